@@ -0,0 +1,249 @@
+"""
+Admission control for AI Fashion Experiment
+重い処理（嫌いな服の解析〜印象予測）の同時実行数を制限し、先着順に待たせる
+
+Jobs are queued in FIFO order and run on a fixed number of worker threads,
+so a burst of submissions never runs more pipelines at once than the
+configured capacity. Waiting times are estimated from the durations of
+recently finished jobs. A job submitted with the key of a job that is
+still queued or running is attached to that job instead of running twice.
+"""
+
+import time
+import uuid
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """Raised when the wait queue has no room for another job."""
+
+
+class Job:
+    """One queued pipeline run."""
+
+    def __init__(self, key, fn, meta=None):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.fn = fn
+        self.meta = meta or {}
+        self.state = 'queued'  # queued -> running -> done / failed
+        self.result = None
+        self.error = None
+        self.enqueued_at = time.monotonic()
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def finished(self):
+        return self.state in ('done', 'failed')
+
+
+class AdmissionController:
+    """
+    Bounded-concurrency FIFO executor with wait-time estimates.
+
+    Args:
+        max_concurrent: Jobs allowed to run at the same time
+        max_queue: Jobs allowed to wait (0 = unlimited)
+        history: Number of recent job durations used for estimates
+        default_duration: Estimated job duration before any job has finished (seconds)
+        retention: Seconds a finished job's status stays available
+    """
+
+    def __init__(self, max_concurrent=2, max_queue=0, history=20, default_duration=120.0, retention=3600):
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_queue = max_queue
+        self.default_duration = default_duration
+        self.retention = retention
+        self._cond = threading.Condition()
+        self._queue = deque()
+        self._jobs = {}
+        self._active_keys = {}  # key -> queued/running job
+        self._durations = deque(maxlen=history)
+        self._workers = []
+        self._stats = {
+            'executed': 0,
+            'coalesced': 0,
+            'rejected': 0,
+            'completed': 0,
+            'failed': 0,
+            'wait_time_total': 0.0,
+        }
+
+    def start(self):
+        """Start the worker threads (idempotent)."""
+        with self._cond:
+            if self._workers:
+                return
+            for index in range(self.max_concurrent):
+                worker = threading.Thread(target=self._run_worker, name=f'admission-{index}', daemon=True)
+                worker.start()
+                self._workers.append(worker)
+
+    def submit(self, key, fn, meta=None):
+        """
+        Queue fn unless a job with the same key is already queued or running.
+
+        Args:
+            key: Identity of the work; equal keys share one job
+            fn: Callable run on a worker thread; its return value becomes job.result
+            meta: Optional dictionary kept on the job for the caller
+
+        Returns:
+            Tuple of (job, shared) where shared is True when an existing job was returned
+
+        Raises:
+            QueueFullError: If max_queue jobs are already waiting
+        """
+        self.start()
+        with self._cond:
+            job = self._active_keys.get(key)
+            if job is not None:
+                self._stats['coalesced'] += 1
+                return job, True
+            if self.max_queue and len(self._queue) >= self.max_queue:
+                self._stats['rejected'] += 1
+                raise QueueFullError(f"{len(self._queue)} jobs are already waiting")
+
+            job = Job(key, fn, meta)
+            self._jobs[job.id] = job
+            self._active_keys[key] = job
+            self._queue.append(job)
+            self._stats['executed'] += 1
+            self._cond.notify()
+        return job, False
+
+    def get(self, job_id):
+        with self._cond:
+            return self._jobs.get(job_id)
+
+    def find_active(self, key):
+        """Return the queued or running job for key, or None."""
+        with self._cond:
+            return self._active_keys.get(key)
+
+    def attach(self, key):
+        """
+        Join the queued or running job for key, counting it as coalesced.
+
+        Lets a caller skip preparing a job (e.g. saving uploads) when an
+        identical one is already active.
+
+        Returns:
+            The active job, or None
+        """
+        with self._cond:
+            job = self._active_keys.get(key)
+            if job is not None:
+                self._stats['coalesced'] += 1
+            return job
+
+    def average_duration(self):
+        with self._cond:
+            return self._average_duration()
+
+    def _average_duration(self):
+        if not self._durations:
+            return self.default_duration
+        return sum(self._durations) / len(self._durations)
+
+    def status(self, job_id):
+        """
+        Return the state, queue position and estimated wait of a job.
+
+        The estimate replays the queue: each waiting job takes the slot that
+        frees up first, and every job is assumed to take the recent average.
+
+        Returns:
+            Dictionary, or None for an unknown (or expired) job
+        """
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            average = self._average_duration()
+            now = time.monotonic()
+            status = {
+                'state': job.state,
+                'position': 0,
+                'queue_length': len(self._queue),
+                'running': len(self._running_jobs()),
+                'estimated_start_seconds': 0.0,
+                'estimated_finish_seconds': 0.0,
+            }
+
+            if job.state == 'running':
+                status['estimated_finish_seconds'] = max(0.0, average - (now - job.started_at))
+            elif job.state == 'queued':
+                # 実行中ジョブの残り時間から、各スロットが空く時刻を求める
+                slots = sorted(max(0.0, average - (now - running.started_at))
+                               for running in self._running_jobs())
+                slots += [0.0] * (self.max_concurrent - len(slots))
+                for position, queued in enumerate(self._queue, start=1):
+                    slots.sort()
+                    start = slots.pop(0)
+                    slots.append(start + average)
+                    if queued is job:
+                        status['position'] = position
+                        status['estimated_start_seconds'] = start
+                        status['estimated_finish_seconds'] = start + average
+                        break
+            return status
+
+    def stats(self):
+        """Return queue length, running jobs, coalescing, duration and wait figures."""
+        with self._cond:
+            stats = dict(self._stats)
+            stats['queued'] = len(self._queue)
+            stats['running'] = len(self._running_jobs())
+            stats['max_concurrent'] = self.max_concurrent
+            stats['max_queue'] = self.max_queue
+            stats['average_duration'] = self._average_duration()
+        total = stats['executed'] + stats['coalesced']
+        stats['coalesced_ratio'] = stats['coalesced'] / total if total else 0.0
+        started = stats['completed'] + stats['failed'] + stats['running']
+        stats['wait_time_avg'] = stats.pop('wait_time_total') / started if started else 0.0
+        return stats
+
+    def _running_jobs(self):
+        return [job for job in self._active_keys.values() if job.state == 'running']
+
+    def _expire(self, now):
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.finished and now - job.finished_at > self.retention]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def _run_worker(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                job = self._queue.popleft()
+                job.state = 'running'
+                job.started_at = time.monotonic()
+                self._stats['wait_time_total'] += job.started_at - job.enqueued_at
+
+            try:
+                job.result = job.fn()
+                state = 'done'
+            except Exception as e:
+                logger.error("Queued job %s failed: %s", job.id, e, exc_info=True)
+                job.error = e
+                state = 'failed'
+
+            with self._cond:
+                job.finished_at = time.monotonic()
+                job.state = state
+                job.fn = None
+                if state == 'done':
+                    # 早く失敗したジョブで見積もりが短くならないよう、成功分だけを使う
+                    self._durations.append(job.finished_at - job.started_at)
+                self._stats['completed' if state == 'done' else 'failed'] += 1
+                if self._active_keys.get(job.key) is job:
+                    del self._active_keys[job.key]
+                self._expire(job.finished_at)
@@ -5,18 +5,32 @@ Flask Application for AI Fashion Experiment
 """
 
 import os
-import base64
+import re
+import gzip
+import hashlib
 import json
+import mimetypes
 import time
+import click
 import requests
 import logging
 import random
+import tempfile
+import threading
 import uuid
 from datetime import datetime
 from functools import wraps
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify, send_from_directory
-from werkzeug.utils import secure_filename
-from openai import OpenAI
+from flask import Flask, render_template, request, redirect, url_for, session, jsonify, send_from_directory, send_file
+from jinja2 import FileSystemBytecodeCache
+from PIL import Image
+from image_service import create_image_service, payload_text, DataUrlCache
+from upload_store import UploadStore
+from http_transport import HttpTransport
+from model_backends import ModelBackend, ModelRegistry
+from static_assets import StaticAssets
+from image_descriptions import DescriptionStore, file_sha256, generate_descriptions
+from admission import AdmissionController, QueueFullError
+from structured_logging import configure_logging, set_correlation_id, PayloadFilter
 
 # ============================================================================
 # Configuration
@@ -30,12 +44,53 @@ UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'jpg', 'jpeg', 'png'}
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
 
-if not os.path.exists(UPLOAD_FOLDER):
-    os.makedirs(UPLOAD_FOLDER)
+UPLOAD_RETENTION_SECONDS = int(os.getenv('UPLOAD_RETENTION_SECONDS', str(7 * 24 * 3600)))  # 0 = 無期限
+UPLOAD_QUOTA_BYTES = int(os.getenv('UPLOAD_QUOTA_BYTES', str(500 * 1024 * 1024)))  # 0 = 無制限
+UPLOAD_JANITOR_INTERVAL = int(os.getenv('UPLOAD_JANITOR_INTERVAL', '600'))  # seconds, 0 = 無効
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = MAX_FILE_SIZE
 
+# Template and response configuration
+JINJA_CACHE_DIR = os.getenv('JINJA_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'fashion_app_jinja_cache'))
+GZIP_LEVEL = 6
+GZIP_MIN_SIZE = 500  # bytes
+COMPRESSIBLE_MIMETYPES = {'text/html', 'text/css', 'application/javascript', 'application/json'}
+
+# ハッシュ付きファイル名・事前圧縮した静的ファイルの出力先
+STATIC_BUILD_DIR = os.getenv('STATIC_BUILD_DIR', os.path.join(tempfile.gettempdir(), 'fashion_app_static'))
+STATIC_IMMUTABLE_MAX_AGE = 365 * 24 * 3600  # seconds
+
+os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+# コンパイル済みテンプレートをディスクに保存し、ワーカー起動時の再コンパイルを省く
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(JINJA_CACHE_DIR)
+
+# Evaluation set configuration
+TEST_DATA_DIR = 'test_data'
+DUMMY_IMAGE_FILENAME = 'virus.png'
+EVAL_MANIFEST_PATH = os.getenv('EVAL_MANIFEST_PATH', os.path.join(TEST_DATA_DIR, 'manifest.json'))
+EVAL_SAMPLE_SIZE = int(os.getenv('EVAL_SAMPLE_SIZE', '0'))  # 0 = 全画像を使用
+EVAL_SAMPLING = os.getenv('EVAL_SAMPLING', 'random')  # 'random' or 'stratified'
+
+# Admission control for the dislike pipeline（ワーカープロセスごとの上限）
+ADMISSION_MAX_CONCURRENT = int(os.getenv('ADMISSION_MAX_CONCURRENT', '3'))
+ADMISSION_MAX_QUEUE = int(os.getenv('ADMISSION_MAX_QUEUE', '50'))  # 0 = 無制限
+ADMISSION_DEFAULT_DURATION = float(os.getenv('ADMISSION_DEFAULT_DURATION', '150'))  # 実績がないときの所要時間の見積もり（秒）
+WAITING_POLL_INTERVAL = 3  # seconds
+
+# Image processing pool (0 workers = run inline on the request thread)
+IMAGE_POOL_WORKERS = int(os.getenv('IMAGE_POOL_WORKERS', str(os.cpu_count() or 1)))
+IMAGE_POOL_QUEUE_SIZE = int(os.getenv('IMAGE_POOL_QUEUE_SIZE', '0'))  # 0 = workers * 4
+IMAGE_MAX_DIMENSION = int(os.getenv('IMAGE_MAX_DIMENSION', '0'))  # 0 = リサイズしない
+EVAL_PAYLOAD_CACHE_BYTES = int(os.getenv('EVAL_PAYLOAD_CACHE_BYTES', str(32 * 1024 * 1024)))  # 0 = 無効
+
+# Criteria/feature extraction（ストリーミングで受信し、箇条書きが揃ったら打ち切る）
+EXTRACTION_MAX_BULLETS = 10  # プロンプトで指示している個数
+EXTRACTION_MAX_TOKENS = 1024
+BULLET_MARK = '・'
+PROGRESS_STREAM_TIMEOUT = int(os.getenv('PROGRESS_STREAM_TIMEOUT', '300'))  # seconds
+PROGRESS_KEEPALIVE_INTERVAL = 15  # seconds
+
 # API Configuration
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 N8N_WEBHOOK_LIKE = os.getenv('N8N_WEBHOOK_LIKE')
@@ -43,19 +98,82 @@ N8N_WEBHOOK_DISLIKE = os.getenv('N8N_WEBHOOK_DISLIKE')
 N8N_WEBHOOK_IMPRESSION = os.getenv('N8N_WEBHOOK_IMPRESSION')
 N8N_WEBHOOK_RESULT = os.getenv('N8N_WEBHOOK_RESULT')
 
+# HTTP transport configuration（OpenAI と n8n で共有する接続プール）
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '10'))  # ワーカーの同時リクエスト数に合わせる
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '5'))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv('HTTP_KEEPALIVE_EXPIRY', '60'))
+HTTP_WARM_CONNECTIONS = int(os.getenv('HTTP_WARM_CONNECTIONS', '2'))  # ホストごとの事前接続数
+OPENAI_READ_TIMEOUT = float(os.getenv('OPENAI_READ_TIMEOUT', '120'))  # 判断基準・特徴の抽出
+PREDICTION_READ_TIMEOUT = float(os.getenv('PREDICTION_READ_TIMEOUT', '30'))  # 印象予測（短文）
+N8N_READ_TIMEOUT = float(os.getenv('N8N_READ_TIMEOUT', '10'))
+
+transport = HttpTransport(HTTP_POOL_SIZE, HTTP_CONNECT_TIMEOUT, OPENAI_READ_TIMEOUT, HTTP_KEEPALIVE_EXPIRY)
+
 # Initialize OpenAI client
 if OPENAI_API_KEY:
-    client = OpenAI(api_key=OPENAI_API_KEY)
+    client = transport.openai_client(OPENAI_API_KEY)
 else:
     client = None
 
-# Logging setup
-logging.basicConfig(level=logging.INFO)
+# Model backends（役割ごとに使うモデル・エンドポイントを切り替える）
+DEFAULT_MODEL_BACKEND = 'gpt-4o-mini'
+MODEL_BACKENDS_PATH = os.getenv('MODEL_BACKENDS_PATH')  # 追加のバックエンド定義（JSON）
+EXTRACTION_BACKEND = os.getenv('EXTRACTION_BACKEND', DEFAULT_MODEL_BACKEND)
+PREDICTION_BACKEND = os.getenv('PREDICTION_BACKEND', DEFAULT_MODEL_BACKEND)
+PREDICTION_HEDGE_BACKEND = os.getenv('PREDICTION_HEDGE_BACKEND') or PREDICTION_BACKEND
+DESCRIPTION_BACKEND = os.getenv('DESCRIPTION_BACKEND', DEFAULT_MODEL_BACKEND)  # 評価用画像の説明文の生成（オフライン）
+HEDGE_MAX_EXTRA_RATIO = float(os.getenv('HEDGE_MAX_EXTRA_RATIO', '0.05'))  # 追加リクエストの上限（呼び出し数比, 0 = 無効）
+HEDGE_PERCENTILE = float(os.getenv('HEDGE_PERCENTILE', '95'))
+HEDGE_MIN_SAMPLES = int(os.getenv('HEDGE_MIN_SAMPLES', '20'))
+
+model_registry = ModelRegistry(
+    default_client=lambda: client,
+    client_factory=lambda backend: transport.openai_client(
+        os.getenv(backend.api_key_env) if backend.api_key_env else OPENAI_API_KEY, base_url=backend.base_url),
+    hedge_max_extra_ratio=HEDGE_MAX_EXTRA_RATIO,
+    hedge_percentile=HEDGE_PERCENTILE,
+    hedge_min_samples=HEDGE_MIN_SAMPLES,
+    max_workers=HTTP_POOL_SIZE
+)
+model_registry.register(ModelBackend(DEFAULT_MODEL_BACKEND, 'gpt-4o-mini', max_tokens=1024))
+if MODEL_BACKENDS_PATH:
+    model_registry.load_config(MODEL_BACKENDS_PATH)
+model_registry.assign('extraction', EXTRACTION_BACKEND)
+model_registry.assign('prediction', PREDICTION_BACKEND, PREDICTION_HEDGE_BACKEND)
+model_registry.assign('description', DESCRIPTION_BACKEND)
+
+# 画像の代わりに事前生成した説明文で予測する手法（カンマ区切り、例: "compare" / "propose,compare"）
+TEXT_ONLY_METHODS = tuple(method.strip() for method in os.getenv('TEXT_ONLY_METHODS', '').split(',') if method.strip())
+
+# Logging setup（キュー経由の JSON ログ、生成テキストはサンプリング・切り詰め）
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv('LOG_PAYLOAD_SAMPLE_RATE', '1.0'))
+LOG_PAYLOAD_MAX_CHARS = int(os.getenv('LOG_PAYLOAD_MAX_CHARS', '200'))  # 0 = 切り詰めない
+
+configure_logging(LOG_LEVEL)
 logger = logging.getLogger(__name__)
+payload_logger = logger.getChild('payload')
+payload_logger.addFilter(PayloadFilter(LOG_PAYLOAD_SAMPLE_RATE, LOG_PAYLOAD_MAX_CHARS))
+
+# 画像のデコード・検証・エンコードを担当するプロセスプール（gunicorn ではワーカー起動時、それ以外は初回使用時に起動）
+image_service = create_image_service(IMAGE_POOL_WORKERS, IMAGE_POOL_QUEUE_SIZE, IMAGE_MAX_DIMENSION)
+
+# 評価用画像の data URL（全参加者・全手法で同じ文字列を使い回す）
+evaluation_payloads = DataUrlCache(EVAL_PAYLOAD_CACHE_BYTES)
+
+# 評価用画像の説明文（test_data/ の画像と同じ場所に保存した .description.json）
+image_descriptions = DescriptionStore()
+
+# アップロード画像の保存先（日付・時間でシャーディングし、定期的に古いファイルを削除）
+upload_store = UploadStore(UPLOAD_FOLDER, UPLOAD_RETENTION_SECONDS, UPLOAD_QUOTA_BYTES)
 
 # メモリ上の印象文キャッシュ（セッションIDをキーとする）
 impression_cache = {}
 
+# 評価用画像セット（初回アクセス時に一度だけ読み込む）
+_evaluation_set = None
+_evaluation_set_lock = threading.Lock()
+
 # ============================================================================
 # Utility Functions
 # ============================================================================
@@ -66,28 +184,111 @@ def allowed_file(filename):
 
 
 def encode_image_to_base64(file_path):
-    """Encode image file to base64 string."""
+    """Validate and encode image file to base64 string in the image pool."""
+    try:
+        return payload_text(image_service.process(file_path), data_url=False)
+    except Exception as e:
+        logger.error("Error encoding image: %s", e)
+        return None
+
+
+def encode_image_to_data_url(file_path):
+    """Validate and encode image file to a data URL string in the image pool."""
     try:
-        with open(file_path, 'rb') as image_file:
-            return base64.b64encode(image_file.read()).decode('utf-8')
+        return payload_text(image_service.process(file_path))
     except Exception as e:
-        logger.error(f"Error encoding image: {e}")
+        logger.error("Error encoding image: %s", e)
         return None
 
 
+def build_image_content(images_paths):
+    """
+    Build OpenAI image_url content parts for several images.
+
+    All images are decoded, validated and encoded in parallel in the image
+    pool; missing or invalid files are skipped. Each encoded buffer is
+    released as soon as its data URL string has been made.
+    """
+    existing_paths = []
+    for img_path in images_paths:
+        if not os.path.exists(img_path):
+            logger.warning("Image file not found: %s", img_path)
+            continue
+        existing_paths.append(img_path)
+
+    image_content = []
+    for result in image_service.process_many(existing_paths):
+        if result:
+            image_content.append({
+                "type": "image_url",
+                "image_url": {
+                    "url": payload_text(result),
+                    "detail": "auto"
+                }
+            })
+    return image_content
+
+
 def get_image_media_type(filename):
     """Get media type based on file extension."""
     ext = filename.rsplit('.', 1)[1].lower()
     return 'image/jpeg' if ext in ['jpg', 'jpeg'] else 'image/png'
 
 
-def extract_criteria_from_images(images_paths, criteria_type='like'):
+def stream_bullets(prompt, image_content, max_bullets=None, on_bullet=None):
+    """
+    Stream a bullet-list completion and stop generation after max_bullets bullets.
+    「・」で始まる行を受信しながら数え、指定数に達した時点で生成を打ち切る
+
+    Args:
+        prompt: Instruction text
+        image_content: image_url content parts
+        max_bullets: Bullets after which the stream is closed (default: EXTRACTION_MAX_BULLETS)
+        on_bullet: Optional callback(index, total) called for each complete bullet line
+
+    Returns:
+        The received text, ending with the last counted bullet
+    """
+    max_bullets = max_bullets or EXTRACTION_MAX_BULLETS
+    stream = model_registry.complete('extraction', prompt, image_content,
+                                     max_tokens=EXTRACTION_MAX_TOKENS, stream=True)
+
+    lines = []
+    pending = ''
+    bullets = 0
+    try:
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            pending += chunk.choices[0].delta.content or ''
+            *complete, pending = pending.split('\n')
+            for line in complete:
+                lines.append(line)
+                if line.strip().startswith(BULLET_MARK):
+                    bullets += 1
+                    if on_bullet:
+                        on_bullet(bullets, max_bullets)
+                    if bullets >= max_bullets:
+                        # 残りのトークンは生成させない（接続を閉じると生成が止まる）
+                        logger.info("Stopped extraction stream after %d bullets", bullets)
+                        return '\n'.join(lines).strip()
+        if pending.strip():
+            lines.append(pending)
+            if pending.strip().startswith(BULLET_MARK) and on_bullet:
+                on_bullet(bullets + 1, max_bullets)
+        return '\n'.join(lines).strip()
+    finally:
+        stream.close()
+
+
+def extract_criteria_from_images(images_paths, criteria_type='like', on_bullet=None):
     """
     Extract judgment criteria from clothing images using OpenAI API.
     
     Args:
         images_paths: List of file paths to images
         criteria_type: 'like' or 'dislike'
+        on_bullet: Optional callback(index, total) called as each criterion arrives
     
     Returns:
         Extracted criteria as string (bullet points)
@@ -113,22 +314,7 @@ markdown形式での記述を避け、**などのマークを含めないでく
 判断基準以外のテキストは出力しないでください。"""
     
     # Build image content for API
-    image_content = []
-    for img_path in images_paths:
-        if not os.path.exists(img_path):
-            logger.warning(f"Image file not found: {img_path}")
-            continue
-        
-        base64_image = encode_image_to_base64(img_path)
-        if base64_image:
-            media_type = get_image_media_type(img_path)
-            image_content.append({
-                "type": "image_url",
-                "image_url": {
-                    "url": f"data:{media_type};base64,{base64_image}",
-                    "detail": "auto"
-                }
-            })
+    image_content = build_image_content(images_paths)
     
     if not image_content:
         raise ValueError("No valid images could be processed")
@@ -138,36 +324,23 @@ markdown形式での記述を避け、**などのマークを含めないでく
         raise ValueError("OpenAI client is not initialized. Please set OPENAI_API_KEY.")
     
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            max_tokens=1024,
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": system_prompt},
-                        *image_content
-                    ]
-                }
-            ]
-        )
-        
-        criteria = response.choices[0].message.content
-        logger.info(f"Extracted {criteria_type} criteria successfully")
-        logger.info(f"[{criteria_type.upper()} CRITERIA]:\n{criteria}")
+        criteria = stream_bullets(system_prompt, image_content, on_bullet=on_bullet)
+        logger.info("Extracted %s criteria successfully", criteria_type)
+        payload_logger.info("[%s CRITERIA]:\n%s", criteria_type.upper(), criteria)
         return criteria
     
     except Exception as e:
-        logger.error(f"OpenAI API error: {e}")
+        logger.error("OpenAI API error: %s", e)
         raise
 
 
-def extract_features_from_images(images_paths):
+def extract_features_from_images(images_paths, on_bullet=None):
     """
     Extract features from clothing images using OpenAI API (for comparison method).
     
     Args:
         images_paths: List of file paths to images
+        on_bullet: Optional callback(index, total) called as each feature arrives
     
     Returns:
         Extracted features as string (bullet points)
@@ -180,22 +353,7 @@ def extract_features_from_images(images_paths):
 ・〜〜〜"""
     
     # Build image content for API
-    image_content = []
-    for img_path in images_paths:
-        if not os.path.exists(img_path):
-            logger.warning(f"Image file not found: {img_path}")
-            continue
-        
-        base64_image = encode_image_to_base64(img_path)
-        if base64_image:
-            media_type = get_image_media_type(img_path)
-            image_content.append({
-                "type": "image_url",
-                "image_url": {
-                    "url": f"data:{media_type};base64,{base64_image}",
-                    "detail": "auto"
-                }
-            })
+    image_content = build_image_content(images_paths)
     
     if not image_content:
         raise ValueError("No valid images could be processed")
@@ -205,31 +363,155 @@ def extract_features_from_images(images_paths):
         raise ValueError("OpenAI client is not initialized. Please set OPENAI_API_KEY.")
     
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            max_tokens=1024,
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": system_prompt},
-                        *image_content
-                    ]
-                }
-            ]
-        )
-        
-        features = response.choices[0].message.content
-        logger.info(f"Extracted features successfully")
-        logger.info(f"[FEATURES]:\n{features}")
+        features = stream_bullets(system_prompt, image_content, on_bullet=on_bullet)
+        logger.info("Extracted features successfully")
+        payload_logger.info("[FEATURES]:\n%s", features)
         return features
     
     except Exception as e:
-        logger.error(f"OpenAI API error: {e}")
+        logger.error("OpenAI API error: %s", e)
         raise
 
 
-def predict_impression(account_name, like_criteria, dislike_criteria, like_features, dislike_features, image_path, retry_count=3, retry_delay=2):
+# Prediction prompt templates ({like_criteria} などは str.format で埋め込む)
+PROPOSE_PROMPT_TEMPLATE = """##判断基準
+###好きな服から抽出された「どんな服を好みであると認定するかの判断基準」
+{like_criteria}
+###嫌いな服から抽出された「どんな服を嫌いと認定するかの判断基準」
+{dislike_criteria}
+##指示
+上記の判断基準はユーザーが実際に好きな服と嫌いな服からLLMによって抽出された判断基準です。
+これらのファッションに対する判断基準を持つ人が、この衣服画像を見た時にどんな印象を持つか一人称視点で予測してください。
+出力は短文で１つだけ簡潔にお願いします。"""
+
+COMPARE_PROMPT_TEMPLATE = """##服の特徴
+###好きな服から抽出された特徴
+{like_features}
+###嫌いな服から抽出された特徴
+{dislike_features}
+##指示
+上記の服の特徴はユーザーの実際に好きな服と嫌いな服からLLMによって抽出されたそれらの服の特徴です。
+これらの特徴を参考にし、その人がこの衣服画像を見た時にどんな印象を持つか一人称視点で予測してください。
+出力は短文で１個簡潔にお願いします。"""
+
+PREDICTION_METHODS = ('propose', 'compare')
+PREDICTION_MAX_TOKENS = 256
+
+_unknown_text_only = set(TEXT_ONLY_METHODS) - set(PREDICTION_METHODS)
+if _unknown_text_only:
+    raise ValueError(f"Unknown methods in TEXT_ONLY_METHODS: {', '.join(sorted(_unknown_text_only))}")
+
+# 画像の代わりに送る説明文（プロンプトの「この衣服画像」はこの説明文を指す）
+DESCRIPTION_PART_TEMPLATE = """##衣服画像の説明
+画像の代わりに、この衣服画像を詳しく説明した文章を示します。
+{description}"""
+
+# 説明文の生成（好み・評価を含めず、見た目だけを詳しく書かせる）
+DESCRIPTION_PROMPT = """この衣服画像を、画像を見られない人が見た目を正確に思い浮かべられるよう詳しく説明してください。
+次の観点をすべて含めてください：
+アイテムの種類、色と配色、柄、素材感、シルエット・サイズ感、丈、襟・袖・装飾などのディテール、
+全体のテイスト・雰囲気、想定される着用シーン。
+良し悪しや好みの評価は含めず、見た目の事実だけを日本語の文章で書いてください。"""
+DESCRIPTION_MAX_TOKENS = 800
+
+
+def prediction_prompt_templates(prompt_templates=None):
+    """Return method -> template, with optional overrides applied to the defaults."""
+    templates = {'propose': PROPOSE_PROMPT_TEMPLATE, 'compare': COMPARE_PROMPT_TEMPLATE}
+    templates.update(prompt_templates or {})
+    return templates
+
+
+def build_prediction_prompts(like_criteria, dislike_criteria, like_features, dislike_features, prompt_templates=None):
+    """
+    Fill the propose/compare prompt templates.
+
+    Args:
+        prompt_templates: Optional {'propose': str, 'compare': str} overriding the defaults
+
+    Returns:
+        Dictionary of method -> prompt text
+    """
+    templates = prediction_prompt_templates(prompt_templates)
+    values = {
+        'like_criteria': like_criteria,
+        'dislike_criteria': dislike_criteria,
+        'like_features': like_features,
+        'dislike_features': dislike_features,
+    }
+    return {method: template.format(**values) for method, template in templates.items()}
+
+
+def build_prediction_image_parts(data_url):
+    """Build the image_url content part of one impression prediction."""
+    return [
+        {"type": "image_url",
+         "image_url": {
+             "url": data_url,
+             "detail": "auto"
+         }}
+    ]
+
+
+def build_prediction_description_parts(description):
+    """Build the text content part that stands in for the image on the text-only path."""
+    return [{"type": "text", "text": DESCRIPTION_PART_TEMPLATE.format(description=description)}]
+
+
+def describe_evaluation_image(image_path):
+    """Generate the detailed description of one evaluation image (offline, see build-descriptions)."""
+    data_url = encode_image_to_data_url(image_path)
+    if not data_url:
+        raise ValueError(f"Could not encode {image_path}")
+    response = model_registry.complete(
+        'description', DESCRIPTION_PROMPT, build_prediction_image_parts(data_url),
+        max_tokens=DESCRIPTION_MAX_TOKENS, timeout=transport.timeout(read=OPENAI_READ_TIMEOUT)
+    )
+    return response.choices[0].message.content
+
+
+def request_prediction(method, prompt, image_parts, image_name, retry_count=3, retry_delay=2):
+    """
+    Run one impression prediction call, retrying on rate limit errors.
+
+    Args:
+        image_parts: Content parts from build_prediction_image_parts()
+            (or build_prediction_description_parts() on the text-only path)
+
+    Returns:
+        Tuple of (prediction text, has_error)
+    """
+    for attempt in range(retry_count):
+        try:
+            # 観測した p95 を超えたら別の試行を並行して送り、先に返った方を使う
+            response = model_registry.complete(
+                'prediction', prompt, image_parts,
+                max_tokens=PREDICTION_MAX_TOKENS, hedge=True,
+                timeout=transport.timeout(read=PREDICTION_READ_TIMEOUT)
+            )
+            prediction = response.choices[0].message.content
+            payload_logger.info("[%s] %s: %s", method.upper(), image_name, prediction)
+            return prediction, False
+        except Exception as e:
+            error_str = str(e).lower()
+            if "rate_limit" in error_str or "429" in error_str:
+                logger.warning("Rate limit hit for %s method on %s, attempt %d/%d", method, image_name, attempt + 1, retry_count)
+                if attempt < retry_count - 1:
+                    wait_time = retry_delay * (attempt + 1)
+                    logger.info("Waiting %d seconds before retry...", wait_time)
+                    time.sleep(wait_time)
+                else:
+                    logger.error("Rate limit exceeded after %d attempts for %s method on %s", retry_count, method, image_name)
+                    return 'エラー: レート制限', True
+            else:
+                logger.error("OpenAI API error during %s prediction for %s: %s", method, image_name, e)
+                return 'エラー', True
+    return None, True
+
+
+def predict_impression(account_name, like_criteria, dislike_criteria, like_features, dislike_features, image_path,
+                       retry_count=3, retry_delay=2, methods=PREDICTION_METHODS, prompt_templates=None, method_interval=1,
+                       text_only_methods=TEXT_ONLY_METHODS):
     """
     Predict impression of a clothing image based on extracted criteria and features.
     生成した印象文はN8Nに保存し、完全な印象文を返す。
@@ -243,135 +525,63 @@ def predict_impression(account_name, like_criteria, dislike_criteria, like_featu
         image_path: Path to the evaluation image
         retry_count: Number of retries on rate limit error
         retry_delay: Delay in seconds between retries
+        methods: Methods to run ('propose' and/or 'compare'); skipped methods predict None
+        prompt_templates: Optional prompt template overrides per method
+        method_interval: Delay in seconds between the method calls
+        text_only_methods: Methods that send the image's precomputed description
+            instead of the image (methods without a current description use the image)
     
     Returns:
         Dictionary with impression data
     """
     
     if not os.path.exists(image_path):
-        logger.warning(f"Image file not found: {image_path}")
+        logger.warning("Image file not found: %s", image_path)
         return None
     
-    base64_image = encode_image_to_base64(image_path)
-    if not base64_image:
-        return None
-    
-    media_type = get_image_media_type(image_path)
     image_name = os.path.basename(image_path)
     
+    # テキストのみの手法は事前生成した説明文を送る（説明文がない・古い場合は画像を送る）
+    text_methods = [method for method in methods if method in text_only_methods]
+    content_parts = {}
+    if text_methods:
+        description = image_descriptions.get(image_path)
+        if description:
+            description_parts = build_prediction_description_parts(description)
+            content_parts = {method: description_parts for method in text_methods}
+        else:
+            text_methods = []
+            logger.warning("No current description for %s, predicting from the image", image_name)
+    
+    if len(content_parts) < len(methods):
+        # 評価用画像は同じ data URL を全呼び出しで共有する（手法ごとにコピーしない）
+        data_url = evaluation_payloads.get(image_path, encode_image_to_data_url)
+        if not data_url:
+            return None
+        image_parts = build_prediction_image_parts(data_url)
+        for method in methods:
+            content_parts.setdefault(method, image_parts)
+    
     # 印象文IDを生成
     impression_id = str(uuid.uuid4())
     
-    # Prediction with both criteria (proposed method)
-    propose_prompt = f"""##判断基準
-###好きな服から抽出された「どんな服を好みであると認定するかの判断基準」
-{like_criteria}
-###嫌いな服から抽出された「どんな服を嫌いと認定するかの判断基準」
-{dislike_criteria}
-##指示
-上記の判断基準はユーザーが実際に好きな服と嫌いな服からLLMによって抽出された判断基準です。
-これらのファッションに対する判断基準を持つ人が、この衣服画像を見た時にどんな印象を持つか一人称視点で予測してください。
-出力は短文で１つだけ簡潔にお願いします。"""
+    prompts = build_prediction_prompts(like_criteria, dislike_criteria, like_features, dislike_features,
+                                       prompt_templates)
     
-    # Prediction with features (comparison method)
-    compare_prompt = f"""##服の特徴
-###好きな服から抽出された特徴
-{like_features}
-###嫌いな服から抽出された特徴
-{dislike_features}
-##指示
-上記の服の特徴はユーザーの実際に好きな服と嫌いな服からLLMによって抽出されたそれらの服の特徴です。
-これらの特徴を参考にし、その人がこの衣服画像を見た時にどんな印象を持つか一人称視点で予測してください。
-出力は短文で１個簡潔にお願いします。"""
-    
-    prediction_propose = None
-    prediction_compare = None
+    predictions = {method: None for method in PREDICTION_METHODS}
     has_error = False
     
-    # Proposed method prediction with retry
-    for attempt in range(retry_count):
-        try:
-            response_propose = client.chat.completions.create(
-                model="gpt-4o-mini",
-                max_tokens=256,
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": propose_prompt},
-                            {"type": "image_url",
-                             "image_url": {
-                                 "url": f"data:{media_type};base64,{base64_image}",
-                                 "detail": "auto"
-                             }}
-                        ]
-                    }
-                ]
-            )
-            prediction_propose = response_propose.choices[0].message.content
-            logger.info(f"[PROPOSE] {image_name}: {prediction_propose}")
-            break
-        except Exception as e:
-            error_str = str(e).lower()
-            if "rate_limit" in error_str or "429" in error_str:
-                logger.warning(f"Rate limit hit for propose method on {image_name}, attempt {attempt + 1}/{retry_count}")
-                if attempt < retry_count - 1:
-                    wait_time = retry_delay * (attempt + 1)
-                    logger.info(f"Waiting {wait_time} seconds before retry...")
-                    time.sleep(wait_time)
-                else:
-                    logger.error(f"Rate limit exceeded after {retry_count} attempts for propose method on {image_name}")
-                    prediction_propose = 'エラー: レート制限'
-                    has_error = True
-            else:
-                logger.error(f"OpenAI API error during propose prediction for {image_name}: {e}")
-                prediction_propose = 'エラー'
-                has_error = True
-                break
+    for index, method in enumerate(methods):
+        # 提案手法と比較手法の間に待機時間を入れる
+        if index and method_interval:
+            time.sleep(method_interval)
+        predictions[method], method_error = request_prediction(
+            method, prompts[method], content_parts[method], image_name, retry_count, retry_delay
+        )
+        has_error = has_error or method_error
     
-    # 提案手法と比較手法の間に待機時間を入れる
-    time.sleep(1)
-    
-    # Comparison method prediction with retry
-    for attempt in range(retry_count):
-        try:
-            response_compare = client.chat.completions.create(
-                model="gpt-4o-mini",
-                max_tokens=256,
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": compare_prompt},
-                            {"type": "image_url",
-                             "image_url": {
-                                 "url": f"data:{media_type};base64,{base64_image}",
-                                 "detail": "auto"
-                             }}
-                        ]
-                    }
-                ]
-            )
-            prediction_compare = response_compare.choices[0].message.content
-            logger.info(f"[COMPARE] {image_name}: {prediction_compare}")
-            break
-        except Exception as e:
-            error_str = str(e).lower()
-            if "rate_limit" in error_str or "429" in error_str:
-                logger.warning(f"Rate limit hit for compare method on {image_name}, attempt {attempt + 1}/{retry_count}")
-                if attempt < retry_count - 1:
-                    wait_time = retry_delay * (attempt + 1)
-                    logger.info(f"Waiting {wait_time} seconds before retry...")
-                    time.sleep(wait_time)
-                else:
-                    logger.error(f"Rate limit exceeded after {retry_count} attempts for compare method on {image_name}")
-                    prediction_compare = 'エラー: レート制限'
-                    has_error = True
-            else:
-                logger.error(f"OpenAI API error during compare prediction for {image_name}: {e}")
-                prediction_compare = 'エラー'
-                has_error = True
-                break
+    prediction_propose = predictions['propose']
+    prediction_compare = predictions['compare']
     
     # N8Nに印象文を保存（バックアップ用）
     impression_data = {
@@ -385,7 +595,7 @@ def predict_impression(account_name, like_criteria, dislike_criteria, like_featu
     }
     
     if prediction_propose and prediction_compare and not has_error:
-        logger.info(f"Successfully predicted impressions for {image_name}, ID: {impression_id}")
+        logger.info("Successfully predicted impressions for %s, ID: %s", image_name, impression_id)
     
     # 完全なデータを返す
     return {
@@ -395,7 +605,8 @@ def predict_impression(account_name, like_criteria, dislike_criteria, like_featu
         'prediction_propose': prediction_propose,
         'prediction_compare': prediction_compare,
         'timestamp': datetime.now().isoformat(),
-        'has_error': has_error
+        'has_error': has_error,
+        'text_only_methods': text_methods
     }
 
 
@@ -411,26 +622,603 @@ def send_to_n8n(webhook_url, data):
         Boolean indicating success
     """
     if not webhook_url:
-        logger.warning(f"N8N webhook URL not configured")
+        logger.warning("N8N webhook URL not configured")
         return False
     
     try:
-        response = requests.post(webhook_url, json=data, timeout=10)
+        response = transport.post_json(webhook_url, data, read_timeout=N8N_READ_TIMEOUT)
         if response.status_code == 200:
-            logger.info(f"Successfully sent data to n8n: {webhook_url}")
+            logger.info("Successfully sent data to n8n: %s", webhook_url)
             return True
         else:
-            logger.warning(f"n8n webhook returned status {response.status_code}")
+            logger.warning("n8n webhook returned status %s", response.status_code)
             return False
     except requests.exceptions.RequestException as e:
-        logger.error(f"Failed to send data to n8n: {e}")
+        logger.error("Failed to send data to n8n: %s", e)
         return False
 
 
+# ============================================================================
+# Progress Events
+# ============================================================================
+
+PROGRESS_ID_PATTERN = re.compile(r'[A-Za-z0-9-]{8,64}')
+
+
+class ProgressBoard:
+    """
+    In-process progress events for running uploads, keyed by a page-generated ID.
+    アップロード処理の進捗をページへ送るためのイベント置き場
+
+    Events are kept until ttl seconds after the first one was published, so
+    a listener that connects late still receives everything from the start.
+    """
+
+    def __init__(self, ttl=600):
+        self.ttl = ttl
+        self._cond = threading.Condition()
+        self._events = {}  # progress_id -> (created, [event, ...])
+
+    def publish(self, progress_id, **event):
+        """Append one event; ignored when the page did not send a progress ID."""
+        if not progress_id:
+            return
+        with self._cond:
+            now = time.monotonic()
+            for key in [k for k, (created, _) in self._events.items() if now - created > self.ttl]:
+                del self._events[key]
+            self._events.setdefault(progress_id, (now, []))[1].append(event)
+            self._cond.notify_all()
+
+    def latest(self, progress_id):
+        """Return the most recent event for progress_id, or None."""
+        with self._cond:
+            events = self._events.get(progress_id, (None, []))[1]
+            return events[-1] if events else None
+
+    def listen(self, progress_id, timeout, keepalive=PROGRESS_KEEPALIVE_INTERVAL):
+        """
+        Yield events as they are published until a 'done' event or timeout.
+
+        None is yielded after every keepalive seconds without events.
+        """
+        cursor = 0
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._cond:
+                events = self._events.get(progress_id, (None, []))[1]
+                if cursor >= len(events):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return
+                    self._cond.wait(min(remaining, keepalive))
+                    events = self._events.get(progress_id, (None, []))[1]
+                new_events = events[cursor:]
+                cursor = len(events)
+            if not new_events:
+                yield None
+            for event in new_events:
+                yield event
+                if event['type'] == 'done':
+                    return
+
+
+progress_board = ProgressBoard()
+
+
+def bullet_reporter(progress_id, stage):
+    """Return an on_bullet callback that publishes extraction progress for one stage."""
+    def on_bullet(index, total):
+        progress_board.publish(progress_id, type='bullet', stage=stage, index=index, total=total)
+    return on_bullet
+
+
+# ============================================================================
+# Evaluation Set
+# ============================================================================
+
+def _describe_image(test_data_dir, filename):
+    """Collect the precomputed metadata stored for one evaluation image."""
+    file_path = os.path.join(test_data_dir, filename)
+    with Image.open(file_path) as img:
+        width, height = img.size
+    return {
+        'filename': filename,
+        'sha256': file_sha256(file_path),
+        'width': width,
+        'height': height,
+        'media_type': get_image_media_type(filename),
+        'bytes': os.path.getsize(file_path),
+    }
+
+
+def build_evaluation_manifest(test_data_dir=TEST_DATA_DIR):
+    """
+    Scan the evaluation image directory and build a manifest dictionary.
+    評価用画像のマニフェストを生成する
+
+    Every allowed image except the dummy becomes an item. Items keep the
+    natural order of their file names (test2 before test10) and default to
+    the 'default' stratum. The dummy gets the first free id from
+    test{N+2} upwards (test22 for the original 20 images), so it never
+    shares an item's form fields.
+
+    Args:
+        test_data_dir: Directory containing the evaluation images
+
+    Returns:
+        Manifest dictionary with 'items' and 'dummy'
+    """
+    filenames = [
+        name for name in os.listdir(test_data_dir)
+        if allowed_file(name) and name != DUMMY_IMAGE_FILENAME
+    ]
+    filenames.sort(key=lambda name: [int(part) if part.isdigit() else part
+                                     for part in re.split(r'(\d+)', name)])
+
+    items = []
+    for filename in filenames:
+        item = {'id': os.path.splitext(filename)[0]}
+        item.update(_describe_image(test_data_dir, filename))
+        item['stratum'] = 'default'
+        items.append(item)
+
+    dummy = None
+    if os.path.exists(os.path.join(test_data_dir, DUMMY_IMAGE_FILENAME)):
+        ids = {item['id'] for item in items}
+        number = len(items) + 2
+        while f'test{number}' in ids:
+            number += 1
+        dummy = {'id': f'test{number}'}
+        dummy.update(_describe_image(test_data_dir, DUMMY_IMAGE_FILENAME))
+        dummy.update({
+            'prediction_propose': 'ここでは１と入力してください。',
+            'prediction_compare': 'ここでは５を入力してください',
+            'expected_score_left': 1,
+            'expected_score_right': 5,
+        })
+
+    return {'version': 1, 'items': items, 'dummy': dummy}
+
+
+def load_evaluation_set(manifest_path=EVAL_MANIFEST_PATH, test_data_dir=TEST_DATA_DIR):
+    """
+    Load the evaluation manifest and index it for sampling.
+
+    Falls back to scanning test_data_dir when no manifest file exists, so a
+    fresh checkout still works; run `flask --app app build-manifest` to
+    write the file.
+
+    Returns:
+        Dictionary with 'items', 'dummy' and 'strata' (stratum -> item indices)
+    """
+    if os.path.exists(manifest_path):
+        with open(manifest_path, encoding='utf-8') as f:
+            manifest = json.load(f)
+    else:
+        logger.warning("Evaluation manifest not found at %s, scanning %s", manifest_path, test_data_dir)
+        manifest = build_evaluation_manifest(test_data_dir)
+
+    items = manifest.get('items', [])
+    # 評価フォームの入力欄名は id から作るため、重複があると別の画像の点数を読んでしまう
+    ids = [item['id'] for item in items]
+    if manifest.get('dummy'):
+        ids.append(manifest['dummy']['id'])
+    duplicates = sorted({item_id for item_id in ids if ids.count(item_id) > 1})
+    if duplicates:
+        raise ValueError(f"Duplicate evaluation ids in {manifest_path}: {', '.join(duplicates)}")
+
+    strata = {}
+    for index, item in enumerate(items):
+        strata.setdefault(item.get('stratum', 'default'), []).append(index)
+
+    logger.info("Loaded evaluation set: %d images in %d strata", len(items), len(strata))
+    return {'items': items, 'dummy': manifest.get('dummy'), 'strata': strata}
+
+
+def get_evaluation_set():
+    """Return the process-wide evaluation set, loading it on first use."""
+    global _evaluation_set
+    if _evaluation_set is None:
+        with _evaluation_set_lock:
+            if _evaluation_set is None:
+                _evaluation_set = load_evaluation_set()
+    return _evaluation_set
+
+
+def sample_evaluation_items(evaluation_set, sample_size=0, strategy='random', rng=None):
+    """
+    Pick the evaluation items shown to one participant.
+
+    Args:
+        evaluation_set: Result of load_evaluation_set()
+        sample_size: Number of items to draw (0 or >= total means all items)
+        strategy: 'random' or 'stratified' (proportional per stratum)
+        rng: random.Random instance (defaults to the module RNG)
+
+    Returns:
+        List of manifest items in manifest order
+    """
+    items = evaluation_set['items']
+    if sample_size <= 0 or sample_size >= len(items):
+        return list(items)
+
+    rng = rng or random
+    if strategy == 'stratified':
+        strata = evaluation_set['strata']
+        # 各層から割合に応じて枚数を割り当て、端数は余りの大きい層から配分する
+        quotas = {name: sample_size * len(indices) / len(items) for name, indices in strata.items()}
+        counts = {name: int(quota) for name, quota in quotas.items()}
+        remainder = sample_size - sum(counts.values())
+        for name in sorted(quotas, key=lambda n: quotas[n] - counts[n], reverse=True)[:remainder]:
+            counts[name] += 1
+        chosen = []
+        for name, indices in strata.items():
+            chosen.extend(rng.sample(indices, counts[name]))
+    else:
+        chosen = rng.sample(range(len(items)), sample_size)
+
+    return [items[index] for index in sorted(chosen)]
+
+
+@app.cli.command('build-manifest')
+def build_manifest_command():
+    """Write the evaluation manifest for the images in test_data/."""
+    manifest = build_evaluation_manifest(TEST_DATA_DIR)
+    with open(EVAL_MANIFEST_PATH, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+        f.write('\n')
+    print(f"Wrote {len(manifest['items'])} items to {EVAL_MANIFEST_PATH}")
+
+
+@app.cli.command('build-descriptions')
+@click.option('--force', is_flag=True, help='Regenerate descriptions that are still current.')
+def build_descriptions_command(force):
+    """Write a text description next to every evaluation image in test_data/."""
+    image_paths = [os.path.join(TEST_DATA_DIR, item['filename']) for item in get_evaluation_set()['items']]
+    result = generate_descriptions(image_paths, describe_evaluation_image,
+                                   model_registry.backend_for('description').model,
+                                   store=image_descriptions, force=force)
+    print(f"Wrote {len(result['written'])}, kept {len(result['skipped'])}, failed {len(result['failed'])} descriptions")
+    for name in result['failed']:
+        print(f"  failed: {name}")
+
+
+# ============================================================================
+# Admission Control
+# ============================================================================
+
+# /second の解析パイプライン（同時実行数を制限し、先着順に待たせる。同一送信は1回だけ実行）
+dislike_admission = AdmissionController(
+    max_concurrent=ADMISSION_MAX_CONCURRENT,
+    max_queue=ADMISSION_MAX_QUEUE,
+    default_duration=ADMISSION_DEFAULT_DURATION
+)
+
+
+def submission_key(account_name, like_criteria, like_features, files):
+    """
+    Build the coalescing key for a dislike-page submission.
+
+    The participant is identified by the session data fixed on the first
+    page (a refresh resends the same cookie), and the upload by a hash of
+    every file's content. File streams are rewound after hashing.
+    """
+    digest = hashlib.sha256()
+    for value in (account_name, like_criteria, like_features):
+        digest.update(value.encode('utf-8'))
+        digest.update(b'\0')
+    for file in files:
+        for chunk in iter(lambda: file.stream.read(65536), b''):
+            digest.update(chunk)
+        file.stream.seek(0)
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+# ============================================================================
+# Pipeline
+# ============================================================================
+
+class PipelineError(Exception):
+    """Pipeline failure whose message is shown to the participant as-is."""
+
+
+def run_dislike_pipeline(account_name, like_criteria, like_features, image_paths, cache_key,
+                         progress_id=None):
+    """
+    Extract dislike criteria/features and predict impressions for the evaluation set.
+    嫌いな服の解析から印象予測までの一連の処理
+
+    Args:
+        account_name: Account name for tracking
+        like_criteria: Criteria extracted on the first page
+        like_features: Features extracted on the first page
+        image_paths: Saved paths of the disliked clothing images
+        cache_key: impression_cache key to store the result under
+        progress_id: Optional ID under which progress events are published
+
+    Returns:
+        cache_key under which the display model was stored
+
+    Raises:
+        PipelineError: If no evaluation image could be processed
+    """
+    # 提案手法用：判断基準を抽出
+    dislike_criteria = extract_criteria_from_images(image_paths, criteria_type='dislike',
+                                                    on_bullet=bullet_reporter(progress_id, 'dislike_criteria'))
+    logger.info("Dislike criteria extracted successfully")
+
+    # 比較手法用：特徴を抽出
+    dislike_features = extract_features_from_images(image_paths,
+                                                    on_bullet=bullet_reporter(progress_id, 'dislike_features'))
+    logger.info("Dislike features extracted successfully")
+
+    n8n_data = {
+        'account_name': account_name,
+        'timestamp': datetime.now().isoformat(),
+        'dislike_criteria': dislike_criteria,
+        'dislike_features': dislike_features
+    }
+    send_to_n8n(N8N_WEBHOOK_DISLIKE, n8n_data)
+
+    # メモリ上に印象文を保持する配列
+    impressions_list = []
+    impressions_for_save = []
+
+    # マニフェストから評価用画像をサンプリング（存在確認はマニフェスト生成時に済んでいる）
+    evaluation_set = get_evaluation_set()
+    evaluation_items = sample_evaluation_items(evaluation_set, EVAL_SAMPLE_SIZE, EVAL_SAMPLING)
+    logger.info("Sampled %d of %d evaluation images", len(evaluation_items), len(evaluation_set['items']))
+
+    # 各画像に対して印象予測
+    for position, item in enumerate(evaluation_items):
+        img_file = item['filename']
+        img_path = os.path.join(TEST_DATA_DIR, img_file)
+        progress_board.publish(progress_id, type='prediction', index=position + 1, total=len(evaluation_items))
+
+        try:
+            logger.debug("Processing %s...", img_file)
+            impression_data = predict_impression(
+                account_name, like_criteria, dislike_criteria, 
+                like_features, dislike_features, img_path
+            )
+
+            if impression_data:
+                # ランダムに左右の表示順序を決定
+                show_propose_left = random.choice([True, False])
+
+                # メモリ上に完全なデータを保持
+                impressions_list.append({
+                    'id': item['id'],
+                    'filename': img_file,
+                    'impression_id': impression_data['impression_id'],
+                    'prediction_propose': impression_data['prediction_propose'],
+                    'prediction_compare': impression_data['prediction_compare'],
+                    'show_propose_left': show_propose_left,
+                    'has_error': impression_data['has_error']
+                })
+                impressions_for_save.append({
+                    'image_name': impression_data['image_name'],
+                    'account_name': impression_data['account_name'],
+                    'impression_id': impression_data['impression_id'],
+                    'prediction_propose': impression_data['prediction_propose'],
+                    'prediction_compare': impression_data['prediction_compare'],
+                    'has_error': impression_data['has_error']
+                })
+
+                logger.debug("Successfully processed %s", img_file)
+
+            # 各画像処理の後に待機時間を追加（レート制限回避）
+            if position < len(evaluation_items) - 1:
+                time.sleep(2)
+
+        except Exception as e:
+            logger.error("Error predicting for %s: %s", img_file, e, exc_info=True)
+            impressions_list.append({
+                'id': item['id'],
+                'filename': img_file,
+                'impression_id': 'error',
+                'prediction_propose': 'エラー',
+                'prediction_compare': 'エラー',
+                'show_propose_left': True,
+                'has_error': True
+            })
+    send_to_n8n(N8N_WEBHOOK_IMPRESSION, {"data": impressions_for_save})
+    logger.info("Total evaluation images prepared: %d", len(impressions_list))
+
+    if len(impressions_list) == 0:
+        logger.error("No evaluation images could be processed")
+        raise PipelineError('評価用画像の処理に失敗しました')
+
+    # ダミー項目を追加（注意喚起用）
+    dummy = evaluation_set['dummy']
+    if dummy:
+        impressions_list.append({
+            'id': dummy['id'],
+            'filename': dummy['filename'],
+            'impression_id': dummy['id'],
+            'prediction_propose': dummy['prediction_propose'],
+            'prediction_compare': dummy['prediction_compare'],
+            'show_propose_left': True,
+            'has_error': False,
+            'is_dummy': True,
+            'expected_score_left': dummy['expected_score_left'],
+            'expected_score_right': dummy['expected_score_right']
+        })
+
+    # リストをシャッフルしてダミー項目の位置をランダムにする
+    random.shuffle(impressions_list)
+
+    # メモリ上のキャッシュに保存
+    impression_cache[cache_key] = {
+        'images': build_output_view_model(impressions_list),
+        'pages': {}
+    }
+
+    logger.info("Stored %d impressions in memory cache with key: %s", len(impressions_list), cache_key)
+    return cache_key
+
+
+
+# ============================================================================
+# Output Page
+# ============================================================================
+
+def build_output_view_model(impressions_list):
+    """
+    Expand stored impressions into the rows rendered by output.html.
+    表示用データ（左右の予測文・手法）を印象文保存時に一度だけ構築する
+
+    Args:
+        impressions_list: Shuffled impression items built in second()
+
+    Returns:
+        List of display dictionaries
+    """
+    expanded_images = []
+    for img_data in impressions_list:
+        show_propose_left = img_data['show_propose_left']
+        
+        expanded_images.append({
+            'id': img_data['id'],
+            'filename': img_data['filename'],
+            'impression_id': img_data['impression_id'],
+            'prediction_propose': img_data['prediction_propose'],
+            'prediction_compare': img_data['prediction_compare'],
+            'show_propose_left': show_propose_left,
+            'left_prediction': img_data['prediction_propose'] if show_propose_left else img_data['prediction_compare'],
+            'right_prediction': img_data['prediction_compare'] if show_propose_left else img_data['prediction_propose'],
+            'left_method': 'propose' if show_propose_left else 'compare',
+            'right_method': 'compare' if show_propose_left else 'propose',
+            'is_dummy': img_data.get('is_dummy', False),  # ダミーフラグを追加
+            'expected_score_left': img_data.get('expected_score_left', 1),
+            'expected_score_right': img_data.get('expected_score_right', 5)
+        })
+    return expanded_images
+
+
+def accepts_gzip():
+    """Return True if the request accepts gzip (an entry with q=0 refuses it)."""
+    # `'gzip' in request.accept_encodings` は品質値を見ないため q=0 でも True になる
+    return request.accept_encodings['gzip'] > 0
+
+
+def render_output_page(cache_entry, error=None):
+    """
+    Return the evaluation page for one participant, rendering it at most once.
+
+    The page contains no score state, so the rendered HTML (plain and
+    gzip-compressed) is cached in the participant's cache entry per error
+    message and reused for every later GET or failed POST.
+    """
+    pages = cache_entry['pages']
+    page = pages.get(error)
+    if page is None:
+        html = render_template('output.html', evaluation_images=cache_entry['images'], error=error)
+        body = html.encode('utf-8')
+        page = {'body': body, 'gzip': gzip.compress(body, compresslevel=GZIP_LEVEL)}
+        pages[error] = page
+
+    if accepts_gzip():
+        response = app.response_class(page['gzip'], mimetype='text/html')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = app.response_class(page['body'], mimetype='text/html')
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+@app.after_request
+def compress_response(response):
+    """Gzip-compress text responses for clients that accept it."""
+    if (response.direct_passthrough or response.is_streamed
+            or response.status_code < 200 or response.status_code >= 300
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES
+            or not accepts_gzip()):
+        return response
+
+    body = response.get_data()
+    if len(body) < GZIP_MIN_SIZE:
+        return response
+
+    response.set_data(gzip.compress(body, compresslevel=GZIP_LEVEL))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+# ============================================================================
+# Static Assets
+# ============================================================================
+
+# 起動時に一度だけ生成する（内容が同じならファイル名も同じなので再生成は不要）
+static_assets = StaticAssets(app.static_folder, STATIC_BUILD_DIR)
+static_assets.build()
+
+
+@app.url_defaults
+def fingerprint_static_urls(endpoint, values):
+    """Point url_for('static', filename=...) at the fingerprinted file."""
+    if endpoint == 'static' and 'filename' in values:
+        values['filename'] = static_assets.url_name(values['filename'])
+
+
+def serve_static(filename):
+    """
+    Serve static files, preferring the precompressed fingerprinted variants.
+
+    Fingerprinted names are cached as immutable; anything else falls back
+    to Flask's default static handling.
+    """
+    selected = static_assets.select(filename, request.accept_encodings)
+    if selected is None:
+        return app.send_static_file(filename)
+
+    path, encoding = selected
+    # 圧縮版でも Content-Type は元ファイルのもの
+    response = send_file(path, mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+                         conditional=True, max_age=STATIC_IMMUTABLE_MAX_AGE)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.cache_control.immutable = True
+    response.cache_control.public = True
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+app.view_functions['static'] = serve_static
+
+
+@app.cli.command('build-static')
+def build_static_command():
+    """Fingerprint and precompress the files in static/."""
+    for filename, built_name in sorted(static_assets.build().items()):
+        print(f"{filename} -> {built_name}")
+
+
 # ============================================================================
 # Routes
 # ============================================================================
 
+@app.before_request
+def start_background_services():
+    """Start per-process background threads on the first served request."""
+    if not app.testing:
+        upload_store.start_janitor(UPLOAD_JANITOR_INTERVAL)
+
+
+@app.before_request
+def bind_correlation_id():
+    """Tag this request's log records with the participant's ID."""
+    if request.endpoint == 'static':
+        return
+    if 'participant_id' not in session and request.method == 'POST':
+        session['participant_id'] = uuid.uuid4().hex
+    set_correlation_id(session.get('participant_id'))
+
+
 @app.route('/', methods=['GET', 'POST'])
 def index():
     """
@@ -446,25 +1234,28 @@ def index():
         if not uploaded_files or len(uploaded_files) < 5:
             return render_template('index.html', error='好きな服を5枚アップロードしてください'), 400
         
-        image_paths = []
-        for file in uploaded_files:
-            if file and file.filename and allowed_file(file.filename):
-                filename = secure_filename(file.filename)
-                timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_')
-                filename = timestamp + filename
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                file.save(filepath)
-                image_paths.append(filepath)
+        image_paths = upload_store.save(
+            file for file in uploaded_files
+            if file and file.filename and allowed_file(file.filename)
+        )
         
         if len(image_paths) < 5:
+            upload_store.release(image_paths)
             return render_template('index.html', error='有効な画像ファイルが5枚に達しません'), 400
         
+        progress_id = request.form.get('progress_id')
         try:
-            # 提案手法用：判断基準を抽出
-            like_criteria = extract_criteria_from_images(image_paths, criteria_type='like')
-            
-            # 比較手法用：特徴を抽出
-            like_features = extract_features_from_images(image_paths)
+            # 解析中はアップロード画像を削除対象から外す（save() が使用中登録済み）
+            try:
+                # 提案手法用：判断基準を抽出
+                like_criteria = extract_criteria_from_images(
+                    image_paths, criteria_type='like', on_bullet=bullet_reporter(progress_id, 'like_criteria'))
+                
+                # 比較手法用：特徴を抽出
+                like_features = extract_features_from_images(
+                    image_paths, on_bullet=bullet_reporter(progress_id, 'like_features'))
+            finally:
+                upload_store.release(image_paths)
             
             session['account_name'] = account_name
             session['like_criteria'] = like_criteria
@@ -481,8 +1272,10 @@ def index():
             return redirect(url_for('second'))
         
         except Exception as e:
-            logger.error(f"Error processing like images: {e}", exc_info=True)
+            logger.error("Error processing like images: %s", e, exc_info=True)
             return render_template('index.html', error=f'エラーが発生しました: {str(e)}'), 500
+        finally:
+            progress_board.publish(progress_id, type='done')
     
     return render_template('index.html')
 
@@ -507,145 +1300,48 @@ def second():
         if not uploaded_files or len(uploaded_files) < 5:
             return render_template('second.html', account_name=account_name, error='嫌いな服を5枚アップロードしてください'), 400
         
-        image_paths = []
-        for file in uploaded_files:
-            if file and file.filename and allowed_file(file.filename):
-                filename = secure_filename(file.filename)
-                timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_')
-                filename = timestamp + filename
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                file.save(filepath)
-                image_paths.append(filepath)
+        valid_files = [file for file in uploaded_files
+                       if file and file.filename and allowed_file(file.filename)]
         
-        if len(image_paths) < 5:
+        if len(valid_files) < 5:
             return render_template('second.html', account_name=account_name, error='有効な画像ファイルが5枚に達しません'), 400
         
-        try:
-            # 提案手法用：判断基準を抽出
-            dislike_criteria = extract_criteria_from_images(image_paths, criteria_type='dislike')
-            logger.info("Dislike criteria extracted successfully")
-            
-            # 比較手法用：特徴を抽出
-            dislike_features = extract_features_from_images(image_paths)
-            logger.info("Dislike features extracted successfully")
-            
-            n8n_data = {
-                'account_name': account_name,
-                'timestamp': datetime.now().isoformat(),
-                'dislike_criteria': dislike_criteria,
-                'dislike_features': dislike_features
-            }
-            send_to_n8n(N8N_WEBHOOK_DISLIKE, n8n_data)
-            
-            # メモリ上に印象文を保持する配列
-            impressions_list = []
-            impressions_for_save = []
-            test_data_dir = 'test_data'
-            
-            # test_dataディレクトリの存在確認
-            if not os.path.exists(test_data_dir):
-                logger.error(f"test_data directory not found at: {os.path.abspath(test_data_dir)}")
-                return render_template('second.html', account_name=account_name, 
-                                     error='評価用画像ディレクトリが見つかりません'), 500
-            
-            logger.info(f"test_data directory found at: {os.path.abspath(test_data_dir)}")
-            
-            # 各画像に対して印象予測
-            for i in range(1, 21):
-                img_file = f'test{i}.jpg'
-                img_path = os.path.join(test_data_dir, img_file)
-                
-                if os.path.exists(img_path):
-                    try:
-                        logger.info(f"Processing {img_file}...")
-                        impression_data = predict_impression(
-                            account_name, like_criteria, dislike_criteria, 
-                            like_features, dislike_features, img_path
-                        )
-                        
-                        if impression_data:
-                            # ランダムに左右の表示順序を決定
-                            show_propose_left = random.choice([True, False])
-                            
-                            # メモリ上に完全なデータを保持
-                            impressions_list.append({
-                                'id': f'test{i}',
-                                'filename': img_file,
-                                'impression_id': impression_data['impression_id'],
-                                'prediction_propose': impression_data['prediction_propose'],
-                                'prediction_compare': impression_data['prediction_compare'],
-                                'show_propose_left': show_propose_left,
-                                'has_error': impression_data['has_error']
-                            })
-                            impressions_for_save.append({
-                                'image_name': impression_data['image_name'],
-                                'account_name': impression_data['account_name'],
-                                'impression_id': impression_data['impression_id'],
-                                'prediction_propose': impression_data['prediction_propose'],
-                                'prediction_compare': impression_data['prediction_compare'],
-                                'has_error': impression_data['has_error']
-                            })
-                            
-                            logger.info(f"Successfully processed {img_file}")
-                        
-                        # 各画像処理の後に待機時間を追加（レート制限回避）
-                        if i < 20:
-                            time.sleep(2)
-                        
-                    except Exception as e:
-                        logger.error(f"Error predicting for {img_file}: {e}", exc_info=True)
-                        impressions_list.append({
-                            'id': f'test{i}',
-                            'filename': img_file,
-                            'impression_id': 'error',
-                            'prediction_propose': 'エラー',
-                            'prediction_compare': 'エラー',
-                            'show_propose_left': True,
-                            'has_error': True
-                        })
-                else:
-                    logger.warning(f"Image not found: {img_path}")
-            send_to_n8n(N8N_WEBHOOK_IMPRESSION, {"data": impressions_for_save})
-            logger.info(f"Total evaluation images prepared: {len(impressions_list)}")
-            
-            if len(impressions_list) == 0:
-                logger.error("No evaluation images could be processed")
-                return render_template('second.html', account_name=account_name, 
-                                     error='評価用画像の処理に失敗しました'), 500
-            
-            # ダミー項目を追加（注意喚起用）
-            dummy_item = {
-                'id': 'test22',
-                'filename': 'virus.png',
-                'impression_id': 'test22',
-                'prediction_propose': 'ここでは１と入力してください。',
-                'prediction_compare': 'ここでは５を入力してください',
-                'show_propose_left': True,
-                'has_error': False,
-                'is_dummy': True
-            }
-            impressions_list.append(dummy_item)
-            
-            # リストをシャッフルしてダミー項目の位置をランダムにする
-            random.shuffle(impressions_list)
-            
-            # メモリ上のキャッシュに保存（session['sid']をキーとする）
-            cache_key = session.get('cache_key')
-            if not cache_key:
-                cache_key = str(uuid.uuid4())
-                session['cache_key'] = cache_key
-            
-            impression_cache[cache_key] = impressions_list
+        cache_key = session.get('cache_key') or str(uuid.uuid4())
+        flight_key = submission_key(account_name, like_criteria, like_features, valid_files)
+        participant_id = session.get('participant_id')
+        
+        # 同じ被験者・同じ画像の送信が待機中・処理中なら、そのジョブを共有する
+        job = dislike_admission.attach(flight_key)
+        if job is None:
+            # 待機中・処理中はアップロード画像を削除対象から外す（save() が使用中登録済み）
+            image_paths = upload_store.save(valid_files)
+            progress_id = uuid.uuid4().hex
             
-            logger.info(f"Stored {len(impressions_list)} impressions in memory cache with key: {cache_key}")
-            logger.info(f"Redirecting to output page...")
+            def compute():
+                set_correlation_id(participant_id)
+                try:
+                    return run_dislike_pipeline(account_name, like_criteria, like_features,
+                                                image_paths, cache_key, progress_id)
+                finally:
+                    upload_store.release(image_paths)
+                    progress_board.publish(progress_id, type='done')
             
-            return redirect(url_for('output'))
+            try:
+                job, shared = dislike_admission.submit(flight_key, compute, {'progress_id': progress_id})
+            except QueueFullError:
+                upload_store.release(image_paths)
+                logger.warning("Admission queue is full, rejecting submission from %s", account_name)
+                return render_template('second.html', account_name=account_name,
+                                     error='現在混み合っています。しばらく待ってから再度お試しください'), 503
+            if shared:
+                upload_store.release(image_paths)
+        else:
+            shared = True
         
-        except Exception as e:
-            logger.error(f"Error processing dislike images: {e}", exc_info=True)
-            return render_template('second.html', account_name=account_name, 
-                                 error=f'エラーが発生しました: {str(e)}'), 500
+        if shared:
+            logger.info("Coalesced duplicate submission for %s", account_name)
+        session['job_id'] = job.id
+        return redirect(url_for('waiting'))
     
     account_name = session.get('account_name')
     if not account_name:
@@ -654,6 +1350,64 @@ def second():
     return render_template('second.html', account_name=account_name)
 
 
+def pipeline_error_message(error):
+    """Return the message shown to the participant for a failed pipeline."""
+    if isinstance(error, PipelineError):
+        return str(error)
+    return f'エラーが発生しました: {str(error)}'
+
+
+def waiting_status(job):
+    """Queue position, wait estimate and latest progress of a job, for the waiting page."""
+    status = dislike_admission.status(job.id)
+    for name in ('start', 'finish'):
+        seconds = status[f'estimated_{name}_seconds']
+        status[f'estimated_{name}_seconds'] = round(seconds)
+        status[f'estimated_{name}_minutes'] = max(1, -(-int(seconds) // 60))
+    status['progress'] = progress_board.latest(job.meta.get('progress_id'))
+    return status
+
+
+@app.route('/waiting')
+def waiting():
+    """
+    Route shown while the participant's pipeline is queued or running.
+    解析の順番待ち・処理中に表示するページ
+    """
+    account_name = session.get('account_name')
+    job = dislike_admission.get(session.get('job_id'))
+    if not account_name:
+        return redirect(url_for('index'))
+    if job is None:
+        session.pop('job_id', None)
+        return redirect(url_for('second'))
+    
+    if job.state == 'done':
+        session['cache_key'] = job.result
+        session.pop('job_id', None)
+        logger.info("Redirecting to output page...")
+        return redirect(url_for('output'))
+    if job.state == 'failed':
+        session.pop('job_id', None)
+        return render_template('second.html', account_name=account_name,
+                               error=pipeline_error_message(job.error)), 500
+    
+    return render_template('waiting.html', status=waiting_status(job),
+                           poll_interval=WAITING_POLL_INTERVAL)
+
+
+@app.route('/waiting/status')
+def waiting_status_api():
+    """Polled by the waiting page; finished jobs are handed back to /waiting."""
+    job = dislike_admission.get(session.get('job_id'))
+    if job is None:
+        return jsonify({'state': 'unknown', 'redirect': url_for('second')}), 404
+    status = waiting_status(job)
+    if job.finished:
+        status['redirect'] = url_for('waiting')
+    return jsonify(status)
+
+
 @app.route('/output', methods=['GET', 'POST'])
 def output():
     """
@@ -664,42 +1418,25 @@ def output():
     cache_key = session.get('cache_key')
     
     # デバッグ用ログ
-    logger.info(f"=== OUTPUT ROUTE ACCESSED ===")
-    logger.info(f"Method: {request.method}")
-    logger.info(f"Account name: {account_name}")
-    logger.info(f"Cache key: {cache_key}")
+    logger.debug("Output route accessed: method=%s account=%s cache_key=%s",
+                 request.method, account_name, cache_key)
     
     if not account_name:
         logger.warning("No account_name in session, redirecting to index")
         return redirect(url_for('index'))
     
+    if session.get('job_id'):
+        return redirect(url_for('waiting'))
+    
     if not cache_key or cache_key not in impression_cache:
         logger.warning("No impression data in cache, redirecting to index")
         return redirect(url_for('index'))
     
-    # メモリキャッシュから印象文データを取得
-    impressions_list = impression_cache[cache_key]
-    
-    # 表示用に展開
-    expanded_images = []
-    for img_data in impressions_list:
-        show_propose_left = img_data['show_propose_left']
-        
-        expanded_images.append({
-            'id': img_data['id'],
-            'filename': img_data['filename'],
-            'impression_id': img_data['impression_id'],
-            'prediction_propose': img_data['prediction_propose'],
-            'prediction_compare': img_data['prediction_compare'],
-            'show_propose_left': show_propose_left,
-            'left_prediction': img_data['prediction_propose'] if show_propose_left else img_data['prediction_compare'],
-            'right_prediction': img_data['prediction_compare'] if show_propose_left else img_data['prediction_propose'],
-            'left_method': 'propose' if show_propose_left else 'compare',
-            'right_method': 'compare' if show_propose_left else 'propose',
-            'is_dummy': img_data.get('is_dummy', False)  # ダミーフラグを追加
-        })
+    # メモリキャッシュから表示用データを取得（second() で一度だけ構築済み）
+    cache_entry = impression_cache[cache_key]
+    expanded_images = cache_entry['images']
     
-    logger.info(f"Loaded {len(expanded_images)} impressions from memory cache")
+    logger.debug("Loaded %d impressions from memory cache", len(expanded_images))
     
     if request.method == 'POST':
         scores_left = {}
@@ -714,24 +1451,24 @@ def output():
             score_right = request.form.get(f'score_right_{img_id}')
             
             if not score_left or not score_right:
-                return render_template('output.html', evaluation_images=expanded_images, 
-                                     error='すべての画像に対して評価を入力してください'), 400
+                return render_output_page(cache_entry, error='すべての画像に対して評価を入力してください'), 400
             try:
                 scores_left[img_id] = int(score_left)
                 scores_right[img_id] = int(score_right)
                 
                 # ダミー画像のチェック（バリデーションフラグのみ更新し、エラーにはしない）
                 if img.get('is_dummy', False):
-                    if scores_left[img_id] != 1:
+                    if scores_left[img_id] != img['expected_score_left']:
                         validation_passed = False
-                        logger.warning(f"Dummy validation failed for {account_name}: Left score = {scores_left[img_id]} (expected 1)")
-                    if scores_right[img_id] != 5:
+                        logger.warning("Dummy validation failed for %s: Left score = %s (expected %s)",
+                                       account_name, scores_left[img_id], img['expected_score_left'])
+                    if scores_right[img_id] != img['expected_score_right']:
                         validation_passed = False
-                        logger.warning(f"Dummy validation failed for {account_name}: Right score = {scores_right[img_id]} (expected 5)")
+                        logger.warning("Dummy validation failed for %s: Right score = %s (expected %s)",
+                                       account_name, scores_right[img_id], img['expected_score_right'])
                     
             except ValueError:
-                return render_template('output.html', evaluation_images=expanded_images, 
-                                     error='無効な評価値です'), 400
+                return render_output_page(cache_entry, error='無効な評価値です'), 400
         
         results = []
         for img in expanded_images:
@@ -766,13 +1503,13 @@ def output():
         # メモリキャッシュをクリア
         if cache_key in impression_cache:
             del impression_cache[cache_key]
-            logger.info(f"Cleared impression cache for key: {cache_key}")
+            logger.info("Cleared impression cache for key: %s", cache_key)
         
         session.clear()
         return redirect(url_for('thanks_page'))
     
-    logger.info(f"Rendering output.html with {len(expanded_images)} images")
-    return render_template('output.html', evaluation_images=expanded_images)
+    logger.debug("Rendering output.html with %d images", len(expanded_images))
+    return render_output_page(cache_entry)
 
 
 @app.route('/thanks-page')
@@ -787,6 +1524,49 @@ def serve_test_image(filename):
     return send_from_directory('test_data', filename)
 
 
+@app.route('/progress/<progress_id>')
+def progress_stream(progress_id):
+    """
+    Server-Sent Events stream of one upload's progress.
+    アップロード処理中のページへ進捗を送る
+    """
+    if not PROGRESS_ID_PATTERN.fullmatch(progress_id):
+        return jsonify({'error': 'invalid progress id'}), 400
+
+    def generate():
+        for event in progress_board.listen(progress_id, PROGRESS_STREAM_TIMEOUT):
+            if event is None:
+                yield ': keepalive\n\n'
+            else:
+                yield f"data: {json.dumps(event)}\n\n"
+
+    return app.response_class(generate(), mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+def warm_up_connections():
+    """Open pooled connections to OpenAI and n8n before traffic arrives."""
+    transport.warm_up(
+        client.base_url if client else None,
+        [N8N_WEBHOOK_LIKE, N8N_WEBHOOK_DISLIKE, N8N_WEBHOOK_IMPRESSION, N8N_WEBHOOK_RESULT],
+        HTTP_WARM_CONNECTIONS
+    )
+
+
+@app.route('/metrics')
+def metrics():
+    """Report runtime statistics of this worker process."""
+    return jsonify({
+        'image_service': image_service.stats(),
+        'evaluation_payloads': evaluation_payloads.stats(),
+        'image_descriptions': image_descriptions.stats(),
+        'dislike_pipeline': dislike_admission.stats(),
+        'uploads': upload_store.stats(),
+        'http': transport.stats(),
+        'models': model_registry.stats()
+    })
+
+
 # ============================================================================
 # Error Handlers
 # ============================================================================
@@ -806,7 +1586,7 @@ def not_found(error):
 @app.errorhandler(500)
 def internal_error(error):
     """Handle 500 error."""
-    logger.error(f"Internal server error: {error}")
+    logger.error("Internal server error: %s", error)
     return render_template('error.html', error='サーバーエラーが発生しました'), 500
 
 
@@ -0,0 +1,314 @@
+"""
+OpenAI Batch API backend for AI Fashion Experiment
+印象予測リクエストを Batch API にまとめて投入し、結果を取り込む
+
+Prediction requests are serialized lazily and streamed into Batch JSONL
+files on disk (chunked by request count and file size), uploaded and
+submitted, polled until they
+finish, and the outputs are converted back into the impression-record
+shape returned by predict_impression(). A JSON state file records every
+submitted batch, so re-running resumes polling instead of resubmitting,
+and a batch's output is ingested only once.
+"""
+
+import os
+import json
+import time
+import uuid
+import logging
+import tempfile
+from datetime import datetime
+
+import app as fashion_app
+from batch_rerun import checkpoint_keys, load_checkpoint, participant_methods, prompt_hashes
+
+logger = logging.getLogger('batch_api')
+
+BATCH_ENDPOINT = '/v1/chat/completions'
+MAX_REQUESTS_PER_BATCH = 50000
+MAX_BYTES_PER_BATCH = 190 * 1024 * 1024  # API の上限 200MB に余裕を持たせる
+TERMINAL_STATUSES = {'completed', 'failed', 'expired', 'cancelled'}
+
+
+def make_custom_id(method, image_id, account_name):
+    """Encode one request's identity; the account name goes last so it may contain ':'."""
+    return f"{method}:{image_id}:{account_name}"
+
+
+def parse_custom_id(custom_id):
+    """Return (method, image_id, account_name) from a custom_id."""
+    method, image_id, account_name = custom_id.split(':', 2)
+    return method, image_id, account_name
+
+
+def build_batch_requests(participants, items, methods=fashion_app.PREDICTION_METHODS,
+                         prompt_templates=None, exclude=()):
+    """
+    Serialize prediction requests as Batch API request lines, one at a time.
+
+    Every line embeds the full image data URL, so lines are generated
+    lazily instead of being collected in memory.
+
+    Args:
+        participants: Records from batch_rerun.load_participants()
+        items: Evaluation manifest items
+        methods: Methods to request
+        prompt_templates: Optional prompt template overrides per method
+        exclude: custom_ids that must not be requested again
+
+    Yields:
+        (custom_id, JSONL line) tuples
+    """
+    exclude = set(exclude)
+    # Batch API は OpenAI 本体のみなので、予測用バックエンドのモデル・形式をそのまま使う
+    backend = fashion_app.model_registry.backend_for('prediction')
+    image_parts = {}
+    for participant in participants:
+        prompts = fashion_app.build_prediction_prompts(
+            participant.get('like_criteria'), participant.get('dislike_criteria'),
+            participant.get('like_features'), participant.get('dislike_features'),
+            prompt_templates
+        )
+        for item in items:
+            for method in participant_methods(participant, methods):
+                custom_id = make_custom_id(method, item['id'], participant['account_name'])
+                if custom_id in exclude:
+                    continue
+                if item['id'] not in image_parts:
+                    # 評価用画像は参加者間で共通なので一度だけエンコードする
+                    image_path = os.path.join(fashion_app.TEST_DATA_DIR, item['filename'])
+                    data_url = fashion_app.evaluation_payloads.get(image_path, fashion_app.encode_image_to_data_url)
+                    image_parts[item['id']] = data_url and fashion_app.build_prediction_image_parts(data_url)
+                if not image_parts[item['id']]:
+                    continue
+                body = backend.request_body(prompts[method], image_parts[item['id']],
+                                            fashion_app.PREDICTION_MAX_TOKENS)
+                line = json.dumps({'custom_id': custom_id, 'method': 'POST',
+                                   'url': BATCH_ENDPOINT, 'body': body}, ensure_ascii=False)
+                yield custom_id, line
+
+
+def _pair_groups(lines):
+    """Group consecutive lines of the same participant/image pair."""
+    pair, group = None, []
+    for custom_id, line in lines:
+        line_pair = custom_id.split(':', 1)[-1]
+        if group and line_pair != pair:
+            yield group
+            group = []
+        pair = line_pair
+        group.append((custom_id, line))
+    if group:
+        yield group
+
+
+def write_chunks(lines, directory, max_requests=MAX_REQUESTS_PER_BATCH, max_bytes=MAX_BYTES_PER_BATCH):
+    """
+    Stream request lines into JSONL files within the per-batch count and size limits.
+
+    Requests for the same participant/image pair (consecutive lines) stay in
+    one chunk, so each pair's methods are ingested together. Only one pair's
+    lines are held in memory at a time.
+
+    Args:
+        lines: (custom_id, line) tuples, e.g. from build_batch_requests()
+        directory: Directory the chunk files are written to
+
+    Yields:
+        (path, custom_ids) of each finished chunk file
+    """
+    out, path, custom_ids, current_bytes = None, None, [], 0
+    try:
+        for group in _pair_groups(lines):
+            data = ''.join(line + '\n' for _, line in group).encode('utf-8')
+            if out and (len(custom_ids) + len(group) > max_requests or current_bytes + len(data) > max_bytes):
+                out.close()
+                yield path, custom_ids
+                out = None
+            if out is None:
+                out = tempfile.NamedTemporaryFile('wb', suffix='.jsonl', prefix='predictions-',
+                                                  dir=directory, delete=False)
+                path, custom_ids, current_bytes = out.name, [], 0
+            out.write(data)
+            custom_ids.extend(custom_id for custom_id, _ in group)
+            current_bytes += len(data)
+        if out:
+            out.close()
+            yield path, custom_ids
+            out = None
+    finally:
+        if out:
+            out.close()
+
+
+def load_state(state_path):
+    """Load the submitted-batch state file."""
+    if not os.path.exists(state_path):
+        return {'batches': {}}
+    with open(state_path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_state(state_path, state):
+    """Write the state file atomically."""
+    tmp_path = state_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, state_path)
+
+
+def submit_chunk(client, path, request_count, metadata=None):
+    """Upload one chunk file as a batch input file and create the batch."""
+    with open(path, 'rb') as f:
+        input_file = client.files.create(file=f, purpose='batch')
+    batch = client.batches.create(
+        input_file_id=input_file.id,
+        endpoint=BATCH_ENDPOINT,
+        completion_window='24h',
+        metadata=metadata or {},
+    )
+    logger.info("Submitted batch %s with %d requests (%d bytes)", batch.id, request_count, os.path.getsize(path))
+    return batch
+
+
+def _read_jsonl(client, file_id):
+    if not file_id:
+        return []
+    text = client.files.content(file_id).text
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def ingest_batch(client, batch_id, batch_state, done=()):
+    """
+    Convert one completed batch's output into impression records.
+
+    impression_id is derived from the batch and request identity, so
+    ingesting the same batch twice yields identical records.
+
+    Args:
+        done: Checkpoint keys (see batch_rerun.checkpoint_keys) that already have a result
+
+    Returns:
+        List of impression records
+    """
+    batch = client.batches.retrieve(batch_id)
+    outputs = {}
+    for entry in _read_jsonl(client, batch.output_file_id) + _read_jsonl(client, batch.error_file_id):
+        response = entry.get('response') or {}
+        if response.get('status_code') == 200:
+            outputs[entry['custom_id']] = (response['body']['choices'][0]['message']['content'], False)
+        else:
+            outputs[entry['custom_id']] = ('エラー', True)
+
+    pairs = {}
+    for custom_id in batch_state['custom_ids']:
+        method, image_id, account_name = parse_custom_id(custom_id)
+        pairs.setdefault((account_name, image_id), []).append((method, custom_id))
+
+    filenames = {item['id']: item['filename'] for item in fashion_app.get_evaluation_set()['items']}
+    hashes = batch_state.get('prompt_hashes', {})
+    records = []
+    for (account_name, image_id), requested in sorted(pairs.items()):
+        if all((account_name, image_id, method, hashes.get(method)) in done for method, _ in requested):
+            continue
+        predictions = {method: None for method in fashion_app.PREDICTION_METHODS}
+        has_error = False
+        for method, custom_id in requested:
+            prediction, error = outputs.get(custom_id, ('エラー', True))
+            predictions[method] = prediction
+            has_error = has_error or error
+        records.append({
+            'impression_id': str(uuid.uuid5(uuid.NAMESPACE_URL, f"{batch_id}/{account_name}/{image_id}")),
+            'image_name': filenames.get(image_id, image_id),
+            'account_name': account_name,
+            'prediction_propose': predictions['propose'],
+            'prediction_compare': predictions['compare'],
+            'timestamp': datetime.now().isoformat(),
+            'has_error': has_error,
+            'image_id': image_id,
+            'methods': [method for method, _ in requested],
+            'prompt_hashes': {method: hashes.get(method) for method, _ in requested},
+            'batch_id': batch_id,
+        })
+    return records
+
+
+def run_batch_api(client, participants, items, output_path, state_path,
+                  methods=fashion_app.PREDICTION_METHODS, prompt_templates=None,
+                  poll_interval=60, max_requests=MAX_REQUESTS_PER_BATCH, max_bytes=MAX_BYTES_PER_BATCH,
+                  wait=True):
+    """
+    Submit, poll and ingest Batch API prediction runs.
+
+    Requests already in output_path with the same prompt template, or
+    requested with the same template by a batch that is still running or
+    not yet ingested, are not submitted again. Requests from failed,
+    expired or cancelled batches, and pairs whose ingested result had an
+    error, are.
+
+    Returns:
+        Summary dictionary with submission and ingestion counts
+    """
+    state = load_state(state_path)
+    done = load_checkpoint(output_path)
+    hashes = prompt_hashes(methods, prompt_templates)
+
+    pending_ids = set()
+    for batch_state in state['batches'].values():
+        # 実行中、または完了後まだ取り込んでいないバッチの分は、同じプロンプトなら再投入しない
+        if batch_state['status'] not in TERMINAL_STATUSES or (
+                batch_state['status'] == 'completed' and not batch_state['ingested']):
+            batch_hashes = batch_state.get('prompt_hashes', {})
+            for custom_id in batch_state['custom_ids']:
+                method = parse_custom_id(custom_id)[0]
+                if batch_hashes.get(method) == hashes.get(method):
+                    pending_ids.add(custom_id)
+    exclude = pending_ids | {
+        make_custom_id(method, image_id, account_name)
+        for account_name, image_id, method, prompt_hash in done if hashes.get(method) == prompt_hash
+    }
+
+    lines = build_batch_requests(participants, items, methods, prompt_templates, exclude)
+    submitted = 0
+    with tempfile.TemporaryDirectory(prefix='batch_api_') as chunk_dir:
+        for path, custom_ids in write_chunks(lines, chunk_dir, max_requests, max_bytes):
+            batch = submit_chunk(client, path, len(custom_ids))
+            os.remove(path)
+            state['batches'][batch.id] = {
+                'status': batch.status,
+                'custom_ids': custom_ids,
+                'prompt_hashes': hashes,
+                'ingested': False,
+                'submitted_at': datetime.now().isoformat(),
+            }
+            save_state(state_path, state)
+            submitted += len(custom_ids)
+
+    ingested = 0
+    while True:
+        waiting = False
+        for batch_id, batch_state in state['batches'].items():
+            if batch_state['status'] not in TERMINAL_STATUSES:
+                batch_state['status'] = client.batches.retrieve(batch_id).status
+                save_state(state_path, state)
+            if batch_state['status'] not in TERMINAL_STATUSES:
+                waiting = True
+                continue
+            if batch_state['status'] == 'completed' and not batch_state['ingested']:
+                records = ingest_batch(client, batch_id, batch_state, done)
+                with open(output_path, 'a', encoding='utf-8') as out:
+                    for record in records:
+                        out.write(json.dumps(record, ensure_ascii=False) + '\n')
+                for record in records:
+                    done.update(checkpoint_keys(record))
+                batch_state['ingested'] = True
+                save_state(state_path, state)
+                ingested += len(records)
+        if not waiting or not wait:
+            break
+        time.sleep(poll_interval)
+
+    statuses = {}
+    for batch_state in state['batches'].values():
+        statuses[batch_state['status']] = statuses.get(batch_state['status'], 0) + 1
+    return {'submitted_requests': submitted, 'ingested_records': ingested, 'batches': statuses}
@@ -0,0 +1,323 @@
+"""
+Offline batch re-run for AI Fashion Experiment
+過去の参加者の判断基準・特徴から、評価用画像すべての印象文を再生成する
+
+Participant records are read from a capture in the memo.json format (n8n
+webhook bodies grouped by page) or from a JSONL file with one participant
+per line. Results are appended to a JSONL file, which doubles as the
+checkpoint. Each record lists its methods and a hash of the prompt
+template each method ran with, so re-running skips only the
+participant/image/method combinations that already have an error-free
+result for the same template. Adding a method or revising a prompt runs
+just the affected predictions.
+
+With --backend batch the requests go through the OpenAI Batch API
+instead (see batch_api.py); re-run the same command to keep polling.
+
+--rpm limits the first attempt of each prediction call. Retries after a
+rate-limit error and hedged attempts (see model_backends.py) are not
+charged to it; set HEDGE_MAX_EXTRA_RATIO=0 for a strict limit.
+
+Usage:
+    python batch_rerun.py memo.json -o rerun.jsonl --workers 8 --rpm 300
+    python batch_rerun.py participants.jsonl -o rerun.jsonl --propose-prompt revised.txt
+    python batch_rerun.py memo.json -o rerun.jsonl --backend batch --state rerun.state.json
+"""
+
+import os
+import sys
+import json
+import hashlib
+import time
+import argparse
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+import app as fashion_app
+
+logger = logging.getLogger('batch_rerun')
+
+PARTICIPANT_FIELDS = ('like_criteria', 'like_features', 'dislike_criteria', 'dislike_features')
+
+
+class RateLimiter:
+    """
+    Thread-safe token bucket shared by every worker thread.
+
+    Args:
+        rate_per_minute: Sustained number of tokens per minute
+        burst: Maximum tokens that can accumulate (defaults to one second's worth)
+    """
+
+    def __init__(self, rate_per_minute, burst=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = burst or max(1.0, self.rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """
+        Block until the given number of tokens has been taken.
+
+        Tokens are taken one at a time, so a request larger than the bucket
+        is still charged in full.
+        """
+        for _ in range(tokens):
+            self._acquire_one()
+
+    def _acquire_one(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def load_participants(path):
+    """
+    Load participant criteria/features records.
+
+    Accepts either the memo.json capture format ({page: [{"body": {...}}]})
+    or JSONL with one flat record per line. Records are merged per
+    account_name in timestamp order, so the latest value of each field wins.
+
+    Returns:
+        List of participant dictionaries sorted by account_name
+    """
+    with open(path, encoding='utf-8') as f:
+        if path.endswith('.jsonl'):
+            records = [json.loads(line) for line in f if line.strip()]
+        else:
+            capture = json.load(f)
+            records = [entry.get('body', entry)
+                       for entries in capture.values() for entry in entries]
+
+    participants = {}
+    for record in sorted(records, key=lambda r: r.get('timestamp', '')):
+        account_name = record.get('account_name')
+        if not account_name:
+            continue
+        participant = participants.setdefault(account_name, {'account_name': account_name})
+        for field in PARTICIPANT_FIELDS:
+            if record.get(field):
+                participant[field] = record[field]
+
+    return [participants[name] for name in sorted(participants)]
+
+
+def prompt_hashes(methods, prompt_templates=None):
+    """Return method -> short hash of the prompt template the method runs with."""
+    templates = fashion_app.prediction_prompt_templates(prompt_templates)
+    return {method: hashlib.sha256(templates[method].encode('utf-8')).hexdigest()[:12]
+            for method in methods}
+
+
+def checkpoint_keys(record):
+    """Return the (account_name, image_id, method, prompt_hash) keys an error-free record completes."""
+    hashes = record.get('prompt_hashes')
+    if record.get('has_error') or not hashes:
+        return set()
+    return {(record['account_name'], record['image_id'], method, hashes.get(method))
+            for method in record.get('methods', ())}
+
+
+def load_checkpoint(output_path):
+    """
+    Return the (account_name, image_id, method, prompt_hash) keys already completed.
+
+    Records written before prompt hashes were recorded complete nothing,
+    since the prompt they ran with is unknown.
+    """
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    legacy = 0
+    with open(output_path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # 中断時に書きかけだった行
+            if not record.get('has_error') and not record.get('prompt_hashes'):
+                legacy += 1
+            done.update(checkpoint_keys(record))
+    if legacy:
+        logger.warning("%d records in %s have no prompt hashes and will be run again", legacy, output_path)
+    return done
+
+
+def participant_methods(participant, methods):
+    """Drop methods whose inputs the participant record does not have."""
+    required = {
+        'propose': ('like_criteria', 'dislike_criteria'),
+        'compare': ('like_features', 'dislike_features'),
+    }
+    return tuple(method for method in methods
+                 if all(participant.get(field) for field in required[method]))
+
+
+def run_batch(participants, items, output_path, workers=4, rate_per_minute=300,
+              methods=fashion_app.PREDICTION_METHODS, prompt_templates=None):
+    """
+    Predict impressions for every participant x evaluation item pair.
+
+    Args:
+        participants: Records from load_participants()
+        items: Evaluation manifest items
+        output_path: JSONL file to append results to (also the checkpoint)
+        workers: Number of concurrent prediction threads
+        rate_per_minute: Global limit on OpenAI calls per minute
+        methods: Methods to run
+        prompt_templates: Optional prompt template overrides per method
+
+    Returns:
+        Summary dictionary with counts and predictions per minute
+    """
+    done = load_checkpoint(output_path)
+    hashes = prompt_hashes(methods, prompt_templates)
+    tasks = []
+    skipped = 0
+    for participant in participants:
+        participant_run = participant_methods(participant, methods)
+        if not participant_run:
+            logger.warning("Skipping %s: no criteria or features for %s",
+                           participant['account_name'], ', '.join(methods))
+            continue
+        for item in items:
+            # 同じプロンプトで完了済みの手法は除き、残りの手法だけを実行する
+            pending = tuple(method for method in participant_run
+                            if (participant['account_name'], item['id'], method, hashes[method]) not in done)
+            if pending:
+                tasks.append((participant, pending, item))
+            else:
+                skipped += 1
+
+    limiter = RateLimiter(rate_per_minute)
+
+    def predict(participant, participant_run, item):
+        # 1回の予測で手法ごとに1回ずつ API を呼ぶ
+        limiter.acquire(len(participant_run))
+        impression = fashion_app.predict_impression(
+            participant['account_name'],
+            participant.get('like_criteria'), participant.get('dislike_criteria'),
+            participant.get('like_features'), participant.get('dislike_features'),
+            os.path.join(fashion_app.TEST_DATA_DIR, item['filename']),
+            methods=participant_run, prompt_templates=prompt_templates, method_interval=0
+        )
+        if impression is None:
+            impression = {'image_name': item['filename'], 'account_name': participant['account_name'],
+                          'impression_id': None, 'prediction_propose': None, 'prediction_compare': None,
+                          'timestamp': datetime.now().isoformat(), 'has_error': True}
+        impression['image_id'] = item['id']
+        impression['methods'] = list(participant_run)
+        impression['prompt_hashes'] = {method: hashes[method] for method in participant_run}
+        return impression
+
+    logger.info("Running %d predictions (%d already done) with %d workers at %d calls/min",
+                len(tasks), skipped, workers, rate_per_minute)
+
+    completed = errors = 0
+    started = time.monotonic()
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        with open(output_path, 'a', encoding='utf-8') as out:
+            futures = [executor.submit(predict, *task) for task in tasks]
+            for future in as_completed(futures):
+                try:
+                    record = future.result()
+                except Exception as e:
+                    logger.error("Prediction failed: %s", e)
+                    errors += 1
+                    continue
+                out.write(json.dumps(record, ensure_ascii=False) + '\n')
+                out.flush()
+                completed += 1
+                errors += bool(record['has_error'])
+                if completed % 20 == 0:
+                    elapsed = time.monotonic() - started
+                    logger.info("%d/%d done, %.1f predictions/min", completed, len(tasks),
+                                completed * 60 / elapsed)
+    except KeyboardInterrupt:
+        logger.warning("Interrupted; completed results are saved, re-run to resume")
+        executor.shutdown(wait=True, cancel_futures=True)
+        raise
+    executor.shutdown(wait=True)
+
+    elapsed = time.monotonic() - started
+    return {
+        'completed': completed,
+        'skipped': skipped,
+        'errors': errors,
+        'elapsed_seconds': round(elapsed, 1),
+        'predictions_per_minute': round(completed * 60 / elapsed, 1) if elapsed else 0.0,
+    }
+
+
+def _read_template(path):
+    if not path:
+        return None
+    with open(path, encoding='utf-8') as f:
+        return f.read()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Re-generate impressions for archived participants.')
+    parser.add_argument('participants', help='memo.json-format capture or participants JSONL')
+    parser.add_argument('-o', '--output', required=True, help='JSONL file for results (resumed if it exists)')
+    parser.add_argument('--workers', type=int, default=4, help='concurrent prediction threads')
+    parser.add_argument('--rpm', type=int, default=300, help='global OpenAI calls per minute (retries and hedges not included)')
+    parser.add_argument('--methods', default='propose,compare', help='comma-separated methods to run')
+    parser.add_argument('--propose-prompt', help='file with a revised propose prompt template')
+    parser.add_argument('--compare-prompt', help='file with a revised compare prompt template')
+    parser.add_argument('--backend', choices=('sync', 'batch'), default='sync',
+                        help='sync: rate-limited chat calls, batch: OpenAI Batch API')
+    parser.add_argument('--state', help='batch backend state file (default: <output>.state.json)')
+    parser.add_argument('--poll-interval', type=int, default=60, help='batch status polling interval (seconds)')
+    parser.add_argument('--no-wait', action='store_true', help='submit/ingest once without waiting for batches')
+    args = parser.parse_args(argv)
+
+    if fashion_app.client is None:
+        parser.error('OPENAI_API_KEY is not set')
+
+    methods = tuple(method.strip() for method in args.methods.split(',') if method.strip())
+    unknown = set(methods) - set(fashion_app.PREDICTION_METHODS)
+    if unknown:
+        parser.error(f"unknown methods: {', '.join(sorted(unknown))}")
+    # Batch API のリクエストは常に画像を送るため、テキストのみの設定と混ぜない
+    text_only = set(methods) & set(fashion_app.TEXT_ONLY_METHODS)
+    if args.backend == 'batch' and text_only:
+        parser.error(f"--backend batch always sends images, but TEXT_ONLY_METHODS includes "
+                     f"{', '.join(sorted(text_only))}; unset it or use --backend sync")
+
+    prompt_templates = {}
+    if args.propose_prompt:
+        prompt_templates['propose'] = _read_template(args.propose_prompt)
+    if args.compare_prompt:
+        prompt_templates['compare'] = _read_template(args.compare_prompt)
+
+    participants = load_participants(args.participants)
+    items = fashion_app.get_evaluation_set()['items']
+    if args.backend == 'batch':
+        from batch_api import run_batch_api
+        summary = run_batch_api(fashion_app.client, participants, items, args.output,
+                                args.state or args.output + '.state.json', methods, prompt_templates,
+                                poll_interval=args.poll_interval, wait=not args.no_wait)
+        print(json.dumps(summary, ensure_ascii=False))
+        return 0
+
+    summary = run_batch(participants, items, args.output, args.workers, args.rpm,
+                        methods, prompt_templates)
+    print(json.dumps(summary, ensure_ascii=False))
+    return 0 if summary['errors'] == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,247 @@
+"""
+Vision vs. text-only comparison for AI Fashion Experiment
+画像を送る通常の予測と、事前生成した説明文を送るテキストのみの予測を比較する
+
+For every participant x evaluation image x method, the same prompt is sent
+once with the image and once with the image's stored description (see
+`flask --app app build-descriptions`). Each pair of calls is written to a
+JSONL file with latency, token usage and both outputs, and a summary per
+method reports latency percentiles, cost and how closely the text-only
+outputs agree with the vision outputs. Because predictions vary between
+runs even on one path, --baseline adds a second vision call whose
+agreement with the first shows the noise floor.
+
+Usage:
+    python compare_text_path.py memo.json -o comparison.jsonl --limit 5
+    python compare_text_path.py participants.jsonl -o comparison.jsonl --methods compare --baseline
+"""
+
+import os
+import sys
+import json
+import time
+import difflib
+import argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import app as fashion_app
+from batch_rerun import RateLimiter, load_participants, participant_methods
+from model_backends import percentile
+
+logger = logging.getLogger('compare_text_path')
+
+# gpt-4o-mini の料金（USD / 100万トークン）。画像のトークンは prompt_tokens に含まれる
+DEFAULT_INPUT_PRICE = 0.15
+DEFAULT_OUTPUT_PRICE = 0.60
+
+
+def similarity(a, b):
+    """Character-level similarity of two outputs (0.0 - 1.0)."""
+    if a is None or b is None:
+        return None
+    return difflib.SequenceMatcher(None, a, b).ratio()
+
+
+def timed_completion(prompt, content_parts, **kwargs):
+    """
+    Send one prediction call (without hedging) and measure it.
+
+    Returns:
+        Dictionary with output, latency_seconds, prompt_tokens,
+        completion_tokens and error
+    """
+    started = time.perf_counter()
+    try:
+        response = fashion_app.model_registry.complete(
+            'prediction', prompt, content_parts,
+            max_tokens=fashion_app.PREDICTION_MAX_TOKENS,
+            timeout=fashion_app.transport.timeout(read=fashion_app.PREDICTION_READ_TIMEOUT),
+            **kwargs
+        )
+    except Exception as e:
+        return {'output': None, 'latency_seconds': time.perf_counter() - started,
+                'prompt_tokens': 0, 'completion_tokens': 0, 'error': str(e)}
+    usage = getattr(response, 'usage', None)
+    return {
+        'output': response.choices[0].message.content,
+        'latency_seconds': time.perf_counter() - started,
+        'prompt_tokens': getattr(usage, 'prompt_tokens', 0) or 0,
+        'completion_tokens': getattr(usage, 'completion_tokens', 0) or 0,
+        'error': None,
+    }
+
+
+def compare_pair(prompt, image_path, baseline=False, **kwargs):
+    """
+    Run one prompt on the vision path and on the text-only path.
+
+    Returns:
+        Row dictionary, or None when the image has no current description
+    """
+    description = fashion_app.image_descriptions.get(image_path)
+    if not description:
+        return None
+    data_url = fashion_app.evaluation_payloads.get(image_path, fashion_app.encode_image_to_data_url)
+    if not data_url:
+        return None
+
+    image_parts = fashion_app.build_prediction_image_parts(data_url)
+    row = {
+        'vision': timed_completion(prompt, image_parts, **kwargs),
+        'text': timed_completion(prompt, fashion_app.build_prediction_description_parts(description), **kwargs),
+    }
+    row['agreement'] = similarity(row['vision']['output'], row['text']['output'])
+    if baseline:
+        row['vision_repeat'] = timed_completion(prompt, image_parts, **kwargs)
+        row['baseline_agreement'] = similarity(row['vision']['output'], row['vision_repeat']['output'])
+    return row
+
+
+def _mean(values):
+    values = [value for value in values if value is not None]
+    return sum(values) / len(values) if values else None
+
+
+def summarize(rows, input_price=DEFAULT_INPUT_PRICE, output_price=DEFAULT_OUTPUT_PRICE):
+    """
+    Aggregate comparison rows per method.
+
+    Returns:
+        Dictionary of method -> {'vision': {...}, 'text': {...}, agreement figures}
+    """
+    summary = {}
+    for method in sorted({row['method'] for row in rows}):
+        method_rows = [row for row in rows if row['method'] == method]
+        entry = {'pairs': len(method_rows)}
+        for path in ('vision', 'text'):
+            calls = [row[path] for row in method_rows]
+            ok = [call for call in calls if call['error'] is None]
+            latencies = [call['latency_seconds'] for call in ok]
+            prompt_tokens = sum(call['prompt_tokens'] for call in calls)
+            completion_tokens = sum(call['completion_tokens'] for call in calls)
+            cost = (prompt_tokens * input_price + completion_tokens * output_price) / 1_000_000
+            entry[path] = {
+                'calls': len(calls),
+                'errors': len(calls) - len(ok),
+                'latency_p50': percentile(latencies, 50),
+                'latency_p95': percentile(latencies, 95),
+                'latency_mean': _mean(latencies),
+                'prompt_tokens_mean': prompt_tokens / len(calls) if calls else 0,
+                'completion_tokens_mean': completion_tokens / len(calls) if calls else 0,
+                'cost_usd': cost,
+                'cost_per_call_usd': cost / len(calls) if calls else 0,
+            }
+
+        vision, text = entry['vision'], entry['text']
+        if vision['latency_p50'] and text['latency_p50']:
+            entry['latency_p50_ratio'] = text['latency_p50'] / vision['latency_p50']
+        if vision['cost_usd']:
+            entry['cost_ratio'] = text['cost_usd'] / vision['cost_usd']
+        entry['agreement_mean'] = _mean([row['agreement'] for row in method_rows])
+        entry['exact_match_rate'] = _mean([
+            float(row['vision']['output'] == row['text']['output'])
+            for row in method_rows if row['vision']['output'] is not None and row['text']['output'] is not None
+        ])
+        if any('baseline_agreement' in row for row in method_rows):
+            entry['baseline_agreement_mean'] = _mean([row.get('baseline_agreement') for row in method_rows])
+        summary[method] = entry
+    return summary
+
+
+def run_comparison(participants, items, output_path, methods=fashion_app.PREDICTION_METHODS,
+                   workers=4, rate_per_minute=300, baseline=False, limit=0, **kwargs):
+    """
+    Compare the vision and text-only paths for participant x item x method.
+
+    Args:
+        participants: Records from batch_rerun.load_participants()
+        items: Evaluation manifest items
+        output_path: JSONL file the rows are written to (overwritten)
+        methods: Methods to compare
+        workers: Number of concurrent comparison threads
+        rate_per_minute: Global limit on OpenAI calls per minute
+        baseline: Also repeat the vision call to measure run-to-run agreement
+        limit: Compare at most this many participants (0 = all)
+        **kwargs: Passed to chat.completions.create (e.g. temperature)
+
+    Returns:
+        Tuple of (rows, images skipped for lack of a description)
+    """
+    if limit:
+        participants = participants[:limit]
+    tasks = []
+    for participant in participants:
+        prompts = fashion_app.build_prediction_prompts(
+            participant.get('like_criteria'), participant.get('dislike_criteria'),
+            participant.get('like_features'), participant.get('dislike_features')
+        )
+        for item in items:
+            for method in participant_methods(participant, methods):
+                tasks.append((participant['account_name'], item, method, prompts[method]))
+
+    limiter = RateLimiter(rate_per_minute)
+    calls_per_task = 3 if baseline else 2
+
+    def compare(account_name, item, method, prompt):
+        image_path = os.path.join(fashion_app.TEST_DATA_DIR, item['filename'])
+        # 説明文のない画像は呼び出しを行わないので、レート制限の枠を消費しない
+        if not fashion_app.image_descriptions.get(image_path):
+            return item['filename'], None
+        limiter.acquire(calls_per_task)
+        row = compare_pair(prompt, image_path, baseline, **kwargs)
+        if row is not None:
+            row.update({'account_name': account_name, 'image_id': item['id'], 'method': method})
+        return item['filename'], row
+
+    logger.info("Comparing %d predictions on both paths with %d workers", len(tasks), workers)
+    rows = []
+    missing = set()
+    with ThreadPoolExecutor(max_workers=workers) as executor, \
+            open(output_path, 'w', encoding='utf-8') as out:
+        for filename, row in executor.map(lambda task: compare(*task), tasks):
+            if row is None:
+                missing.add(filename)
+                continue
+            out.write(json.dumps(row, ensure_ascii=False) + '\n')
+            rows.append(row)
+    if missing:
+        logger.warning("No current description for %s; run `flask --app app build-descriptions`",
+                       ', '.join(sorted(missing)))
+    return rows, sorted(missing)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare vision and text-only impression predictions.')
+    parser.add_argument('participants', help='memo.json-format capture or participants JSONL')
+    parser.add_argument('-o', '--output', required=True, help='JSONL file for per-call rows')
+    parser.add_argument('--methods', default='propose,compare', help='comma-separated methods to compare')
+    parser.add_argument('--limit', type=int, default=0, help='compare at most this many participants')
+    parser.add_argument('--workers', type=int, default=4, help='concurrent comparison threads')
+    parser.add_argument('--rpm', type=int, default=300, help='global OpenAI calls per minute')
+    parser.add_argument('--baseline', action='store_true', help='repeat the vision call to measure its own agreement')
+    parser.add_argument('--temperature', type=float, help='sampling temperature for every call')
+    parser.add_argument('--input-price', type=float, default=DEFAULT_INPUT_PRICE, help='USD per 1M prompt tokens')
+    parser.add_argument('--output-price', type=float, default=DEFAULT_OUTPUT_PRICE, help='USD per 1M completion tokens')
+    args = parser.parse_args(argv)
+
+    if fashion_app.client is None:
+        parser.error('OPENAI_API_KEY is not set')
+
+    methods = tuple(method.strip() for method in args.methods.split(',') if method.strip())
+    unknown = set(methods) - set(fashion_app.PREDICTION_METHODS)
+    if unknown:
+        parser.error(f"unknown methods: {', '.join(sorted(unknown))}")
+
+    kwargs = {} if args.temperature is None else {'temperature': args.temperature}
+    participants = load_participants(args.participants)
+    items = fashion_app.get_evaluation_set()['items']
+    rows, missing = run_comparison(participants, items, args.output, methods, args.workers, args.rpm,
+                                   args.baseline, args.limit, **kwargs)
+    summary = summarize(rows, args.input_price, args.output_price)
+    print(json.dumps({'methods': summary, 'missing_descriptions': missing}, ensure_ascii=False, indent=2))
+    return 0 if rows else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
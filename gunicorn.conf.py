@@ -0,0 +1,19 @@
+"""
+Gunicorn configuration for AI Fashion Experiment
+Gunicorn はカレントディレクトリの gunicorn.conf.py を自動で読み込む
+"""
+
+import os
+import threading
+
+# 進捗表示（Server-Sent Events）を処理中のアップロードと並行して返すためスレッドワーカーを使う
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', '10'))
+
+
+def post_worker_init(worker):
+    """Start the image pool and warm up HTTP connections once the worker has loaded the app."""
+    import app as fashion_app
+    threading.Thread(target=fashion_app.warm_up_connections, name='http-warm-up', daemon=True).start()
+    # 最初の参加者のリクエストでプロセスの起動・Pillow の読み込みを待たせないよう、受付開始前に起動する
+    fashion_app.image_service.start()
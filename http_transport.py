@@ -0,0 +1,183 @@
+"""
+Shared HTTP transport for AI Fashion Experiment
+OpenAI と n8n への通信で共有するコネクションプール
+
+One httpx client (used by the OpenAI SDK) and one requests session (used
+for n8n webhooks) per worker process, both with explicit pool sizes,
+keep-alive and connect/read timeouts. Request and new-connection counts
+are tracked so connection reuse and pool utilization can be monitored.
+"""
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from openai import OpenAI
+
+logger = logging.getLogger(__name__)
+
+
+class _CountingTransport(httpx.HTTPTransport):
+    """httpx transport that reports requests, in-flight calls and new connections."""
+
+    def __init__(self, owner, **kwargs):
+        super().__init__(**kwargs)
+        self._owner = owner
+
+    def handle_request(self, request):
+        request.extensions['trace'] = self._owner._trace
+        self._owner._enter()
+        try:
+            return super().handle_request(request)
+        finally:
+            self._owner._exit()
+
+
+class HttpTransport:
+    """
+    Connection pools shared by the OpenAI client and the n8n webhooks.
+
+    Args:
+        pool_size: Maximum connections per pool (match the worker's thread count)
+        connect_timeout: Seconds to wait for a TCP/TLS connection
+        read_timeout: Default seconds to wait for a response
+        keepalive_expiry: Seconds an idle connection is kept open
+    """
+
+    def __init__(self, pool_size=10, connect_timeout=5.0, read_timeout=120.0, keepalive_expiry=60.0):
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._lock = threading.Lock()
+        self._stats = {
+            'openai_requests': 0,
+            'openai_connections': 0,
+            'openai_in_flight': 0,
+            'openai_in_flight_peak': 0,
+        }
+
+        self.http_client = httpx.Client(
+            transport=_CountingTransport(
+                self,
+                limits=httpx.Limits(
+                    max_connections=pool_size,
+                    max_keepalive_connections=pool_size,
+                    keepalive_expiry=keepalive_expiry,
+                ),
+            ),
+            timeout=self.timeout(),
+        )
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, pool_block=False)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def timeout(self, read=None, connect=None):
+        """Return an httpx.Timeout, defaulting to the transport's values."""
+        return httpx.Timeout(read or self.read_timeout, connect=connect or self.connect_timeout)
+
+    def openai_client(self, api_key, max_retries=2, base_url=None):
+        """Create an OpenAI client that sends through the shared httpx pool."""
+        return OpenAI(api_key=api_key, base_url=base_url, http_client=self.http_client, max_retries=max_retries)
+
+    def post_json(self, url, data, read_timeout=None):
+        """POST JSON through the shared requests session."""
+        return self.session.post(url, json=data,
+                                 timeout=(self.connect_timeout, read_timeout or self.read_timeout))
+
+    def warm_up(self, openai_base_url=None, webhook_urls=(), connections=2):
+        """
+        Open keep-alive connections ahead of the first real request.
+        ワーカー起動時に接続（TCP/TLS ハンドシェイク）を済ませておく
+
+        Sends concurrent HEAD requests so that `connections` sockets per host
+        end up idle in the pool. Failures are logged and ignored.
+        """
+        targets = []
+        if openai_base_url:
+            targets.extend([('openai', str(openai_base_url))] * connections)
+        hosts = {}
+        for url in webhook_urls:
+            if url:
+                hosts.setdefault(urlsplit(url).netloc, url)
+        for url in hosts.values():
+            targets.extend([('n8n', url)] * connections)
+        if not targets:
+            return 0
+
+        def head(target):
+            kind, url = target
+            try:
+                if kind == 'openai':
+                    self.http_client.head(url, timeout=self.timeout(read=self.connect_timeout))
+                else:
+                    self.session.head(url, timeout=(self.connect_timeout, self.connect_timeout))
+                return True
+            except Exception as e:
+                logger.warning("Connection warm-up to %s failed: %s", urlsplit(url).netloc, e)
+                return False
+
+        with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+            warmed = sum(executor.map(head, targets))
+        logger.info("Warmed %d/%d HTTP connections", warmed, len(targets))
+        return warmed
+
+    def stats(self):
+        """
+        Return request, new-connection and pool-utilization counts.
+
+        OpenAI calls are in flight until their response headers arrive.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+
+        requests_count = connections = 0
+        for pool in self._urllib3_pools():
+            requests_count += pool.num_requests
+            connections += pool.num_connections
+        stats['n8n_requests'] = requests_count
+        stats['n8n_connections'] = connections
+
+        for prefix in ('openai', 'n8n'):
+            total = stats[f'{prefix}_requests']
+            new = stats[f'{prefix}_connections']
+            stats[f'{prefix}_reuse_ratio'] = (total - new) / total if total else 0.0
+        stats['openai_pool_utilization'] = stats['openai_in_flight'] / self.pool_size
+        stats['pool_size'] = self.pool_size
+        return stats
+
+    def close(self):
+        """Close every pooled connection."""
+        self.http_client.close()
+        self.session.close()
+
+    def _urllib3_pools(self):
+        adapters = {id(adapter): adapter for adapter in self.session.adapters.values()}
+        for adapter in adapters.values():
+            pools = adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is not None:
+                    yield pool
+
+    def _enter(self):
+        with self._lock:
+            self._stats['openai_requests'] += 1
+            self._stats['openai_in_flight'] += 1
+            self._stats['openai_in_flight_peak'] = max(self._stats['openai_in_flight_peak'],
+                                                       self._stats['openai_in_flight'])
+
+    def _exit(self):
+        with self._lock:
+            self._stats['openai_in_flight'] -= 1
+
+    def _trace(self, event_name, info):
+        # httpcore は新規接続を張るときだけ connect_tcp イベントを発行する
+        if event_name == 'connection.connect_tcp.complete':
+            with self._lock:
+                self._stats['openai_connections'] += 1
@@ -0,0 +1,150 @@
+"""
+Precomputed evaluation-image descriptions for AI Fashion Experiment
+評価用画像の詳しい説明文を事前に生成し、画像と同じディレクトリに保存する
+
+Each evaluation image can have a sidecar file (test1.jpg ->
+test1.description.json) that holds a detailed text description generated
+once offline, the SHA-256 of the image it describes and the model that
+wrote it. Prediction methods switched to the text-only path send this
+description instead of the image, so the call becomes a short text
+completion. A description whose hash no longer matches its image counts
+as missing, and such methods fall back to the image.
+"""
+
+import os
+import json
+import hashlib
+import logging
+import threading
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+DESCRIPTION_SUFFIX = '.description.json'
+
+
+def file_sha256(file_path):
+    """Return the SHA-256 hex digest of a file."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def description_path(image_path):
+    """Return the sidecar path of an image's description."""
+    return os.path.splitext(image_path)[0] + DESCRIPTION_SUFFIX
+
+
+def write_description(image_path, description, model):
+    """Store a description next to its image (atomically)."""
+    path = description_path(image_path)
+    record = {
+        'image': os.path.basename(image_path),
+        'sha256': file_sha256(image_path),
+        'model': model,
+        'created_at': datetime.now().isoformat(),
+        'description': description,
+    }
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(record, f, ensure_ascii=False, indent=2)
+        f.write('\n')
+    os.replace(tmp_path, path)
+    return path
+
+
+class DescriptionStore:
+    """
+    Sidecar descriptions loaded on first use and checked against their images.
+
+    Entries are reloaded when the image or the sidecar file changes, so
+    regenerating descriptions does not need a restart.
+    """
+
+    def __init__(self):
+        self._entries = {}  # image_path -> ((image mtime, sidecar mtime), description or None)
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'missing': 0, 'stale': 0}
+
+    def get(self, image_path):
+        """
+        Return the current description of an image.
+
+        Returns:
+            Description text, or None when there is no sidecar or it
+            describes a different version of the image
+        """
+        path = description_path(image_path)
+        try:
+            version = (os.path.getmtime(image_path), os.path.getmtime(path))
+        except OSError:
+            with self._lock:
+                self._stats['missing'] += 1
+            return None
+
+        with self._lock:
+            entry = self._entries.get(image_path)
+        if entry is None or entry[0] != version:
+            entry = (version, self._load(image_path, path))
+            with self._lock:
+                self._entries[image_path] = entry
+
+        with self._lock:
+            self._stats['hits' if entry[1] is not None else 'stale'] += 1
+        return entry[1]
+
+    def _load(self, image_path, path):
+        try:
+            with open(path, encoding='utf-8') as f:
+                record = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning("Could not read description %s: %s", path, e)
+            return None
+        if record.get('sha256') != file_sha256(image_path):
+            logger.warning("Description %s is stale (image has changed)", path)
+            return None
+        return record.get('description') or None
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['loaded'] = sum(1 for _, description in self._entries.values() if description is not None)
+        return stats
+
+
+def generate_descriptions(image_paths, describe, model, store=None, force=False):
+    """
+    Write a description for every image that has no current one.
+
+    Args:
+        image_paths: Evaluation image paths
+        describe: Callable returning the description text of one image path
+        model: Model name recorded in the sidecar files
+        store: DescriptionStore used to detect current descriptions
+        force: Regenerate every description
+
+    Returns:
+        Dictionary with 'written', 'skipped' and 'failed' image names
+    """
+    store = store or DescriptionStore()
+    result = {'written': [], 'skipped': [], 'failed': []}
+    for image_path in image_paths:
+        name = os.path.basename(image_path)
+        if not force and store.get(image_path) is not None:
+            result['skipped'].append(name)
+            continue
+        try:
+            description = describe(image_path)
+        except Exception as e:
+            logger.error("Could not describe %s: %s", name, e)
+            result['failed'].append(name)
+            continue
+        if not description:
+            result['failed'].append(name)
+            continue
+        write_description(image_path, description.strip(), model)
+        result['written'].append(name)
+        logger.info("Wrote description for %s", name)
+    return result
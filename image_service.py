@@ -0,0 +1,392 @@
+"""
+Image processing service for AI Fashion Experiment
+画像のデコード・検証・リサイズ・Base64エンコードを別プロセスで実行する
+
+This module is kept free of Flask/OpenAI imports so that pool workers
+started with the 'spawn' method only load Pillow.
+"""
+
+import os
+import io
+import atexit
+import binascii
+import logging
+import threading
+import time
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# Pillow format name -> media type
+SUPPORTED_FORMATS = {
+    'JPEG': 'image/jpeg',
+    'PNG': 'image/png',
+}
+
+
+# 3の倍数にするとチャンクごとのエンコード結果を連結してもパディングが入らない
+ENCODE_CHUNK_SIZE = 3 * 64 * 1024
+
+
+class ImageValidationError(ValueError):
+    """Raised when a file is not a decodable JPEG/PNG image."""
+
+
+def encode_data_url(source, size, media_type):
+    """
+    Base64-encode a stream into a preallocated data URL buffer.
+    元データ全体やエンコード途中の中間コピーを持たずにエンコードする
+
+    Args:
+        source: Binary file-like object positioned at the start of the data
+        size: Number of bytes that will be read from source
+        media_type: Media type written into the data URL prefix
+
+    Returns:
+        Tuple of (bytearray holding "data:<type>;base64,<data>", prefix length)
+    """
+    prefix = f"data:{media_type};base64,".encode('ascii')
+    payload = bytearray(len(prefix) + 4 * ((size + 2) // 3))
+    payload[:len(prefix)] = prefix
+    position = len(prefix)
+    while True:
+        chunk = source.read(ENCODE_CHUNK_SIZE)
+        if not chunk:
+            break
+        encoded = binascii.b2a_base64(chunk, newline=False)
+        payload[position:position + len(encoded)] = encoded
+        position += len(encoded)
+    if position != len(payload):
+        raise ImageValidationError("Image changed while it was being encoded")
+    return payload, len(prefix)
+
+
+def process_image(file_path, max_dimension=0):
+    """
+    Decode, validate, optionally resize and base64-encode one image.
+    プロセスプール内で実行されるタスク本体
+
+    The file is validated by Pillow straight from disk and then encoded in
+    chunks, so the raw bytes are never held in memory as a whole.
+
+    Args:
+        file_path: Path to the image file
+        max_dimension: Longest side in pixels after resizing (0 = keep original)
+
+    Returns:
+        Dictionary with 'payload' (the image as an ASCII data URL in a
+        bytearray), 'base64_offset' (where the base64 data starts in it),
+        'media_type', 'width', 'height', 'resized' and 'cpu_time' (seconds)
+    """
+    cpu_start = time.process_time()
+
+    try:
+        with Image.open(file_path) as img:
+            img.verify()
+        img = Image.open(file_path)
+        img.load()
+    except Exception as e:
+        raise ImageValidationError(f"{os.path.basename(file_path)} is not a valid image: {e}")
+
+    if img.format not in SUPPORTED_FORMATS:
+        img.close()
+        raise ImageValidationError(f"{os.path.basename(file_path)} has unsupported format {img.format}")
+
+    image_format = img.format
+    media_type = SUPPORTED_FORMATS[image_format]
+    resized = False
+    if max_dimension and max(img.size) > max_dimension:
+        img.thumbnail((max_dimension, max_dimension))
+        if image_format == 'JPEG' and img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        buffer = io.BytesIO()
+        img.save(buffer, format=image_format, quality=90)
+        size = buffer.tell()
+        buffer.seek(0)
+        payload, base64_offset = encode_data_url(buffer, size, media_type)
+        resized = True
+    else:
+        with open(file_path, 'rb') as f:
+            payload, base64_offset = encode_data_url(f, os.fstat(f.fileno()).st_size, media_type)
+
+    width, height = img.size
+    img.close()
+
+    return {
+        'payload': payload,
+        'base64_offset': base64_offset,
+        'media_type': media_type,
+        'width': width,
+        'height': height,
+        'resized': resized,
+        'cpu_time': time.process_time() - cpu_start,
+    }
+
+
+def _process_image_for_pool(file_path, max_dimension=0):
+    """
+    process_image() for pool workers.
+
+    A bytearray is pickled as a bytes copy that is copied again on
+    unpickling, so the worker hands back bytes instead.
+    """
+    result = process_image(file_path, max_dimension)
+    result['payload'] = bytes(result['payload'])
+    return result
+
+
+def payload_text(result, data_url=True):
+    """
+    Convert a process_image() result into a str in one copy and release its buffer.
+
+    Args:
+        result: process_image() result (its 'payload' is removed)
+        data_url: True for the whole data URL, False for only the base64 data
+    """
+    payload = result.pop('payload')
+    offset = 0 if data_url else result['base64_offset']
+    return str(memoryview(payload)[offset:], 'ascii')
+
+
+class DataUrlCache:
+    """
+    LRU cache of data URL strings for images that are sent again and again.
+
+    Entries are keyed by path, size and mtime, so a replaced file is
+    encoded again.
+
+    Args:
+        max_bytes: Total length of cached strings (0 = disabled)
+    """
+
+    def __init__(self, max_bytes=0):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0}
+
+    def get(self, file_path, create):
+        """Return the cached string for file_path, calling create(file_path) on a miss."""
+        stat = os.stat(file_path)
+        key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self._stats['hits'] += 1
+                return self._entries[key]
+            self._stats['misses'] += 1
+
+        value = create(file_path)
+        if value is None or not self.max_bytes or len(value) > self.max_bytes:
+            return value
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = value
+                self._bytes += len(value)
+                while self._bytes > self.max_bytes:
+                    _, evicted = self._entries.popitem(last=False)
+                    self._bytes -= len(evicted)
+        return value
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries), bytes=self._bytes,
+                        max_bytes=self.max_bytes)
+
+
+WARM_UP_TIMEOUT = 60  # seconds
+
+_startup_barrier = None
+
+
+def _init_worker(barrier):
+    global _startup_barrier
+    _startup_barrier = barrier
+
+
+def _warm_up():
+    """
+    Warm-up task that holds its process until every worker has started.
+
+    The pool only spawns a new process when no idle one is available, so
+    blocking each warm-up task on a shared barrier forces all of them to
+    be started instead of a few processes running every quick task.
+    """
+    try:
+        _startup_barrier.wait(WARM_UP_TIMEOUT)
+    except threading.BrokenBarrierError:
+        pass
+    return os.getpid()
+
+
+class ImageService:
+    """
+    Process-pool front end for CPU-bound image work.
+
+    Tasks run in a pool of spawned processes so base64 encoding and Pillow
+    work never hold the GIL of a request thread. At most max_pending tasks
+    may be queued or running; further submissions block until a slot frees
+    up. With workers=0 every task runs inline in the calling thread.
+    """
+
+    def __init__(self, workers=None, max_pending=None, max_dimension=0):
+        self.workers = (os.cpu_count() or 1) if workers is None else workers
+        self.max_pending = max_pending or max(self.workers * 4, 1)
+        self.max_dimension = max_dimension
+        self._executor = None
+        self._processes = 0
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._stats = {
+            'tasks': 0,
+            'failures': 0,
+            'cpu_time_total': 0.0,
+            'cpu_time_max': 0.0,
+            'pool_restarts': 0,
+        }
+
+    def start(self):
+        """
+        Create the pool and start every worker process up front (idempotent).
+
+        Call this before serving traffic (gunicorn's post_worker_init does);
+        otherwise the first submission starts the pool.
+
+        Returns:
+            Number of worker processes that started
+        """
+        if self.workers <= 0:
+            return 0
+        with self._lock:
+            if self._executor is not None:
+                return self._processes
+            context = multiprocessing.get_context('spawn')
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=context,
+                initializer=_init_worker,
+                initargs=(context.Barrier(self.workers),),
+            )
+            futures = [self._executor.submit(_warm_up) for _ in range(self.workers)]
+            self._processes = len({future.result() for future in futures})
+        logger.info("Image service started %d of %d worker processes", self._processes, self.workers)
+        return self._processes
+
+    def shutdown(self):
+        """Stop the worker processes."""
+        with self._lock:
+            executor, self._executor = self._executor, None
+            self._processes = 0
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def submit(self, file_path, timeout=None):
+        """
+        Queue one image for processing.
+
+        Blocks while max_pending tasks are already in flight.
+
+        Returns:
+            concurrent.futures.Future resolving to the process_image() result
+
+        Raises:
+            TimeoutError: If no queue slot frees up within timeout seconds
+        """
+        if self.workers <= 0:
+            future = Future()
+            try:
+                future.set_result(process_image(file_path, self.max_dimension))
+            except Exception as e:
+                future.set_exception(e)
+            future.add_done_callback(self._record)
+            return future
+
+        self.start()
+        if not self._slots.acquire(timeout=timeout):
+            raise TimeoutError("Image service queue is full")
+        try:
+            future = self._submit_to_pool(file_path)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(self._release)
+        return future
+
+    def _submit_to_pool(self, file_path):
+        executor = self._executor
+        try:
+            return executor.submit(_process_image_for_pool, file_path, self.max_dimension)
+        except BrokenProcessPool:
+            # ワーカーが異常終了（メモリ不足・Pillow のクラッシュ等）したプールは以後使えないため作り直す
+            logger.warning("Image worker process died, restarting the pool")
+            self._discard(executor)
+            self.start()
+            return self._executor.submit(_process_image_for_pool, file_path, self.max_dimension)
+
+    def _discard(self, executor):
+        """Drop a broken pool so the next start() creates a new one."""
+        with self._lock:
+            if self._executor is not executor:
+                return  # 別のスレッドが作り直し済み
+            self._executor = None
+            self._processes = 0
+            self._stats['pool_restarts'] += 1
+        executor.shutdown(wait=False)
+
+    def process(self, file_path, timeout=None):
+        """Process one image and wait for the result."""
+        return self.submit(file_path, timeout).result()
+
+    def process_many(self, file_paths, timeout=None):
+        """
+        Process several images in parallel.
+
+        Returns:
+            List of results in input order; failed images map to None
+        """
+        futures = [self.submit(path, timeout) for path in file_paths]
+        results = []
+        for path, future in zip(file_paths, futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                logger.error("Error processing image %s: %s", path, e)
+                results.append(None)
+        return results
+
+    def stats(self):
+        """Return task counts and per-task CPU time figures."""
+        with self._lock:
+            stats = dict(self._stats)
+        completed = stats['tasks'] - stats['failures']
+        stats['cpu_time_avg'] = stats['cpu_time_total'] / completed if completed else 0.0
+        stats['workers'] = self.workers
+        stats['processes'] = self._processes
+        stats['max_pending'] = self.max_pending
+        return stats
+
+    def _release(self, future):
+        self._slots.release()
+        self._record(future)
+
+    def _record(self, future):
+        with self._lock:
+            self._stats['tasks'] += 1
+            if future.cancelled() or future.exception() is not None:
+                self._stats['failures'] += 1
+                return
+            cpu_time = future.result()['cpu_time']
+            self._stats['cpu_time_total'] += cpu_time
+            self._stats['cpu_time_max'] = max(self._stats['cpu_time_max'], cpu_time)
+
+
+def create_image_service(workers=None, max_pending=None, max_dimension=0):
+    """Create an ImageService that is shut down when the interpreter exits."""
+    service = ImageService(workers, max_pending, max_dimension)
+    atexit.register(service.shutdown)
+    return service
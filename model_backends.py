@@ -0,0 +1,310 @@
+"""
+Model backend registry for AI Fashion Experiment
+モデル・エンドポイントごとの設定、レイテンシ統計、ヘッジリクエスト
+
+Each backend names a model, an optional OpenAI-compatible endpoint, its
+token limit and the prompt format it expects. Call sites ask for a role
+('extraction', 'prediction') instead of a model, so a slow model or
+endpoint can be replaced by configuration. Latency of every completed call
+is kept per backend, and separately per role on each backend. Short calls
+can be hedged: if the first attempt takes longer than the observed p95 of
+that role on that backend, a second attempt is sent and the first
+successful response wins. The number of hedges is capped as a
+fraction of calls, which bounds the extra spend.
+"""
+
+import json
+import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FuturesTimeout, wait, FIRST_COMPLETED
+
+logger = logging.getLogger(__name__)
+
+PROMPT_FORMATS = ('user_parts', 'system_prompt')
+
+
+def percentile(samples, p):
+    """Return the p-th percentile (nearest rank) of samples, or None when empty."""
+    samples = sorted(samples)
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, max(0, round(p / 100 * len(samples)) - 1))]
+
+
+class LatencyTracker:
+    """
+    Sliding window of recent call latencies.
+
+    Args:
+        window: Number of most recent samples kept
+    """
+
+    def __init__(self, window=200):
+        self.window = window
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    @property
+    def count(self):
+        with self._lock:
+            return len(self._samples)
+
+    def percentile(self, p):
+        """Return the p-th percentile in seconds (None without samples)."""
+        with self._lock:
+            samples = list(self._samples)
+        return percentile(samples, p)
+
+    def snapshot(self):
+        return {
+            'samples': self.count,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+        }
+
+
+class ModelBackend:
+    """
+    One model on one endpoint.
+
+    Args:
+        name: Registry name
+        model: Model name sent to the API
+        max_tokens: Upper limit on max_tokens for any call to this backend
+        base_url: OpenAI-compatible endpoint (None = the default OpenAI client)
+        api_key_env: Environment variable holding the endpoint's API key
+        prompt_format: 'user_parts' (instruction and images in one user
+            message) or 'system_prompt' (instruction as a system message)
+        latency_window: Number of latency samples kept
+    """
+
+    def __init__(self, name, model, max_tokens=1024, base_url=None, api_key_env=None,
+                 prompt_format='user_parts', latency_window=200):
+        if prompt_format not in PROMPT_FORMATS:
+            raise ValueError(f"Unknown prompt format for backend {name}: {prompt_format}")
+        self.name = name
+        self.model = model
+        self.max_tokens = max_tokens
+        self.base_url = base_url
+        self.api_key_env = api_key_env
+        self.prompt_format = prompt_format
+        self.latency = LatencyTracker(latency_window)
+
+    @property
+    def uses_default_client(self):
+        return self.base_url is None and self.api_key_env is None
+
+    def format_messages(self, prompt, image_parts=()):
+        """Build chat messages for an instruction and image_url content parts."""
+        if self.prompt_format == 'system_prompt':
+            return [
+                {"role": "system", "content": prompt},
+                {"role": "user", "content": list(image_parts)},
+            ]
+        return [{"role": "user", "content": [{"type": "text", "text": prompt}, *image_parts]}]
+
+    def request_body(self, prompt, image_parts=(), max_tokens=None):
+        """Return the model, max_tokens and messages of a chat completion request."""
+        return {
+            'model': self.model,
+            'max_tokens': min(max_tokens or self.max_tokens, self.max_tokens),
+            'messages': self.format_messages(prompt, image_parts),
+        }
+
+
+class ModelRegistry:
+    """
+    Registered backends, the role -> backend assignment and hedged calls.
+
+    Args:
+        default_client: Callable returning the shared OpenAI client
+        client_factory: Callable creating a client for a backend with its own endpoint or key
+        hedge_max_extra_ratio: Maximum hedged attempts as a fraction of hedgeable calls (0 = never hedge)
+        hedge_percentile: Latency percentile after which a hedge is sent
+        hedge_min_samples: Samples needed before the percentile is trusted
+        max_workers: Threads available for hedged attempts (primary attempts get their own thread)
+    """
+
+    def __init__(self, default_client, client_factory, hedge_max_extra_ratio=0.0,
+                 hedge_percentile=95, hedge_min_samples=20, max_workers=10):
+        self._default_client = default_client
+        self._client_factory = client_factory
+        self.hedge_max_extra_ratio = hedge_max_extra_ratio
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self._backends = {}
+        self._roles = {}
+        self._clients = {}
+        self._role_latency = {}  # (role, backend name) -> LatencyTracker
+        self._hedge_executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='model-hedge')
+        self._lock = threading.Lock()
+        self._stats = {
+            'hedgeable_calls': 0,
+            'hedges': 0,
+            'hedge_wins': 0,
+            'hedges_over_budget': 0,
+        }
+
+    def register(self, backend):
+        """Add or replace a backend."""
+        with self._lock:
+            self._backends[backend.name] = backend
+            self._clients.pop(backend.name, None)
+        return backend
+
+    def load_config(self, path):
+        """
+        Register backends from a JSON file.
+
+        The file holds a list of objects with ModelBackend's arguments, e.g.
+        [{"name": "azure-mini", "model": "gpt-4o-mini", "base_url": "...",
+          "api_key_env": "AZURE_OPENAI_KEY", "max_tokens": 512}]
+        """
+        with open(path, encoding='utf-8') as f:
+            for entry in json.load(f):
+                self.register(ModelBackend(**entry))
+
+    def get(self, name):
+        try:
+            return self._backends[name]
+        except KeyError:
+            raise KeyError(f"Model backend is not registered: {name}") from None
+
+    def assign(self, role, name, hedge_name=None):
+        """Route a role to a backend, optionally sending hedges to another one."""
+        self._roles[role] = (self.get(name), self.get(hedge_name or name))
+
+    def backend_for(self, role):
+        return self._roles[role][0]
+
+    def latency_for(self, role, backend):
+        """
+        Return the latency tracker of one role on one backend.
+
+        Only non-streamed calls are recorded here (a streamed call's time
+        is only the time to the response headers), so the hedge threshold
+        of a role is not skewed by other roles sharing the backend.
+        """
+        key = (role, backend.name)
+        with self._lock:
+            if key not in self._role_latency:
+                self._role_latency[key] = LatencyTracker(backend.latency.window)
+            return self._role_latency[key]
+
+    def client_for(self, backend):
+        """Return the OpenAI client for a backend (created once per backend)."""
+        if backend.uses_default_client:
+            return self._default_client()
+        with self._lock:
+            if backend.name not in self._clients:
+                self._clients[backend.name] = self._client_factory(backend)
+            return self._clients[backend.name]
+
+    def _call(self, role, backend, prompt, image_parts, max_tokens, kwargs):
+        client = self.client_for(backend)
+        if client is None:
+            raise ValueError("OpenAI client is not initialized. Please set OPENAI_API_KEY.")
+        started = time.perf_counter()
+        response = client.chat.completions.create(
+            **backend.request_body(prompt, image_parts, max_tokens), **kwargs
+        )
+        elapsed = time.perf_counter() - started
+        # ストリーミングの場合はレスポンスヘッダー受信までの時間（バックエンド全体の統計にだけ含める）
+        backend.latency.record(elapsed)
+        if not kwargs.get('stream'):
+            self.latency_for(role, backend).record(elapsed)
+        return response
+
+    def _start_primary(self, role, backend, prompt, image_parts, max_tokens, kwargs):
+        """
+        Run the first attempt of a hedgeable call on a thread of its own.
+
+        A shared bounded pool would make callers queue for a thread, and
+        the queueing time would count against the hedge deadline, so the
+        registry would hedge exactly when it is saturated.
+        """
+        future = Future()
+
+        def run():
+            future.set_running_or_notify_cancel()
+            try:
+                future.set_result(self._call(role, backend, prompt, image_parts, max_tokens, kwargs))
+            except Exception as e:
+                future.set_exception(e)
+
+        threading.Thread(target=run, name='model-primary', daemon=True).start()
+        return future
+
+    def complete(self, role, prompt, image_parts=(), max_tokens=None, hedge=False, **kwargs):
+        """
+        Send one chat completion for a role.
+
+        Args:
+            role: Role assigned with assign()
+            prompt: Instruction text
+            image_parts: image_url content parts
+            max_tokens: Requested max_tokens (capped by the backend's limit)
+            hedge: Send a second attempt when the first exceeds the observed percentile
+            **kwargs: Passed to chat.completions.create (timeout, stream, ...)
+
+        Returns:
+            The chat completion response of the attempt that finished first
+        """
+        primary, secondary = self._roles[role]
+        if not hedge:
+            return self._call(role, primary, prompt, image_parts, max_tokens, kwargs)
+
+        with self._lock:
+            self._stats['hedgeable_calls'] += 1
+        threshold = None
+        latency = self.latency_for(role, primary)
+        if self.hedge_max_extra_ratio > 0 and not kwargs.get('stream') and latency.count >= self.hedge_min_samples:
+            threshold = latency.percentile(self.hedge_percentile)
+        if threshold is None:
+            return self._call(role, primary, prompt, image_parts, max_tokens, kwargs)
+
+        first = self._start_primary(role, primary, prompt, image_parts, max_tokens, kwargs)
+        try:
+            return first.result(timeout=threshold)
+        except FuturesTimeout:
+            pass
+
+        with self._lock:
+            allowed = self._stats['hedges'] + 1 <= self.hedge_max_extra_ratio * self._stats['hedgeable_calls']
+            self._stats['hedges' if allowed else 'hedges_over_budget'] += 1
+        if not allowed:
+            return first.result()
+
+        logger.info("Hedging %s call to %s after %.2fs", role, secondary.name, threshold)
+        second = self._hedge_executor.submit(self._call, role, secondary, prompt, image_parts, max_tokens, kwargs)
+        pending = {first, second}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is second:
+                        with self._lock:
+                            self._stats['hedge_wins'] += 1
+                    # 遅い方の呼び出しは取り消せないので、結果を捨てる
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def stats(self):
+        """Return latency percentiles per backend and per role, role routing and hedge counts."""
+        with self._lock:
+            stats = dict(self._stats)
+        stats['hedge_max_extra_ratio'] = self.hedge_max_extra_ratio
+        stats['roles'] = {role: {'backend': primary.name, 'hedge_backend': secondary.name,
+                                 'latency': self.latency_for(role, primary).snapshot()}
+                          for role, (primary, secondary) in self._roles.items()}
+        stats['backends'] = {name: backend.latency.snapshot() for name, backend in self._backends.items()}
+        return stats
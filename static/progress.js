@@ -0,0 +1,45 @@
+// アップロード送信中、サーバーから解析の進捗（Server-Sent Events）を受け取って表示する
+(function () {
+    const STAGE_LABELS = {
+        like_criteria: '好きな服の判断基準を抽出中',
+        like_features: '好きな服の特徴を抽出中',
+        dislike_criteria: '嫌いな服の判断基準を抽出中',
+        dislike_features: '嫌いな服の特徴を抽出中',
+        prediction: '印象を予測中'
+    };
+
+    function newProgressId() {
+        if (window.crypto && crypto.randomUUID) {
+            return crypto.randomUUID();
+        }
+        return Date.now().toString(36) + '-' + Math.random().toString(36).slice(2, 12);
+    }
+
+    document.querySelectorAll('form[data-progress-url]').forEach((form) => {
+        const panel = document.getElementById(form.dataset.progressPanel);
+        const status = panel.querySelector('.stream-progress-status');
+        const bar = panel.querySelector('.stream-progress-fill');
+
+        form.addEventListener('submit', () => {
+            if (!window.EventSource) {
+                return;
+            }
+            const progressId = newProgressId();
+            form.querySelector('input[name="progress_id"]').value = progressId;
+            panel.hidden = false;
+
+            const source = new EventSource(form.dataset.progressUrl.replace('__id__', progressId));
+            source.onmessage = (message) => {
+                const event = JSON.parse(message.data);
+                if (event.type === 'done') {
+                    source.close();
+                    return;
+                }
+                const label = STAGE_LABELS[event.stage || event.type];
+                status.textContent = `${label}… ${event.index} / ${event.total}`;
+                bar.style.width = `${Math.round(event.index / event.total * 100)}%`;
+            };
+            source.onerror = () => source.close();
+        });
+    });
+})();
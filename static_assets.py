@@ -0,0 +1,132 @@
+"""
+Static asset pipeline for AI Fashion Experiment
+静的ファイルにハッシュ付きのファイル名を付け、圧縮版を事前生成する
+
+Every file in the static folder is copied to the build directory under a
+content-hashed name (style.css -> style.<hash>.css). Text assets also get
+precompressed .gz and, when the brotli package is installed, .br variants.
+Because a fingerprinted name changes whenever the content changes, those
+URLs can be cached by browsers as immutable.
+"""
+
+import os
+import gzip
+import hashlib
+import logging
+import threading
+
+try:
+    import brotli
+except ImportError:  # brotli は任意（無ければ .br を生成しない）
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+COMPRESSIBLE_EXTENSIONS = {'.css', '.js', '.svg', '.html', '.json', '.txt'}
+FINGERPRINT_LENGTH = 12
+MIN_COMPRESS_SIZE = 256  # bytes
+
+# Accept-Encoding の優先順位
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+
+def fingerprinted_name(filename, content):
+    """Return filename with a content hash inserted before the extension."""
+    stem, ext = os.path.splitext(filename)
+    digest = hashlib.sha256(content).hexdigest()[:FINGERPRINT_LENGTH]
+    return f"{stem}.{digest}{ext}"
+
+
+def _write_atomic(path, data):
+    """Write a file once; content-addressed names never need rewriting."""
+    if os.path.exists(path):
+        return
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class StaticAssets:
+    """
+    Fingerprinted, precompressed copies of the static folder.
+
+    Args:
+        source_dir: Static folder the templates refer to
+        build_dir: Directory the fingerprinted files are written to
+        gzip_level: Compression level of the .gz variants
+        brotli_quality: Quality of the .br variants
+    """
+
+    def __init__(self, source_dir, build_dir, gzip_level=9, brotli_quality=11):
+        self.source_dir = source_dir
+        self.build_dir = build_dir
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.manifest = {}  # 'style.css' -> 'style.<hash>.css'
+        self.variants = {}  # 'style.<hash>.css' -> {'identity': path, 'gzip': path, 'br': path}
+
+    def build(self):
+        """
+        Fingerprint and precompress every static file.
+
+        Returns:
+            Manifest mapping original names to fingerprinted names
+        """
+        manifest = {}
+        variants = {}
+        for dirpath, dirnames, filenames in os.walk(self.source_dir):
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            for name in filenames:
+                if name.startswith('.'):
+                    continue
+                source_path = os.path.join(dirpath, name)
+                filename = os.path.relpath(source_path, self.source_dir).replace(os.sep, '/')
+                with open(source_path, 'rb') as f:
+                    content = f.read()
+
+                built_name = fingerprinted_name(filename, content)
+                built_path = os.path.join(self.build_dir, *built_name.split('/'))
+                os.makedirs(os.path.dirname(built_path), exist_ok=True)
+                _write_atomic(built_path, content)
+                files = {'identity': built_path}
+
+                if os.path.splitext(name)[1].lower() in COMPRESSIBLE_EXTENSIONS and len(content) >= MIN_COMPRESS_SIZE:
+                    _write_atomic(built_path + '.gz', gzip.compress(content, compresslevel=self.gzip_level, mtime=0))
+                    files['gzip'] = built_path + '.gz'
+                    if brotli is not None:
+                        _write_atomic(built_path + '.br', brotli.compress(content, quality=self.brotli_quality))
+                        files['br'] = built_path + '.br'
+
+                manifest[filename] = built_name
+                variants[built_name] = files
+
+        self.manifest, self.variants = manifest, variants
+        logger.info("Built %d static assets into %s (brotli: %s)",
+                    len(manifest), self.build_dir, 'yes' if brotli else 'no')
+        return manifest
+
+    def url_name(self, filename):
+        """Return the fingerprinted name for filename (unchanged if unknown)."""
+        return self.manifest.get(filename, filename)
+
+    def select(self, built_name, accept_encodings):
+        """
+        Pick the variant of a fingerprinted file for the request.
+
+        Args:
+            built_name: Fingerprinted filename from the URL
+            accept_encodings: The request's Accept-Encoding (werkzeug MIMEAccept-like)
+
+        Returns:
+            (path, content_encoding) or None if built_name is not fingerprinted;
+            content_encoding is None for the uncompressed file
+        """
+        files = self.variants.get(built_name)
+        if files is None:
+            return None
+        for encoding, _ in ENCODINGS:
+            # `in` は q=0（拒否）の指定にも True を返すため、品質値で判定する
+            if encoding in files and accept_encodings[encoding] > 0:
+                return files[encoding], encoding
+        return files['identity'], None
@@ -0,0 +1,136 @@
+"""
+Structured logging for AI Fashion Experiment
+ログをキュー経由で別スレッドから JSON 形式で出力する
+
+Request threads only put the LogRecord on an in-process queue; message
+formatting, JSON encoding and the write to stderr happen on a listener
+thread. Every record carries the correlation ID of the participant/job
+that produced it.
+"""
+
+import sys
+import json
+import queue
+import atexit
+import random
+import logging
+import contextvars
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+# 参加者・ジョブ単位の相関ID（スレッドごと・コンテキストごとに独立）
+correlation_id = contextvars.ContextVar('correlation_id', default='-')
+
+_listener = None
+
+
+def set_correlation_id(value):
+    """Set the correlation ID for the current request or job."""
+    correlation_id.set(value or '-')
+
+
+class CorrelationIdFilter(logging.Filter):
+    """Attach the current correlation ID to each record."""
+
+    def filter(self, record):
+        record.correlation_id = correlation_id.get()
+        return True
+
+
+class PayloadFilter(logging.Filter):
+    """
+    Sample records and cap the length of their string arguments.
+
+    Used on loggers that carry generated text (criteria, predictions) so
+    that long payloads neither flood the log nor cost time to write.
+
+    Args:
+        sample_rate: Fraction of records to keep (1.0 = all)
+        max_chars: Maximum length of each string argument (0 = no cap)
+    """
+
+    def __init__(self, sample_rate=1.0, max_chars=0):
+        super().__init__()
+        self.sample_rate = sample_rate
+        self.max_chars = max_chars
+
+    def filter(self, record):
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return False
+        if self.max_chars and isinstance(record.args, tuple):
+            record.args = tuple(
+                f"{arg[:self.max_chars]}...(+{len(arg) - self.max_chars} chars)"
+                if isinstance(arg, str) and len(arg) > self.max_chars else arg
+                for arg in record.args
+            )
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as one JSON object per line."""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'correlation_id': getattr(record, 'correlation_id', '-'),
+            'thread': record.threadName,
+        }
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    QueueHandler that leaves formatting to the listener thread.
+
+    The queue never leaves the process, so the record can be enqueued as-is
+    instead of being pre-formatted and stripped of its args.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def configure_logging(level=logging.INFO, stream=None):
+    """
+    Route the root logger through a queue to a JSON stream handler.
+    ルートロガーをキュー経由の JSON 出力に置き換える（再呼び出し時は置き換え直す）
+
+    Returns:
+        The running QueueListener
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(JsonFormatter())
+
+    log_queue = queue.SimpleQueue()
+    handler = DeferredQueueHandler(log_queue)
+    handler.addFilter(CorrelationIdFilter())
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    _listener = QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+def shutdown_logging():
+    """Flush queued records and stop the listener thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(shutdown_logging)
@@ -4,15 +4,49 @@ Test script for Flask Fashion Experiment App
 
 import os
 import sys
+import base64
+import gzip
+import json
+import logging
+import random
+import shutil
+import signal
+import tempfile
+import threading
+import time
+import tracemalloc
 import unittest
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO, StringIO
+from types import SimpleNamespace
 from unittest.mock import patch, MagicMock
-from io import BytesIO
+
+from flask import render_template, url_for
 from PIL import Image
+from werkzeug.datastructures import FileStorage
+from werkzeug.http import parse_accept_header
 
 # Add parent directory to path
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
-from app import app, allowed_file, encode_image_to_base64, get_image_media_type
+from app import (app, allowed_file, encode_image_to_base64, get_image_media_type,
+                 build_evaluation_manifest, load_evaluation_set, sample_evaluation_items,
+                 impression_cache, build_output_view_model,
+                 stream_bullets, ProgressBoard, predict_impression)
+import batch_api
+import batch_rerun
+import compare_text_path
+import static_assets
+from admission import AdmissionController, QueueFullError
+from http_transport import HttpTransport
+from image_descriptions import DescriptionStore, generate_descriptions, write_description
+from image_service import ImageService, ImageValidationError, process_image, payload_text, DataUrlCache
+from model_backends import LatencyTracker, ModelBackend, ModelRegistry
+from static_assets import StaticAssets
+from structured_logging import PayloadFilter, configure_logging, set_correlation_id, shutdown_logging
+from upload_store import UploadStore
 
 
 class FlaskAppTestCase(unittest.TestCase):
@@ -76,6 +110,51 @@ class FlaskAppTestCase(unittest.TestCase):
         # Should redirect to index if no session
         self.assertEqual(response.status_code, 302)
 
+    def _prime_output_cache(self):
+        """Store a two-item evaluation in the cache and the session"""
+        impressions = [
+            {'id': 'test1', 'filename': 'test1.jpg', 'impression_id': 'a',
+             'prediction_propose': 'propose-1', 'prediction_compare': 'compare-1',
+             'show_propose_left': False, 'has_error': False},
+            {'id': 'test22', 'filename': 'virus.png', 'impression_id': 'test22',
+             'prediction_propose': 'dummy-p', 'prediction_compare': 'dummy-c',
+             'show_propose_left': True, 'has_error': False, 'is_dummy': True,
+             'expected_score_left': 1, 'expected_score_right': 5},
+        ]
+        impression_cache['output-test'] = {'images': build_output_view_model(impressions), 'pages': {}}
+        self.addCleanup(impression_cache.pop, 'output-test', None)
+        with self.client.session_transaction() as sess:
+            sess['account_name'] = 'test_user'
+            sess['cache_key'] = 'output-test'
+
+    def test_output_view_model_orders_predictions(self):
+        """Test that left/right predictions follow show_propose_left"""
+        self._prime_output_cache()
+        first = impression_cache['output-test']['images'][0]
+        self.assertEqual(first['left_prediction'], 'compare-1')
+        self.assertEqual(first['right_method'], 'propose')
+
+    def test_output_page_rendered_once_and_gzipped(self):
+        """Test that the output page is cached per participant and gzip-encoded"""
+        self._prime_output_cache()
+        with patch('app.render_template', wraps=render_template) as mock_render:
+            first = self.client.get('/output', headers={'Accept-Encoding': 'gzip'})
+            second = self.client.get('/output', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(mock_render.call_count, 1)
+        self.assertEqual(first.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(first.data, second.data)
+        self.assertIn('compare-1', gzip.decompress(first.data).decode('utf-8'))
+
+        plain = self.client.get('/output')
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertIn('compare-1', plain.get_data(as_text=True))
+
+        refused = self.client.get('/output', headers={'Accept-Encoding': 'gzip;q=0'})
+        self.assertNotIn('Content-Encoding', refused.headers)
+        self.assertIn('compare-1', refused.get_data(as_text=True))
+        metrics = self.client.get('/metrics', headers={'Accept-Encoding': 'gzip;q=0'})
+        self.assertNotIn('Content-Encoding', metrics.headers)
+
     def test_thanks_page_loads(self):
         """Test that thanks page loads"""
         response = self.client.get('/thanks-page')
@@ -178,6 +257,1019 @@ class DirectoryStructureTestCase(unittest.TestCase):
             self.assertTrue(os.path.isfile(img_path), f"{img_path} should exist")
 
 
+class EvaluationSetTestCase(unittest.TestCase):
+    """Test evaluation manifest loading and sampling"""
+
+    def _make_set(self, strata_sizes):
+        items = []
+        for stratum, size in strata_sizes.items():
+            for i in range(size):
+                items.append({'id': f'{stratum}{i}', 'filename': f'{stratum}{i}.jpg', 'stratum': stratum})
+        strata = {}
+        for index, item in enumerate(items):
+            strata.setdefault(item['stratum'], []).append(index)
+        return {'items': items, 'dummy': None, 'strata': strata}
+
+    def test_manifest_matches_test_data(self):
+        """Test that the manifest covers test_data in natural order"""
+        manifest = build_evaluation_manifest('test_data')
+        ids = [item['id'] for item in manifest['items']]
+        self.assertEqual(ids[:3], ['test1', 'test2', 'test3'])
+        self.assertNotIn('virus', ids)
+        self.assertEqual(manifest['dummy']['filename'], 'virus.png')
+        self.assertEqual(manifest['items'][0]['media_type'], 'image/jpeg')
+        self.assertEqual(manifest['items'][0]['bytes'], os.path.getsize('test_data/test1.jpg'))
+
+    def test_dummy_id_never_collides_with_items(self):
+        """Test that a test22.jpg item does not share its id with the dummy"""
+        test_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, test_dir, True)
+        for number in range(1, 23):
+            Image.new('RGB', (4, 4)).save(os.path.join(test_dir, f'test{number}.jpg'))
+        Image.new('RGB', (4, 4)).save(os.path.join(test_dir, 'virus.png'))
+
+        manifest = build_evaluation_manifest(test_dir)
+        ids = [item['id'] for item in manifest['items']]
+        self.assertIn('test22', ids)
+        self.assertEqual(manifest['dummy']['id'], 'test24')
+
+        manifest['dummy']['id'] = 'test22'
+        manifest_path = os.path.join(test_dir, 'manifest.json')
+        with open(manifest_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f)
+        with self.assertRaises(ValueError):
+            load_evaluation_set(manifest_path, test_dir)
+
+    def test_load_evaluation_set_indexes_strata(self):
+        """Test that loading the committed manifest builds the stratum index"""
+        evaluation_set = load_evaluation_set('test_data/manifest.json')
+        self.assertEqual(len(evaluation_set['items']), 20)
+        self.assertEqual(evaluation_set['strata']['default'], list(range(20)))
+
+    def test_sample_all_when_size_is_zero(self):
+        """Test that sample size 0 returns every item"""
+        evaluation_set = self._make_set({'a': 5})
+        self.assertEqual(sample_evaluation_items(evaluation_set, 0), evaluation_set['items'])
+
+    def test_random_sample_size_and_order(self):
+        """Test that random sampling returns N distinct items in manifest order"""
+        evaluation_set = self._make_set({'a': 1000})
+        sample = sample_evaluation_items(evaluation_set, 20, rng=random.Random(0))
+        positions = [evaluation_set['items'].index(item) for item in sample]
+        self.assertEqual(len(set(positions)), 20)
+        self.assertEqual(positions, sorted(positions))
+
+    def test_stratified_sample_is_proportional(self):
+        """Test that stratified sampling allocates items per stratum"""
+        evaluation_set = self._make_set({'a': 60, 'b': 30, 'c': 10})
+        sample = sample_evaluation_items(evaluation_set, 10, 'stratified', random.Random(0))
+        counts = {}
+        for item in sample:
+            counts[item['stratum']] = counts.get(item['stratum'], 0) + 1
+        self.assertEqual(counts, {'a': 6, 'b': 3, 'c': 1})
+
+
+class ImageServiceTestCase(unittest.TestCase):
+    """Test the image processing pool"""
+
+    def setUp(self):
+        self.image_path = 'test_image_service.png'
+        Image.new('RGB', (400, 200), color='blue').save(self.image_path)
+
+    def tearDown(self):
+        for path in (self.image_path, 'test_not_image.jpg'):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_process_image_resizes_and_encodes(self):
+        """Test that process_image resizes to max_dimension and reports CPU time"""
+        result = process_image(self.image_path, max_dimension=100)
+        self.assertEqual((result['width'], result['height']), (100, 50))
+        self.assertEqual(result['media_type'], 'image/png')
+        self.assertTrue(result['resized'])
+        self.assertGreaterEqual(result['cpu_time'], 0.0)
+        decoded = Image.open(BytesIO(base64.b64decode(payload_text(result, data_url=False))))
+        self.assertEqual(decoded.size, (100, 50))
+
+    def test_process_image_rejects_non_images(self):
+        """Test that files Pillow cannot decode are rejected"""
+        with open('test_not_image.jpg', 'wb') as f:
+            f.write(b'not an image')
+        with self.assertRaises(ImageValidationError):
+            process_image('test_not_image.jpg')
+
+    def test_pool_matches_inline_result(self):
+        """Test that pooled processing returns the same bytes as inline processing"""
+        service = ImageService(workers=1, max_pending=2)
+        try:
+            results = service.process_many([self.image_path, 'missing.png'])
+        finally:
+            service.shutdown()
+        self.assertEqual(payload_text(results[0]), payload_text(process_image(self.image_path)))
+        self.assertIsNone(results[1])
+        stats = service.stats()
+        self.assertEqual(stats['tasks'], 2)
+        self.assertEqual(stats['failures'], 1)
+
+    def test_start_spawns_every_worker(self):
+        """Test that start() brings up all worker processes, not just the ones warm-up tasks reached"""
+        service = ImageService(workers=2)
+        try:
+            self.assertEqual(service.start(), 2)
+            self.assertEqual(service.start(), 2)
+            self.assertEqual(service.stats()['processes'], 2)
+        finally:
+            service.shutdown()
+
+    def test_pool_recovers_after_a_worker_dies(self):
+        """Test that a killed worker process does not break every later submission"""
+        service = ImageService(workers=1)
+        self.addCleanup(service.shutdown)
+        service.start()
+        os.kill(service._executor.submit(os.getpid).result(), signal.SIGKILL)
+
+        result = None
+        for _ in range(10):
+            try:
+                result = service.process(self.image_path)
+                break
+            except BrokenProcessPool:
+                time.sleep(0.1)  # 異常終了の検知前に投入したタスクは失敗する
+        self.assertIsNotNone(result)
+        self.assertEqual(payload_text(result), payload_text(process_image(self.image_path)))
+        self.assertEqual(service.stats()['pool_restarts'], 1)
+
+
+class EncodingMemoryTestCase(unittest.TestCase):
+    """Test peak memory of the image encoding path with tracemalloc"""
+
+    # 1リクエスト（5枚）のピークは「送信する data URL 5本 + 作業用1本」まで
+    REQUEST_BUDGET_PAYLOADS = 6.5
+    # 1枚のエンコードはエンコード済みバッファと文字列の2本分まで
+    SINGLE_BUDGET_PAYLOADS = 2.2
+
+    @classmethod
+    def setUpClass(cls):
+        cls.image_path = 'test_encoding_memory.jpg'
+        # ノイズ画像は JPEG でもほとんど圧縮されない（約2MB）
+        Image.frombytes('RGB', (1000, 1000), os.urandom(3 * 1000 * 1000)).save(cls.image_path, quality=95)
+        cls.payload_size = len(payload_text(process_image(cls.image_path)))
+
+    @classmethod
+    def tearDownClass(cls):
+        os.remove(cls.image_path)
+
+    def _peak(self, fn):
+        with patch('app.image_service', ImageService(workers=0)):
+            tracemalloc.start()
+            try:
+                result = fn()
+                _, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+        return result, peak / self.payload_size
+
+    def test_single_image_peak(self):
+        """Test that encoding one image holds at most two copies of the payload"""
+        from app import encode_image_to_data_url
+        data_url, peak = self._peak(lambda: encode_image_to_data_url(self.image_path))
+        self.assertTrue(data_url.startswith('data:image/jpeg;base64,'))
+        self.assertLess(peak, self.SINGLE_BUDGET_PAYLOADS)
+
+    def test_request_peak_for_five_images(self):
+        """Test the peak while building the content parts of one extraction request"""
+        from app import build_image_content
+        content, peak = self._peak(lambda: build_image_content([self.image_path] * 5))
+        self.assertEqual(len(content), 5)
+        self.assertLess(peak, self.REQUEST_BUDGET_PAYLOADS)
+
+    def test_evaluation_payload_is_shared(self):
+        """Test that repeated predictions reuse one data URL string"""
+        from app import encode_image_to_data_url
+        cache = DataUrlCache(max_bytes=10 * self.payload_size)
+        with patch('app.image_service', ImageService(workers=0)):
+            first = cache.get(self.image_path, encode_image_to_data_url)
+            second = cache.get(self.image_path, encode_image_to_data_url)
+        self.assertIs(first, second)
+        self.assertEqual(cache.stats()['hits'], 1)
+
+
+class StaticAssetsTestCase(unittest.TestCase):
+    """Test fingerprinted, precompressed static assets"""
+
+    def setUp(self):
+        self.source_dir = tempfile.mkdtemp()
+        self.build_dir = tempfile.mkdtemp()
+        self.css = b'body { color: #333; }\n' * 50
+        with open(os.path.join(self.source_dir, 'style.css'), 'wb') as f:
+            f.write(self.css)
+        Image.new('RGB', (10, 10)).save(os.path.join(self.source_dir, 'logo.png'))
+        self.assets = StaticAssets(self.source_dir, self.build_dir)
+        self.assets.build()
+
+    def tearDown(self):
+        shutil.rmtree(self.source_dir)
+        shutil.rmtree(self.build_dir)
+
+    def test_build_fingerprints_and_precompresses(self):
+        """Test that names carry a content hash and text files get a .gz variant"""
+        built = self.assets.url_name('style.css')
+        self.assertRegex(built, r'^style\.[0-9a-f]{12}\.css$')
+        path, encoding = self.assets.select(built, parse_accept_header('gzip'))
+        self.assertEqual(encoding, 'gzip')
+        with open(path, 'rb') as f:
+            self.assertEqual(gzip.decompress(f.read()), self.css)
+        # 画像は圧縮しない
+        _, encoding = self.assets.select(self.assets.url_name('logo.png'), parse_accept_header('gzip'))
+        self.assertIsNone(encoding)
+        self.assertIsNone(self.assets.select('style.css', parse_accept_header('gzip')))
+        # q=0 は「gzip を使わない」という指定
+        _, encoding = self.assets.select(built, parse_accept_header('gzip;q=0'))
+        self.assertIsNone(encoding)
+
+    def test_changed_content_changes_name(self):
+        """Test that editing a file produces a new fingerprinted name"""
+        before = self.assets.url_name('style.css')
+        with open(os.path.join(self.source_dir, 'style.css'), 'ab') as f:
+            f.write(b'h1 { margin: 0; }\n')
+        self.assets.build()
+        self.assertNotEqual(self.assets.url_name('style.css'), before)
+
+    @unittest.skipIf(static_assets.brotli is None, 'brotli is not installed')
+    def test_brotli_preferred_when_accepted(self):
+        """Test that br wins over gzip when the client accepts both"""
+        _, encoding = self.assets.select(self.assets.url_name('style.css'), parse_accept_header('gzip, br'))
+        self.assertEqual(encoding, 'br')
+
+    def test_pages_link_fingerprinted_assets_with_immutable_caching(self):
+        """Test url_for rewriting and the headers of the served asset"""
+        app.config['TESTING'] = True
+        client = app.test_client()
+        with app.test_request_context():
+            url = url_for('static', filename='style.css')
+        self.assertRegex(url, r'^/static/style\.[0-9a-f]{12}\.css$')
+        self.assertIn(url, client.get('/thanks-page').get_data(as_text=True))
+
+        response = client.get(url, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers.get('Content-Encoding'), 'gzip')
+        self.assertEqual(response.mimetype, 'text/css')
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        response.close()
+
+        response = client.get(url, headers={'Accept-Encoding': 'identity'})
+        self.assertNotIn('Content-Encoding', response.headers)
+        response.close()
+
+
+class AdmissionControllerTestCase(unittest.TestCase):
+    """Test admission control, queue positions and wait estimates"""
+
+    def _blocking_jobs(self, controller, count):
+        """Submit count jobs that wait on one event; return (jobs, started order, release event)"""
+        release = threading.Event()
+        started = []
+
+        def make(index):
+            def run():
+                started.append(index)
+                release.wait(5)
+                return index
+            return run
+
+        jobs = [controller.submit(f'k{index}', make(index))[0] for index in range(count)]
+        self.addCleanup(release.set)
+        return jobs, started, release
+
+    def _wait_until(self, predicate):
+        deadline = time.monotonic() + 5
+        while not predicate() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(predicate())
+
+    def test_concurrency_is_capped_and_queue_is_fifo(self):
+        """Test that at most max_concurrent jobs run and the rest start in order"""
+        controller = AdmissionController(max_concurrent=2, default_duration=60)
+        jobs, started, release = self._blocking_jobs(controller, 5)
+        self._wait_until(lambda: len(started) == 2)
+        time.sleep(0.05)
+        self.assertEqual(sorted(started), [0, 1])
+        self.assertEqual([controller.status(job.id)['position'] for job in jobs[2:]], [1, 2, 3])
+
+        release.set()
+        self._wait_until(lambda: all(job.finished for job in jobs))
+        self.assertEqual(started[2:], [2, 3, 4])
+        self.assertEqual([job.result for job in jobs], [0, 1, 2, 3, 4])
+        stats = controller.stats()
+        self.assertEqual((stats['completed'], stats['queued'], stats['running']), (5, 0, 0))
+
+    def test_wait_estimate_replays_free_slots(self):
+        """Test that queued jobs are estimated from the slots that free up first"""
+        controller = AdmissionController(max_concurrent=2, default_duration=100)
+        jobs, started, _ = self._blocking_jobs(controller, 5)
+        self._wait_until(lambda: len(started) == 2)
+
+        running = controller.status(jobs[0].id)
+        self.assertEqual(running['state'], 'running')
+        self.assertAlmostEqual(running['estimated_finish_seconds'], 100, delta=1)
+        starts = [controller.status(job.id)['estimated_start_seconds'] for job in jobs[2:]]
+        for estimate, expected in zip(starts, [100, 100, 200]):
+            self.assertAlmostEqual(estimate, expected, delta=1)
+        self.assertAlmostEqual(controller.status(jobs[4].id)['estimated_finish_seconds'], 300, delta=1)
+
+    def test_duplicate_key_shares_the_job(self):
+        """Test that a queued or running key is attached to instead of run again"""
+        controller = AdmissionController(max_concurrent=1)
+        calls = []
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def compute():
+            calls.append(1)
+            release.wait(5)
+            return 'cache-key'
+
+        first, shared_first = controller.submit('k', compute)
+        second, shared_second = controller.submit('k', compute)
+        self.assertIs(first, second)
+        self.assertEqual((shared_first, shared_second), (False, True))
+
+        release.set()
+        self._wait_until(lambda: first.finished)
+        self.assertEqual((len(calls), first.result), (1, 'cache-key'))
+        self.assertIsNone(controller.find_active('k'))
+        self.assertEqual(controller.stats()['coalesced'], 1)
+
+    def test_full_queue_rejects_and_failures_are_recorded(self):
+        """Test QueueFullError and that a failing job does not shorten the estimate"""
+        controller = AdmissionController(max_concurrent=1, max_queue=1, default_duration=50)
+        jobs, started, release = self._blocking_jobs(controller, 1)
+        self._wait_until(lambda: started == [0])
+        jobs.append(controller.submit('k-queued', lambda: None)[0])
+        with self.assertRaises(QueueFullError):
+            controller.submit('k-extra', lambda: None)
+        self.assertEqual(controller.stats()['rejected'], 1)
+        release.set()
+        self._wait_until(lambda: all(job.finished for job in jobs))
+
+        def fail():
+            raise ValueError('boom')
+
+        job, _ = controller.submit('k-fail', fail)
+        self._wait_until(lambda: job.finished)
+        self.assertEqual(job.state, 'failed')
+        self.assertIsInstance(job.error, ValueError)
+        self.assertEqual(controller.stats()['failed'], 1)
+        self.assertLess(controller.average_duration(), 50)
+
+    def test_waiting_page_follows_the_job(self):
+        """Test the submit -> waiting -> output redirects and the status endpoint"""
+        client = app.test_client()
+        app.config['TESTING'] = True
+        upload_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, upload_dir, True)
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def fake_pipeline(account_name, like_criteria, like_features, image_paths, cache_key, progress_id=None):
+            release.wait(5)
+            return cache_key
+
+        with client.session_transaction() as sess:
+            sess['account_name'] = 'test_user'
+            sess['like_criteria'] = 'criteria'
+            sess['like_features'] = 'features'
+            sess['cache_key'] = 'waiting-test'
+
+        def post_dislikes():
+            files = []
+            for index in range(5):
+                buffer = BytesIO()
+                Image.new('RGB', (8, 8), (index * 40, 0, 0)).save(buffer, 'JPEG')
+                buffer.seek(0)
+                files.append((buffer, f'dislike{index}.jpg'))
+            return client.post('/second', data={'dislike_images': files}, content_type='multipart/form-data')
+
+        before = client.get('/metrics').get_json()['dislike_pipeline']
+        with patch('app.upload_store', UploadStore(upload_dir, 3600, 0)), \
+                patch('app.run_dislike_pipeline', side_effect=fake_pipeline):
+            response = post_dislikes()
+            self.assertEqual(response.status_code, 302)
+            self.assertTrue(response.headers['Location'].endswith('/waiting'))
+
+            # 二重送信は実行中のジョブに合流し、合流数として数える
+            self.assertTrue(post_dislikes().headers['Location'].endswith('/waiting'))
+            after = client.get('/metrics').get_json()['dislike_pipeline']
+            self.assertEqual(after['executed'] - before['executed'], 1)
+            self.assertEqual(after['coalesced'] - before['coalesced'], 1)
+            self.assertGreater(after['coalesced_ratio'], 0)
+
+            status = client.get('/waiting/status').get_json()
+            self.assertIn(status['state'], ('queued', 'running'))
+            self.assertGreaterEqual(status['estimated_finish_minutes'], 1)
+            self.assertNotIn('redirect', status)
+            self.assertEqual(client.get('/waiting').status_code, 200)
+
+            release.set()
+            self._wait_until(lambda: 'redirect' in client.get('/waiting/status').get_json())
+            response = client.get('/waiting')
+            self.assertTrue(response.headers['Location'].endswith('/output'))
+            with client.session_transaction() as sess:
+                self.assertEqual(sess['cache_key'], 'waiting-test')
+                self.assertNotIn('job_id', sess)
+
+        self.assertEqual(client.get('/waiting/status').status_code, 404)
+
+
+class TextOnlyPathTestCase(unittest.TestCase):
+    """Test precomputed descriptions, the text-only prediction path and the comparison harness"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.test_dir, True)
+        self.image_path = os.path.join(self.test_dir, 'test1.jpg')
+        Image.new('RGB', (16, 16), (200, 30, 30)).save(self.image_path, 'JPEG')
+        self.calls = []
+
+    def _fake_complete(self, role, prompt, image_parts=(), max_tokens=None, hedge=False, **kwargs):
+        text_only = all(part['type'] == 'text' for part in image_parts)
+        self.calls.append((role, text_only, image_parts))
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content='赤が派手すぎる' if text_only else '赤が派手'))],
+            usage=SimpleNamespace(prompt_tokens=300 if text_only else 1200, completion_tokens=20))
+
+    def test_descriptions_are_stored_beside_images_and_expire_with_them(self):
+        """Test sidecar writing, skipping current descriptions and stale detection"""
+        store = DescriptionStore()
+        result = generate_descriptions([self.image_path], lambda path: ' 赤いワンピース ', 'gpt-4o-mini', store)
+        self.assertEqual(result['written'], ['test1.jpg'])
+        self.assertTrue(os.path.exists(os.path.join(self.test_dir, 'test1.description.json')))
+        self.assertEqual(store.get(self.image_path), '赤いワンピース')
+
+        describe = MagicMock(return_value='unused')
+        self.assertEqual(generate_descriptions([self.image_path], describe, 'm', store)['skipped'], ['test1.jpg'])
+        describe.assert_not_called()
+
+        Image.new('RGB', (16, 16), (30, 30, 200)).save(self.image_path, 'JPEG')
+        os.utime(self.image_path, (time.time() + 10, time.time() + 10))
+        self.assertIsNone(store.get(self.image_path))
+        self.assertEqual(store.stats()['stale'], 1)
+
+    @patch('app.model_registry.complete')
+    def test_text_only_methods_send_the_description(self, mock_complete):
+        """Test that only the switched method drops the image, and the image is the fallback"""
+        mock_complete.side_effect = self._fake_complete
+        args = ('u1', 'like', 'dislike', 'like-f', 'dislike-f', self.image_path)
+
+        impression = predict_impression(*args, method_interval=0, text_only_methods=('compare',))
+        self.assertEqual([text_only for _, text_only, _ in self.calls], [False, False])
+        self.assertEqual(impression['text_only_methods'], [])
+
+        write_description(self.image_path, '赤いワンピース', 'gpt-4o-mini')
+        self.calls.clear()
+        impression = predict_impression(*args, method_interval=0, text_only_methods=('compare',))
+        self.assertEqual([text_only for _, text_only, _ in self.calls], [False, True])
+        self.assertIn('赤いワンピース', self.calls[1][2][0]['text'])
+        self.assertEqual(impression['text_only_methods'], ['compare'])
+        self.assertEqual(impression['prediction_compare'], '赤が派手すぎる')
+
+    @patch('app.model_registry.complete')
+    def test_comparison_reports_latency_cost_and_agreement(self, mock_complete):
+        """Test that the harness runs both paths and summarizes them per method"""
+        mock_complete.side_effect = self._fake_complete
+        write_description(self.image_path, '赤いワンピース', 'gpt-4o-mini')
+        participants = [{'account_name': 'u1', 'like_criteria': 'a', 'dislike_criteria': 'b'}]
+        items = [{'id': 'test1', 'filename': 'test1.jpg'}, {'id': 'test2', 'filename': 'test2.jpg'}]
+        output_path = os.path.join(self.test_dir, 'comparison.jsonl')
+
+        with patch('app.TEST_DATA_DIR', self.test_dir), \
+                patch.object(batch_rerun.RateLimiter, 'acquire') as mock_acquire:
+            rows, missing = compare_text_path.run_comparison(participants, items, output_path,
+                                                             workers=2, rate_per_minute=6000, baseline=True)
+        self.assertEqual(missing, ['test2.jpg'])
+        # 説明文のない画像はレート制限の枠を使わない
+        mock_acquire.assert_called_once_with(3)
+        self.assertEqual([(row['image_id'], row['method']) for row in rows], [('test1', 'propose')])
+        with open(output_path, encoding='utf-8') as f:
+            self.assertEqual(len(f.readlines()), 1)
+
+        summary = compare_text_path.summarize(rows, input_price=1.0, output_price=2.0)['propose']
+        self.assertAlmostEqual(summary['cost_ratio'], (300 + 40) / (1200 + 40))
+        self.assertEqual(summary['baseline_agreement_mean'], 1.0)
+        self.assertLess(summary['agreement_mean'], 1.0)
+        self.assertEqual(summary['exact_match_rate'], 0.0)
+        self.assertEqual(summary['vision']['prompt_tokens_mean'], 1200)
+
+
+class _FakeStream:
+    """Chat completion stream stand-in that records how far it was read"""
+
+    def __init__(self, pieces):
+        self.pieces = pieces
+        self.consumed = 0
+        self.closed = False
+
+    def __iter__(self):
+        for piece in self.pieces:
+            self.consumed += 1
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=piece))])
+
+    def close(self):
+        self.closed = True
+
+
+class StreamingExtractionTestCase(unittest.TestCase):
+    """Test streamed criteria extraction and progress events"""
+
+    def _stream_with(self, pieces, **kwargs):
+        stream = _FakeStream(pieces)
+        fake_client = MagicMock()
+        fake_client.chat.completions.create.return_value = stream
+        with patch('app.client', fake_client):
+            text = stream_bullets('prompt', [], **kwargs)
+        return text, stream, fake_client.chat.completions.create.call_args.kwargs
+
+    def test_stops_after_max_bullets(self):
+        """Test that the stream is closed once ten bullets have arrived"""
+        pieces = [f'・基準{i}\n' for i in range(1, 13)]
+        progress = []
+        text, stream, kwargs = self._stream_with(pieces, on_bullet=lambda i, n: progress.append((i, n)))
+
+        self.assertTrue(kwargs['stream'])
+        self.assertEqual(text.splitlines(), [f'・基準{i}' for i in range(1, 11)])
+        self.assertEqual(stream.consumed, 10)
+        self.assertTrue(stream.closed)
+        self.assertEqual(progress[-1], (10, 10))
+
+    def test_bullets_split_across_chunks(self):
+        """Test that lines split across chunks and a final line without newline are kept"""
+        text, stream, _ = self._stream_with(['・シン', 'プル\n・明る', 'い色'], max_bullets=10)
+        self.assertEqual(text, '・シンプル\n・明るい色')
+        self.assertTrue(stream.closed)
+
+    def test_progress_board_replays_and_ends_on_done(self):
+        """Test that a late listener receives every event up to 'done'"""
+        board = ProgressBoard()
+        board.publish('abcdef12', type='bullet', stage='like_criteria', index=1, total=10)
+        board.publish(None, type='bullet')  # ID なしの送信は無視される
+        threading.Timer(0.05, board.publish, args=('abcdef12',), kwargs={'type': 'done'}).start()
+        events = list(board.listen('abcdef12', timeout=5))
+        self.assertEqual([e['type'] for e in events], ['bullet', 'done'])
+
+    def test_progress_route_streams_events(self):
+        """Test the Server-Sent Events endpoint"""
+        app.config['TESTING'] = True
+        with patch('app.progress_board', ProgressBoard()) as board:
+            board.publish('abcdef12', type='prediction', index=1, total=20)
+            board.publish('abcdef12', type='done')
+            response = app.test_client().get('/progress/abcdef12')
+            self.assertEqual(response.mimetype, 'text/event-stream')
+            self.assertIn('data: {"type": "prediction"', response.get_data(as_text=True))
+            self.assertEqual(app.test_client().get('/progress/bad!id').status_code, 400)
+
+
+class UploadStoreTestCase(unittest.TestCase):
+    """Test sharded upload storage and the retention janitor"""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+    def _write(self, name, size, age):
+        path = os.path.join(self.store.shard_dir(), name)
+        with open(path, 'wb') as f:
+            f.write(b'x' * size)
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_save_uses_date_shard(self):
+        """Test that uploads are saved under <root>/<YYYYMMDD>/<HH>/"""
+        self.store = UploadStore(self.root)
+        file = FileStorage(stream=BytesIO(b'abc'), filename='../like 1.jpg')
+        path, = self.store.save([file])
+        relative = os.path.relpath(path, self.root).split(os.sep)
+        self.assertEqual(len(relative), 3)
+        self.assertEqual(len(relative[0]), 8)
+        self.assertTrue(relative[2].endswith('_like_1.jpg'))
+        self.assertEqual(self.store.stats()['bytes'], 3)
+
+    def test_saved_files_are_in_use_until_released(self):
+        """Test that save() protects its files before the caller acquires them"""
+        self.store = UploadStore(self.root, quota_bytes=1)
+        path, = self.store.save([FileStorage(stream=BytesIO(b'abc'), filename='like.jpg')])
+        self.assertEqual(self.store.stats()['in_use'], 1)
+        self.assertEqual(self.store.sweep(), {'age': 0, 'quota': 0})
+        self.assertTrue(os.path.exists(path))
+        self.store.release([path])
+        self.assertEqual(self.store.sweep(), {'age': 0, 'quota': 1})
+        self.assertFalse(os.path.exists(path))
+
+    def test_sweep_keeps_current_and_in_use_shards(self):
+        """Test that the janitor only removes empty shards nobody is writing to"""
+        self.store = UploadStore(self.root)
+        current = self.store.shard_dir()
+        stale = self.store.shard_dir(datetime(2020, 1, 1, 3))
+        pending = self.store.shard_dir(datetime(2020, 1, 2, 4))
+        self.store.acquire([os.path.join(pending, 'upload.jpg')])
+        self.store.sweep()
+        self.assertTrue(os.path.isdir(current))
+        self.assertTrue(os.path.isdir(pending))
+        self.assertFalse(os.path.exists(stale))
+
+    def test_sweep_evicts_expired_files(self):
+        """Test that files past retention are deleted"""
+        self.store = UploadStore(self.root, retention_seconds=3600)
+        old = self._write('old.jpg', 10, 7200)
+        new = self._write('new.jpg', 10, 60)
+        self.assertEqual(self.store.sweep(), {'age': 1, 'quota': 0})
+        self.assertFalse(os.path.exists(old))
+        self.assertTrue(os.path.exists(new))
+
+    def test_sweep_enforces_quota_oldest_first_and_skips_held_files(self):
+        """Test quota eviction order and that held files survive"""
+        self.store = UploadStore(self.root, quota_bytes=25)
+        oldest = self._write('a.jpg', 10, 300)
+        older = self._write('b.jpg', 10, 200)
+        newer = self._write('c.jpg', 10, 100)
+        newest = self._write('d.jpg', 10, 50)
+        with self.store.hold([oldest]):
+            evicted = self.store.sweep()
+        self.assertEqual(evicted, {'age': 0, 'quota': 2})
+        self.assertTrue(os.path.exists(oldest))
+        self.assertFalse(os.path.exists(older))
+        self.assertFalse(os.path.exists(newer))
+        self.assertTrue(os.path.exists(newest))
+        stats = self.store.stats()
+        self.assertEqual((stats['bytes'], stats['evicted_quota'], stats['in_use']), (20, 2, 0))
+
+
+class StructuredLoggingTestCase(unittest.TestCase):
+    """Test the queue-based JSON logging pipeline"""
+
+    def tearDown(self):
+        set_correlation_id(None)
+        configure_logging(logging.INFO)
+
+    def test_records_are_json_with_correlation_id(self):
+        """Test that records are written as JSON by the listener thread"""
+        stream = StringIO()
+        configure_logging(logging.INFO, stream)
+        set_correlation_id('participant-1')
+        logging.getLogger('test.structured').info("predicted %s for %s", 'ok', 'test1.jpg')
+        shutdown_logging()
+
+        entry = json.loads(stream.getvalue().strip().splitlines()[-1])
+        self.assertEqual(entry['message'], 'predicted ok for test1.jpg')
+        self.assertEqual(entry['correlation_id'], 'participant-1')
+        self.assertEqual(entry['level'], 'INFO')
+
+    def test_payload_filter_caps_and_samples(self):
+        """Test that payload text is truncated and sampling drops records"""
+        record = logging.LogRecord('p', logging.INFO, __file__, 1, "%s %s", ('x' * 50, 3), None)
+        self.assertTrue(PayloadFilter(1.0, 10).filter(record))
+        self.assertEqual(record.args[0], 'x' * 10 + '...(+40 chars)')
+        self.assertEqual(record.args[1], 3)
+        self.assertFalse(PayloadFilter(0.0).filter(record))
+
+
+class _KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _reply(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(b'ok')
+
+    do_GET = do_POST = do_HEAD = _reply
+
+    def log_message(self, format, *args):
+        pass
+
+
+class HttpTransportTestCase(unittest.TestCase):
+    """Test connection reuse in the shared HTTP transport"""
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), _KeepAliveHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}/webhook'
+        self.transport = HttpTransport(pool_size=2, connect_timeout=2, read_timeout=2)
+
+    def tearDown(self):
+        self.transport.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_webhook_posts_reuse_connection(self):
+        """Test that consecutive webhook posts share one connection"""
+        for _ in range(3):
+            self.assertEqual(self.transport.post_json(self.url, {'a': 1}).status_code, 200)
+        stats = self.transport.stats()
+        self.assertEqual((stats['n8n_requests'], stats['n8n_connections']), (3, 1))
+
+    def test_warm_up_opens_pooled_connections(self):
+        """Test that warm-up connections are reused by later httpx requests"""
+        self.assertEqual(self.transport.warm_up(self.url, connections=1), 1)
+        self.transport.http_client.get(self.url)
+        stats = self.transport.stats()
+        self.assertEqual((stats['openai_requests'], stats['openai_connections']), (2, 1))
+        self.assertEqual(stats['openai_in_flight'], 0)
+        self.assertEqual(stats['openai_reuse_ratio'], 0.5)
+
+
+class _SleepyClient:
+    """Chat client stand-in whose latency depends on the requested model"""
+
+    def __init__(self, delays):
+        self.delays = delays
+        self.models = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _create(self, model, **kwargs):
+        self.models.append(model)
+        time.sleep(self.delays[model])
+        return model
+
+
+class ModelBackendsTestCase(unittest.TestCase):
+    """Test the model backend registry and hedged requests"""
+
+    def _registry(self, delays, ratio):
+        fake = _SleepyClient(delays)
+        registry = ModelRegistry(lambda: fake, lambda backend: fake, hedge_max_extra_ratio=ratio,
+                                 hedge_min_samples=5, max_workers=4)
+        registry.register(ModelBackend('slow', 'slow-model', max_tokens=256))
+        registry.register(ModelBackend('fast', 'fast-model', max_tokens=256))
+        registry.assign('prediction', 'slow', 'fast')
+        for _ in range(5):
+            registry.latency_for('prediction', registry.get('slow')).record(0.01)
+        return registry, fake
+
+    def test_latency_percentiles(self):
+        """Test percentile calculation over the sliding window"""
+        tracker = LatencyTracker(window=100)
+        self.assertIsNone(tracker.percentile(95))
+        for ms in range(1, 101):
+            tracker.record(ms / 1000)
+        self.assertEqual(tracker.percentile(50), 0.05)
+        self.assertEqual(tracker.percentile(95), 0.095)
+
+    def test_request_body_respects_format_and_limit(self):
+        """Test prompt formats and the per-backend max_tokens cap"""
+        backend = ModelBackend('sys', 'm', max_tokens=100, prompt_format='system_prompt')
+        body = backend.request_body('instruction', [{'type': 'image_url'}], max_tokens=256)
+        self.assertEqual(body['max_tokens'], 100)
+        self.assertEqual(body['messages'][0], {'role': 'system', 'content': 'instruction'})
+        with self.assertRaises(ValueError):
+            ModelBackend('bad', 'm', prompt_format='xml')
+
+    def test_slow_call_is_hedged_and_fast_attempt_wins(self):
+        """Test that a call slower than p95 is hedged to the other backend"""
+        registry, fake = self._registry({'slow-model': 0.5, 'fast-model': 0.0}, ratio=1.0)
+        started = time.monotonic()
+        result = registry.complete('prediction', 'p', hedge=True)
+        self.assertEqual(result, 'fast-model')
+        self.assertLess(time.monotonic() - started, 0.4)
+        stats = registry.stats()
+        self.assertEqual((stats['hedges'], stats['hedge_wins']), (1, 1))
+
+    def test_saturated_callers_are_not_hedged(self):
+        """Test that many concurrent calls under p95 send no hedges with a small hedge pool"""
+        fake = _SleepyClient({'slow-model': 0.2, 'fast-model': 0.0})
+        registry = ModelRegistry(lambda: fake, lambda backend: fake, hedge_max_extra_ratio=1.0,
+                                 hedge_min_samples=5, max_workers=2)
+        registry.register(ModelBackend('slow', 'slow-model', max_tokens=256))
+        registry.register(ModelBackend('fast', 'fast-model', max_tokens=256))
+        registry.assign('prediction', 'slow', 'fast')
+        for _ in range(5):
+            registry.latency_for('prediction', registry.get('slow')).record(0.25)
+
+        callers = [threading.Thread(target=registry.complete, args=('prediction', 'p'), kwargs={'hedge': True})
+                   for _ in range(6)]
+        for caller in callers:
+            caller.start()
+        for caller in callers:
+            caller.join(5)
+        self.assertEqual(registry.stats()['hedges'], 0)
+        self.assertNotIn('fast-model', fake.models)
+
+    def test_hedge_threshold_ignores_other_roles_and_streams(self):
+        """Test that slow extraction calls on the same backend do not raise the prediction p95"""
+        registry, fake = self._registry({'slow-model': 0.0, 'fast-model': 0.0}, ratio=1.0)
+        registry.assign('extraction', 'slow')
+        slow = registry.get('slow')
+        for _ in range(5):
+            registry.latency_for('extraction', slow).record(30.0)
+        registry.complete('extraction', 'p', stream=True)
+
+        self.assertEqual(registry.latency_for('prediction', slow).percentile(95), 0.01)
+        self.assertEqual(registry.latency_for('extraction', slow).count, 5)
+        self.assertEqual(slow.latency.count, 1)
+        roles = registry.stats()['roles']
+        self.assertEqual(roles['prediction']['latency']['samples'], 5)
+
+    def test_hedges_stay_within_spend_cap(self):
+        """Test that no hedge is sent once the extra-request budget is used"""
+        registry, fake = self._registry({'slow-model': 0.05, 'fast-model': 0.0}, ratio=0.01)
+        self.assertEqual(registry.complete('prediction', 'p', hedge=True), 'slow-model')
+        stats = registry.stats()
+        self.assertEqual((stats['hedges'], stats['hedges_over_budget']), (0, 1))
+        self.assertNotIn('fast-model', fake.models)
+
+
+class BatchRerunTestCase(unittest.TestCase):
+    """Test the offline batch re-run CLI"""
+
+    def setUp(self):
+        self.output_path = 'test_rerun_output.jsonl'
+        self.items = [{'id': f'test{i}', 'filename': f'test{i}.jpg'} for i in range(1, 4)]
+
+    def tearDown(self):
+        if os.path.exists(self.output_path):
+            os.remove(self.output_path)
+
+    @staticmethod
+    def _fake_prediction(account_name, like_criteria, dislike_criteria, like_features, dislike_features,
+                         image_path, methods, prompt_templates, method_interval):
+        return {'impression_id': 'id', 'image_name': os.path.basename(image_path),
+                'account_name': account_name, 'prediction_propose': 'P',
+                'prediction_compare': 'C' if 'compare' in methods else None,
+                'timestamp': 'now', 'has_error': os.path.basename(image_path) == 'test3.jpg'}
+
+    def test_load_participants_from_memo(self):
+        """Test that memo.json captures merge into one record per participant"""
+        participants = batch_rerun.load_participants('memo.json')
+        self.assertEqual([p['account_name'] for p in participants], ['test001'])
+        self.assertIn('like_criteria', participants[0])
+        self.assertIn('dislike_criteria', participants[0])
+        self.assertEqual(batch_rerun.participant_methods(participants[0], ('propose', 'compare')),
+                         ('propose',))
+
+    def test_rate_limiter_charges_requests_larger_than_the_bucket(self):
+        """Test that acquire(n) above the bucket capacity waits for every token"""
+        limiter = batch_rerun.RateLimiter(6000)  # 100 tokens/s, bucket of 100
+        started = time.monotonic()
+        limiter.acquire(130)
+        self.assertGreaterEqual(time.monotonic() - started, 0.25)
+
+    @patch('batch_rerun.fashion_app.client', MagicMock())
+    @patch('batch_rerun.fashion_app.TEXT_ONLY_METHODS', ('compare',))
+    def test_batch_backend_refuses_text_only_methods(self):
+        """Test that --backend batch does not silently send images for text-only methods"""
+        with patch('sys.stderr', StringIO()) as stderr, self.assertRaises(SystemExit):
+            batch_rerun.main(['memo.json', '-o', self.output_path, '--backend', 'batch'])
+        self.assertIn('TEXT_ONLY_METHODS includes compare', stderr.getvalue())
+
+    @patch('batch_rerun.fashion_app.predict_impression')
+    def test_run_batch_writes_jsonl_and_resumes(self, mock_predict):
+        """Test that results are checkpointed and errored pairs are retried"""
+        mock_predict.side_effect = self._fake_prediction
+        participants = [{'account_name': 'u1', 'like_criteria': 'a', 'dislike_criteria': 'b'}]
+
+        summary = batch_rerun.run_batch(participants, self.items, self.output_path, workers=2,
+                                        rate_per_minute=6000)
+        self.assertEqual((summary['completed'], summary['errors']), (3, 1))
+        with open(self.output_path, encoding='utf-8') as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(sorted(r['image_id'] for r in records), ['test1', 'test2', 'test3'])
+        self.assertEqual(records[0]['methods'], ['propose'])
+
+        summary = batch_rerun.run_batch(participants, self.items, self.output_path, rate_per_minute=6000)
+        self.assertEqual((summary['skipped'], summary['completed']), (2, 1))
+
+        # 手法の追加・プロンプトの変更は、該当する手法だけを実行する
+        participants[0].update({'like_features': 'c', 'dislike_features': 'd'})
+        summary = batch_rerun.run_batch(participants, self.items, self.output_path,
+                                        methods=('propose', 'compare'), rate_per_minute=6000)
+        self.assertEqual(summary['completed'], 3)
+        self.assertEqual(sorted(call.kwargs['methods'] for call in mock_predict.call_args_list[-3:]),
+                         sorted([('compare',), ('compare',), ('propose', 'compare')]))  # test3 は毎回エラー
+        summary = batch_rerun.run_batch(participants, self.items, self.output_path,
+                                        prompt_templates={'propose': 'revised'}, rate_per_minute=6000)
+        self.assertEqual(summary['completed'], 3)
+        self.assertEqual(sorted(call.kwargs['methods'] for call in mock_predict.call_args_list[-3:]),
+                         sorted([('propose',), ('propose',), ('propose', 'compare')]))  # test3 は毎回エラー
+
+
+class FakeBatchClient:
+    """Local stand-in for the OpenAI files and batches endpoints"""
+
+    def __init__(self, fail_custom_ids=()):
+        self.stored = {}
+        self.jobs = {}
+        self.fail_custom_ids = set(fail_custom_ids)
+        self.files = SimpleNamespace(create=self._create_file, content=self._file_content)
+        self.batches = SimpleNamespace(create=self._create_batch, retrieve=self._retrieve_batch)
+
+    def _create_file(self, file, purpose):
+        file_id = f'file-{len(self.stored)}'
+        content = file[1] if isinstance(file, tuple) else file.read()
+        self.stored[file_id] = content.decode('utf-8')
+        return SimpleNamespace(id=file_id)
+
+    def _file_content(self, file_id):
+        return SimpleNamespace(text=self.stored[file_id])
+
+    def _create_batch(self, input_file_id, endpoint, completion_window, metadata):
+        batch_id = f'batch-{len(self.jobs)}'
+        self.jobs[batch_id] = SimpleNamespace(id=batch_id, status='validating', input_file_id=input_file_id,
+                                              output_file_id=None, error_file_id=None, polls=0)
+        return self.jobs[batch_id]
+
+    def _retrieve_batch(self, batch_id):
+        job = self.jobs[batch_id]
+        job.polls += 1
+        if job.status != 'completed' and job.polls >= 2:
+            outputs, errors = [], []
+            for line in self.stored[job.input_file_id].splitlines():
+                custom_id = json.loads(line)['custom_id']
+                if custom_id in self.fail_custom_ids:
+                    errors.append({'custom_id': custom_id, 'response': {'status_code': 500, 'body': {}}})
+                else:
+                    body = {'choices': [{'message': {'content': f'pred:{custom_id}'}}]}
+                    outputs.append({'custom_id': custom_id, 'response': {'status_code': 200, 'body': body}})
+            job.output_file_id = self._create_file(('o', '\n'.join(map(json.dumps, outputs)).encode()), 'batch_output').id
+            job.error_file_id = self._create_file(('e', '\n'.join(map(json.dumps, errors)).encode()), 'batch_output').id
+            job.status = 'completed'
+        elif job.status == 'validating':
+            job.status = 'in_progress'
+        return job
+
+
+class BatchApiTestCase(unittest.TestCase):
+    """Test the Batch API prediction backend"""
+
+    def setUp(self):
+        self.output_path = 'test_batch_output.jsonl'
+        self.state_path = 'test_batch_state.json'
+        self.participants = [{'account_name': 'u:1', 'like_criteria': 'a', 'dislike_criteria': 'b',
+                              'like_features': 'c', 'dislike_features': 'd'}]
+        self.items = [{'id': 'test1', 'filename': 'test1.jpg'}, {'id': 'test2', 'filename': 'test2.jpg'}]
+
+    def tearDown(self):
+        for path in (self.output_path, self.state_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _chunk_sizes(self, lines, **limits):
+        chunk_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, chunk_dir, True)
+        sizes = []
+        for path, custom_ids in batch_api.write_chunks(iter(lines), chunk_dir, **limits):
+            with open(path, encoding='utf-8') as f:
+                self.assertEqual(f.read().splitlines(), [line for custom_id, line in lines if custom_id in custom_ids])
+            sizes.append(len(custom_ids))
+        return sizes
+
+    def test_chunking_respects_count_and_size(self):
+        """Test that request lines are streamed into files split by count and by bytes"""
+        lines = [(str(i), 'x' * 9) for i in range(5)]
+        self.assertEqual(self._chunk_sizes(lines, max_requests=2), [2, 2, 1])
+        self.assertEqual(self._chunk_sizes(lines, max_bytes=30), [3, 2])
+        # 同じ参加者・画像の組は手法が違っても分割しない
+        pair = [('propose:test1:u', 'x'), ('compare:test1:u', 'y'), ('propose:test2:u', 'z')]
+        self.assertEqual(self._chunk_sizes(pair, max_requests=1), [2, 1])
+
+    def test_custom_id_round_trip(self):
+        """Test that account names containing ':' survive the custom_id"""
+        custom_id = batch_api.make_custom_id('propose', 'test1', 'u:1')
+        self.assertEqual(batch_api.parse_custom_id(custom_id), ('propose', 'test1', 'u:1'))
+
+    def test_submit_poll_ingest_and_resubmit_errors(self):
+        """Test the full cycle against the stand-in, including idempotent re-runs"""
+        failing = batch_api.make_custom_id('compare', 'test2', 'u:1')
+        client = FakeBatchClient(fail_custom_ids=[failing])
+        summary = batch_api.run_batch_api(client, self.participants, self.items, self.output_path,
+                                          self.state_path, poll_interval=0, max_requests=3)
+        self.assertEqual(summary['submitted_requests'], 4)
+        self.assertEqual(summary['batches'], {'completed': 2})
+        with open(self.output_path, encoding='utf-8') as f:
+            records = {r['image_id']: r for r in map(json.loads, f)}
+        self.assertEqual(records['test1']['prediction_propose'], 'pred:propose:test1:u:1')
+        self.assertFalse(records['test1']['has_error'])
+        self.assertTrue(records['test2']['has_error'])
+
+        # 再実行ではエラーになった組だけを再投入し、取り込み済みのバッチは再度取り込まない
+        client.fail_custom_ids.clear()
+        summary = batch_api.run_batch_api(client, self.participants, self.items, self.output_path,
+                                          self.state_path, poll_interval=0)
+        self.assertEqual((summary['submitted_requests'], summary['ingested_records']), (2, 1))
+        hashes = batch_rerun.prompt_hashes(('propose', 'compare'))
+        self.assertEqual(batch_rerun.load_checkpoint(self.output_path),
+                         {('u:1', image_id, method, hashes[method])
+                          for image_id in ('test1', 'test2') for method in ('propose', 'compare')})
+
+        # プロンプトを変えた手法だけを再投入する
+        summary = batch_api.run_batch_api(client, self.participants, self.items, self.output_path,
+                                          self.state_path, prompt_templates={'compare': 'revised'}, poll_interval=0)
+        self.assertEqual(summary['submitted_requests'], 2)
+
+
 def run_tests():
     """Run all tests"""
     # Create test suite
@@ -188,6 +1280,19 @@ def run_tests():
     suite.addTests(loader.loadTestsFromTestCase(FlaskAppTestCase))
     suite.addTests(loader.loadTestsFromTestCase(UtilityFunctionsTestCase))
     suite.addTests(loader.loadTestsFromTestCase(DirectoryStructureTestCase))
+    suite.addTests(loader.loadTestsFromTestCase(EvaluationSetTestCase))
+    suite.addTests(loader.loadTestsFromTestCase(ImageServiceTestCase))
+    suite.addTests(loader.loadTestsFromTestCase(EncodingMemoryTestCase))
+    suite.addTests(loader.loadTestsFromTestCase(StaticAssetsTestCase))
+    suite.addTests(loader.loadTestsFromTestCase(AdmissionControllerTestCase))
+    suite.addTests(loader.loadTestsFromTestCase(TextOnlyPathTestCase))
+    suite.addTests(loader.loadTestsFromTestCase(StreamingExtractionTestCase))
+    suite.addTests(loader.loadTestsFromTestCase(UploadStoreTestCase))
+    suite.addTests(loader.loadTestsFromTestCase(StructuredLoggingTestCase))
+    suite.addTests(loader.loadTestsFromTestCase(HttpTransportTestCase))
+    suite.addTests(loader.loadTestsFromTestCase(ModelBackendsTestCase))
+    suite.addTests(loader.loadTestsFromTestCase(BatchRerunTestCase))
+    suite.addTests(loader.loadTestsFromTestCase(BatchApiTestCase))
 
     # Run tests
     runner = unittest.TextTestRunner(verbosity=2)
@@ -0,0 +1,266 @@
+"""
+Upload storage for AI Fashion Experiment
+アップロード画像の保存先（日付・時間ごとのシャーディング）と保持期間管理
+
+Files are saved under <root>/<YYYYMMDD>/<HH>/ so that no single directory
+grows without bound. A background janitor deletes files older than the
+retention period and evicts the oldest files while the total size exceeds
+the quota. Files referenced by a running job are never deleted; save()
+marks its files in use before writing them, so an upload is protected from
+the moment its path exists.
+"""
+
+import os
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from werkzeug.utils import secure_filename
+
+logger = logging.getLogger(__name__)
+
+
+class UploadStore:
+    """
+    Sharded upload directory with reference tracking and a retention janitor.
+
+    Args:
+        root: Upload root directory
+        retention_seconds: Maximum file age (0 = no age limit)
+        quota_bytes: Maximum total size of stored files (0 = no quota)
+    """
+
+    def __init__(self, root, retention_seconds=0, quota_bytes=0):
+        self.root = root
+        self.retention_seconds = retention_seconds
+        self.quota_bytes = quota_bytes
+        self._lock = threading.Lock()
+        self._in_use = {}  # absolute path -> reference count
+        self._janitor = None
+        self._stop = threading.Event()
+        self._stats = {
+            'files': 0,
+            'bytes': 0,
+            'evicted_age': 0,
+            'evicted_quota': 0,
+            'evicted_bytes': 0,
+            'sweeps': 0,
+            'last_sweep': None,
+        }
+        os.makedirs(root, exist_ok=True)
+
+    def _shard_path(self, now):
+        return os.path.join(self.root, now.strftime('%Y%m%d'), now.strftime('%H'))
+
+    def shard_dir(self, now=None):
+        """Return (and create) the shard directory for the given time."""
+        path = self._shard_path(now or datetime.now())
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def save(self, files):
+        """
+        Save uploaded files into the current shard with a timestamp prefix.
+
+        The returned paths are already acquired (see acquire()); the caller
+        owns that reference and must release() it when done.
+
+        Args:
+            files: Iterable of werkzeug FileStorage objects
+
+        Returns:
+            List of saved file paths
+        """
+        now = datetime.now()
+        directory = self._shard_path(now)
+        timestamp = now.strftime('%Y%m%d_%H%M%S_')
+        image_paths = []
+        files = list(files)
+        for file in files:
+            image_paths.append(os.path.join(directory, timestamp + secure_filename(file.filename)))
+
+        # 書き込み前に使用中として登録し、シャード作成も同じロック内で行う（掃除との競合防止）
+        with self._lock:
+            self._mark_in_use(image_paths)
+            os.makedirs(directory, exist_ok=True)
+        try:
+            for file, filepath in zip(files, image_paths):
+                file.save(filepath)
+        except Exception:
+            self.release(image_paths)
+            raise
+
+        added = sum(os.path.getsize(path) for path in image_paths)
+        with self._lock:
+            self._stats['files'] += len(image_paths)
+            self._stats['bytes'] += added
+        return image_paths
+
+    def _mark_in_use(self, paths):
+        for path in paths:
+            key = os.path.abspath(path)
+            self._in_use[key] = self._in_use.get(key, 0) + 1
+
+    def acquire(self, paths):
+        """Protect paths from deletion until release() is called."""
+        with self._lock:
+            self._mark_in_use(paths)
+
+    def release(self, paths):
+        """Undo one acquire() of paths."""
+        with self._lock:
+            for path in paths:
+                key = os.path.abspath(path)
+                if self._in_use[key] <= 1:
+                    del self._in_use[key]
+                else:
+                    self._in_use[key] -= 1
+
+    @contextmanager
+    def hold(self, paths):
+        """Protect paths from deletion while the block runs."""
+        self.acquire(paths)
+        try:
+            yield paths
+        finally:
+            self.release(paths)
+
+    def _scan(self):
+        """Return [(mtime, size, path)] for every stored file."""
+        entries = []
+        stack = [self.root]
+        while stack:
+            directory = stack.pop()
+            try:
+                with os.scandir(directory) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False) and not entry.name.startswith('.'):
+                            stat = entry.stat()
+                            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            except FileNotFoundError:
+                continue
+        return entries
+
+    def _protected_dirs(self):
+        """Return directories that must not be removed (caller holds the lock)."""
+        root = os.path.abspath(self.root)
+        protected = {root}
+        current = os.path.abspath(self._shard_path(datetime.now()))
+        for path in [os.path.join(current, '')] + list(self._in_use):
+            directory = os.path.dirname(path)
+            while directory not in protected and directory.startswith(root):
+                protected.add(directory)
+                directory = os.path.dirname(directory)
+        return protected
+
+    def _remove_empty_shards(self):
+        """Delete shard directories left empty by eviction, except the current shard."""
+        for dirpath, dirnames, filenames in os.walk(self.root, topdown=False):
+            if dirnames or filenames:
+                continue
+            # save() はロック内でシャードを作って使用中登録するので、判定と削除も同じロック内で行う
+            with self._lock:
+                if os.path.abspath(dirpath) in self._protected_dirs():
+                    continue
+                try:
+                    os.rmdir(dirpath)
+                except OSError:
+                    pass
+
+    def sweep(self, now=None):
+        """
+        Enforce retention and quota once.
+        保持期間を過ぎたファイルを削除し、容量超過分を古い順に削除する
+
+        Returns:
+            Dictionary with the number of files evicted by age and by quota
+        """
+        now = now or time.time()
+        entries = sorted(self._scan())
+        total_bytes = sum(size for _, size, _ in entries)
+
+        with self._lock:
+            in_use = set(self._in_use)
+
+        evicted = {'age': 0, 'quota': 0}
+        evicted_bytes = 0
+        kept = []
+        for mtime, size, path in entries:
+            if os.path.abspath(path) in in_use:
+                kept.append((mtime, size, path))
+                continue
+
+            reason = None
+            if self.retention_seconds and now - mtime > self.retention_seconds:
+                reason = 'age'
+            elif self.quota_bytes and total_bytes > self.quota_bytes:
+                reason = 'quota'
+
+            if reason is None:
+                kept.append((mtime, size, path))
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning("Could not evict upload %s: %s", path, e)
+                kept.append((mtime, size, path))
+                continue
+            evicted[reason] += 1
+            evicted_bytes += size
+            total_bytes -= size
+
+        self._remove_empty_shards()
+
+        with self._lock:
+            self._stats['files'] = len(kept)
+            self._stats['bytes'] = sum(size for _, size, _ in kept)
+            self._stats['evicted_age'] += evicted['age']
+            self._stats['evicted_quota'] += evicted['quota']
+            self._stats['evicted_bytes'] += evicted_bytes
+            self._stats['sweeps'] += 1
+            self._stats['last_sweep'] = datetime.fromtimestamp(now).isoformat()
+
+        if evicted['age'] or evicted['quota']:
+            logger.info("Upload janitor evicted %d expired and %d over-quota files", evicted['age'], evicted['quota'])
+        return evicted
+
+    def start_janitor(self, interval):
+        """Run sweep() every interval seconds in a daemon thread (idempotent)."""
+        if interval <= 0 or self._janitor is not None:
+            return
+        with self._lock:
+            if self._janitor is not None:
+                return
+            self._janitor = threading.Thread(target=self._run_janitor, args=(interval,),
+                                             name='upload-janitor', daemon=True)
+            self._janitor.start()
+
+    def stop_janitor(self):
+        """Stop the janitor thread."""
+        self._stop.set()
+        if self._janitor is not None:
+            self._janitor.join()
+            self._janitor = None
+
+    def _run_janitor(self, interval):
+        while True:
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error("Upload janitor failed: %s", e, exc_info=True)
+            if self._stop.wait(interval):
+                return
+
+    def stats(self):
+        """Return current usage and eviction counts."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['in_use'] = len(self._in_use)
+        stats['quota_bytes'] = self.quota_bytes
+        stats['retention_seconds'] = self.retention_seconds
+        return stats